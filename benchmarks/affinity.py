@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Benchmark: effect of CPU/NUMA pinning on concurrently running memory-bound tasks
+
+Starts a number of worker processes (standing in for concurrently running local tasks),
+each repeatedly copying a buffer much larger than the CPU caches, once without
+pinning and once pinned by the same allocator fdaemon uses with --pin-cpus.
+The memory is first touched after pinning, as it would be by a pinned CP2K run.
+"""
+
+import os
+import sys
+import time
+import multiprocessing
+
+import click
+
+# run from a checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fatman_clients.affinity import CpuAllocator, numa_topology, format_cpulist
+
+
+def memory_bound_worker(cpuset, size, duration, start_barrier, result_queue):
+    """Copy a buffer of the given size back and forth for duration seconds"""
+
+    if cpuset:
+        os.sched_setaffinity(0, cpuset)
+
+    # first-touch happens here, after pinning
+    src = bytearray(os.urandom(1024)) * (size // 1024)
+    dst = bytearray(len(src))
+
+    start_barrier.wait()
+
+    copied = 0
+    start = time.time()
+    while time.time() - start < duration:
+        dst[:] = src
+        src[:] = dst
+        copied += 2*len(src)
+
+    result_queue.put((copied, time.time() - start))
+
+
+def run_round(workers, cpus_per_worker, size, duration, pin):
+    """Run one round with all workers in parallel, returns the aggregated bandwidth in GB/s"""
+
+    allocator = CpuAllocator()
+    barrier = multiprocessing.Barrier(workers)
+    results = multiprocessing.Queue()
+
+    procs = []
+    cpusets = []
+    for _ in range(workers):
+        cpuset = allocator.allocate(cpus_per_worker) if pin else None
+        if pin and cpuset is None:
+            raise click.UsageError("not enough CPUs to pin {} workers".format(workers))
+        cpusets.append(cpuset)
+        procs.append(multiprocessing.Process(
+            target=memory_bound_worker, args=(cpuset, size, duration, barrier, results)))
+
+    for proc in procs:
+        proc.start()
+
+    totals = [results.get() for _ in procs]
+
+    for proc in procs:
+        proc.join()
+
+    if pin:
+        click.echo("  cpusets: {}".format(", ".join(format_cpulist(c) for c in cpusets)))
+
+    return sum(copied / elapsed for copied, elapsed in totals) / 1e9
+
+
+@click.command()
+@click.option('--workers', type=int, default=None,
+              help="Number of concurrent workers (default: one per usable CPU)")
+@click.option('--size', type=int, default=256, show_default=True,
+              help="Buffer size per worker in MiB")
+@click.option('--duration', type=float, default=10., show_default=True,
+              help="Duration of each round in seconds")
+@click.option('--rounds', type=int, default=3, show_default=True,
+              help="Number of alternating unpinned/pinned rounds")
+def main(workers, size, duration, rounds):
+    """Compare the aggregated memory bandwidth of unpinned and pinned workers"""
+
+    topology = numa_topology()
+    ncpus = sum(len(c) for c in topology.values())
+    workers = workers or ncpus
+
+    click.echo("NUMA nodes: {}".format(
+        ", ".join("{}: {}".format(n, format_cpulist(c)) for n, c in sorted(topology.items()))))
+    click.echo("{} workers, {} MiB each, {:.0f}s per round".format(workers, size, duration))
+
+    bandwidth = {False: [], True: []}
+    for rnd in range(rounds):
+        for pin in (False, True):
+            click.echo("round {}, {}:".format(rnd+1, "pinned" if pin else "unpinned"))
+            result = run_round(workers, max(ncpus // workers, 1), size*1024*1024, duration, pin)
+            click.echo("  {:.2f} GB/s".format(result))
+            bandwidth[pin].append(result)
+
+    unpinned = max(bandwidth[False])
+    pinned = max(bandwidth[True])
+    click.echo("best unpinned: {:.2f} GB/s, best pinned: {:.2f} GB/s, speedup: {:.2f}x".format(
+        unpinned, pinned, pinned / unpinned))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""Benchmark: download throughput from a local server
+
+Serves a (sparse) file of the given size with sendfile() from a local server and
+downloads it repeatedly, once with the previous approach of iterating over the
+response content in small chunks and once with `fatman_clients.transfer.download`
+for several buffer sizes. Reports the best throughput of each method.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import click
+import requests
+
+# run from a checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fatman_clients.transfer import download
+
+
+class SendfileHandler(BaseHTTPRequestHandler):
+    """Serves the content of the server's file with sendfile()"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        size = self.server.size
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        self.wfile.flush()
+
+        offset = 0
+        while offset < size:
+            offset += os.sendfile(self.connection.fileno(), self.server.source_fd, offset, size - offset)
+
+
+def iter_content_download(sess, url, target, chunk_size):
+    """The approach used before: write chunks of the response content as they come"""
+
+    req = sess.get(url, stream=True)
+    req.raise_for_status()
+    with open(target, 'wb') as fhandle:
+        for chunk in req.iter_content(chunk_size):
+            fhandle.write(chunk)
+
+
+@click.command()
+@click.option('--size', type=int, default=1024, show_default=True,
+              help="Size of the downloaded file in MiB")
+@click.option('--repeat', type=int, default=3, show_default=True,
+              help="Number of downloads per method, the best one counts")
+@click.option('--target-dir', type=click.Path(file_okay=False, exists=True),
+              help="Directory to download to (default: a temporary directory)")
+@click.option('--fsync', type=click.Choice(['none', 'file', 'full']), default='none', show_default=True,
+              help="The fsync policy for transfer.download")
+def main(size, repeat, target_dir, fsync):
+    """Compare the download throughput of chunked iteration and transfer.download"""
+
+    size = size*1024*1024
+
+    with tempfile.NamedTemporaryFile() as source, tempfile.TemporaryDirectory(dir=target_dir) as tmp_dir:
+        source.truncate(size)
+        source.flush()
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), SendfileHandler)
+        server.size = size
+        server.source_fd = source.fileno()
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        url = 'http://127.0.0.1:{}/file'.format(server.server_port)
+        target = os.path.join(tmp_dir, 'download.bin')
+        sess = requests.Session()
+
+        methods = [
+            ("iter_content(1K)", lambda: iter_content_download(sess, url, target, 1024)),
+            ("iter_content(4K)", lambda: iter_content_download(sess, url, target, 4096)),
+        ]
+        for bufsize in (64*1024, 1024*1024, 4*1024*1024, 16*1024*1024):
+            methods.append(("download({}K)".format(bufsize // 1024),
+                            lambda b=bufsize: download(sess, url, target, buffer_size=b, fsync=fsync)))
+
+        click.echo("file size: {} MiB, best of {}".format(size // 2**20, repeat))
+
+        for name, func in methods:
+            best = None
+            for _ in range(repeat):
+                start = time.time()
+                func()
+                elapsed = time.time() - start
+                assert os.path.getsize(target) == size
+                os.unlink(target)
+                best = elapsed if best is None else min(best, elapsed)
+
+            click.echo("  {:<18} {:8.3f}s {:8.2f} GB/s".format(name, best, size / best / 1e9))
+
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+"""Benchmark: end-to-end task throughput of fdaemon, without a cluster or network
+
+Starts a local stand-in for the FATMAN task API serving a number of synthetic tasks,
+puts mock `sbatch`, `squeue` and `sacct` executables into the PATH (jobs are run
+directly in the background), and runs `fdaemon.main` against it until all tasks
+are done. The tasks sleep and write an output file of a given size.
+
+Reports the throughput in tasks per minute, the latency percentiles of the phases
+of a task as seen by the server and the number of API requests per task. Arguments
+after '--' are passed to fdaemon, for example:
+
+    benchmarks/fdaemon_throughput.py --tasks 2000 -- --max-local-tasks 4 --acquire-limit 4
+"""
+
+import os
+import re
+import sys
+import json
+import stat
+import time
+import uuid
+import shutil
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import click
+
+# run from a checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# the phases of a task, as the intervals between the events seen by the server
+PHASES = [
+    ('acquire', 'created', 'pending'),
+    ('stage', 'pending', 'running'),
+    ('execute', 'running', 'uploading'),
+    ('finalize', 'uploading', 'finished'),
+    ('total', 'created', 'finished'),
+    ]
+
+SBATCH = r'''#!{python}
+import os, sys, json, fcntl, subprocess
+state_dir = {state_dir!r}
+with open(os.path.join(state_dir, 'jobid'), 'a+') as fhandle:
+    fcntl.flock(fhandle, fcntl.LOCK_EX)
+    fhandle.seek(0)
+    jobid = int(fhandle.read() or 1000) + 1
+    fhandle.seek(0)
+    fhandle.truncate()
+    fhandle.write(str(jobid))
+rc_fn = os.path.join(state_dir, '{{}}.rc'.format(jobid))
+with open(os.path.join(state_dir, '{{}}.job'.format(jobid)), 'w') as fhandle:
+    json.dump({{'name': os.path.basename(os.getcwd())}}, fhandle)
+# the exit code is written before slurm.out gets closed, like slurm would update its state
+subprocess.Popen(['sh', '-c', '{{ sh "$0"; echo $? > "$1"; }} > slurm.out 2> slurm.err', sys.argv[-1], rc_fn],
+                 start_new_session=True, stdin=subprocess.DEVNULL)
+print('{{}};benchmark'.format(jobid))
+'''
+
+SQUEUE = r'''#!{python}
+import os, sys
+state_dir = {state_dir!r}
+for arg in sys.argv[1:]:
+    if arg.startswith('--jobs='):
+        for jobid in arg.split('=', 1)[1].split(','):
+            if not os.path.exists(os.path.join(state_dir, jobid + '.job')):
+                sys.exit("slurm_load_jobs error: Invalid job id specified")
+            if not os.path.exists(os.path.join(state_dir, jobid + '.rc')):
+                print('{{}}|RUNNING|0:01|1'.format(jobid))
+'''
+
+SACCT = r'''#!{python}
+import os, sys
+state_dir = {state_dir!r}
+print('JobID|JobName|State|ExitCode|Elapsed|Start|End|NNodes|NCPUS|MaxRSS|NodeList')
+for arg in sys.argv[1:]:
+    if arg.startswith('--jobs='):
+        for jobid in arg.split('=', 1)[1].split(','):
+            try:
+                with open(os.path.join(state_dir, jobid + '.rc')) as fhandle:
+                    returncode = int(fhandle.read().strip() or 1)
+            except IOError:
+                continue
+            state = 'COMPLETED' if returncode == 0 else 'FAILED'
+            print('{{0}}|batch|{{1}}|{{2}}:0|00:00:01|||1|1||localhost'.format(jobid, state, returncode))
+'''
+
+
+class TaskAPI(ThreadingHTTPServer):
+    """Holds the tasks, the timestamps of their events and the request statistics"""
+
+    daemon_threads = True
+
+    def __init__(self, address, tasks, use_etags, bulk_updates):
+        ThreadingHTTPServer.__init__(self, address, TaskAPIHandler)
+        self.tasks = {t['id']: t for t in tasks}
+        self.events = {t['id']: {'created': time.time()} for t in tasks}
+        self.requests = {}
+        self.use_etags = use_etags
+        self.bulk_updates = bulk_updates
+        self.lock = threading.Lock()
+        self.all_finished = threading.Event()
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def handle_error(self, request, client_address):
+        # connections get reset when the daemon is terminated at the end
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    def count(self, kind):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def event(self, task_id, name):
+        with self.lock:
+            self.events[task_id].setdefault(name, time.time())
+            if name == 'finished' and all('finished' in e for e in self.events.values()):
+                self.all_finished.set()
+
+
+class TaskAPIHandler(BaseHTTPRequestHandler):
+    """Stand-in for the parts of the FATMAN API used by fdaemon"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def send(self, obj, code=200):
+        body = json.dumps(obj).encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+        if self.server.use_etags and code == 200 and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if self.server.use_etags:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/api/v2/tasks':
+            self.server.count('GET tasks (list)')
+            states = query.get('status', ['new'])[0].split(',')
+            machine = query.get('machine', [None])[0]
+            with self.server.lock:
+                tasks = [t for t in self.server.tasks.values()
+                         if t['status'] in states and (machine is None or t['machine'] == machine)]
+                tasks = [{k: v for k, v in t.items() if k != 'infiles'} for t in tasks]
+            if 'limit' in query:
+                tasks = tasks[:int(query['limit'][0])]
+            return self.send(tasks)
+
+        match = re.match(r'^/api/v2/tasks/([^/]+)$', url.path)
+        if match:
+            self.server.count('GET task')
+            return self.send(self.server.tasks[match.group(1)])
+
+        match = re.match(r'^/files/([^/]+)/(.+)$', url.path)
+        if match:
+            self.server.count('GET input file')
+            task = self.server.tasks[match.group(1)]
+            content = [i for i in task['infiles'] if i['name'] == match.group(2)][0]['_content']
+            body = content.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return None
+
+        self.server.count('GET other')
+        return self.send({}, 404)
+
+    def update_task(self, task_id, changes):
+        with self.server.lock:
+            task = self.server.tasks[task_id]
+            task.update(changes)
+            task['mtime'] = '{:.6f}'.format(time.time())
+
+        status = changes.get('status')
+        if status in ('pending', 'running'):
+            self.server.event(task_id, status)
+        elif status in ('done', 'error'):
+            self.server.event(task_id, 'uploading')  # without any upload
+            self.server.event(task_id, 'finished')
+
+        return task
+
+    def do_PATCH(self):  # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        changes = json.loads(self.read_body().decode('utf-8'))
+
+        if url.path == '/api/v2/tasks':
+            self.server.count('PATCH tasks (bulk)')
+            if not self.server.bulk_updates:
+                return self.send({}, 405)
+            return self.send([self.update_task(c['id'], c) for c in changes])
+
+        self.server.count('PATCH task')
+        return self.send(self.update_task(url.path.rsplit('/', 1)[-1], changes))
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self.server.count('POST upload')
+        task_id = urlparse(self.path).path.split('/')[-2]
+        self.read_body()
+        self.server.event(task_id, 'uploading')
+        return self.send({}, 201)
+
+
+def make_tasks(base_url, count, slurm_fraction, duration, output_size, input_size):
+    """Generate the synthetic tasks"""
+
+    tasks = []
+    script = 'sleep {}; head -c {} /dev/zero > output.dat'.format(duration, output_size)
+
+    for num in range(count):
+        task_id = str(uuid.uuid4())
+        slurm = num < count * slurm_fraction
+
+        # the direct runner runs the commands, sbatch the batch script generated by the server
+        commands = [{'name': 'work', 'cmd': 'sh', 'args': ['-c', script]}]
+        infiles = [{'name': 'input.dat', '_content': 'x' * input_size, 'size': input_size}]
+        if slurm:
+            infiles.append({'name': 'run.sh', '_content': script + '\n', 'size': len(script) + 1})
+
+        for infile in infiles:
+            infile['_links'] = {'download': '{}/files/{}/{}'.format(base_url, task_id, infile['name'])}
+
+        tasks.append({
+            'id': task_id,
+            'status': 'new',
+            'machine': None,
+            'priority': 0,
+            'ctime': '{:012d}'.format(num),
+            'mtime': '{:.6f}'.format(time.time()),
+            'settings': {
+                'name': 'bench-{}'.format(num),
+                'machine': {'runner': 'slurm' if slurm else 'direct'},
+                'commands': commands,
+                'environment': {},
+                'output_artifacts': ['output.dat'],
+                },
+            'infiles': infiles,
+            'data': None,
+            '_links': {
+                'self': '{}/api/v2/tasks/{}'.format(base_url, task_id),
+                'uploads': '{}/api/v2/tasks/{}/uploads'.format(base_url, task_id),
+                },
+            })
+
+    return tasks
+
+
+def install_mock_slurm(bin_dir, state_dir):
+    """Write the mock sbatch, squeue and sacct executables"""
+
+    for name, template in (('sbatch', SBATCH), ('squeue', SQUEUE), ('sacct', SACCT)):
+        filename = os.path.join(bin_dir, name)
+        with open(filename, 'w') as fhandle:
+            fhandle.write(template.format(python=sys.executable, state_dir=state_dir))
+        os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR)
+
+
+def run_fdaemon(args, bin_dir):
+    """Entry point of the fdaemon process"""
+
+    os.environ['PATH'] = bin_dir + os.pathsep + os.environ.get('PATH', '')
+
+    from fatman_clients.fdaemon import main
+    main(args)  # pylint: disable=no-value-for-parameter
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+@click.command(context_settings={'ignore_unknown_options': True})
+@click.option('--tasks', 'ntasks', type=int, default=1000, show_default=True,
+              help="Number of tasks")
+@click.option('--slurm-fraction', type=click.FloatRange(0, 1), default=0.5, show_default=True,
+              help="Fraction of the tasks using the (mock) slurm runner instead of the direct runner")
+@click.option('--duration', type=float, default=0., show_default=True,
+              help="Seconds each task sleeps")
+@click.option('--output-size', type=int, default=4096, show_default=True,
+              help="Bytes written by each task")
+@click.option('--input-size', type=int, default=1024, show_default=True,
+              help="Bytes of input data of each task")
+@click.option('--etags/--no-etags', default=True, show_default=True,
+              help="Whether the stand-in API supports conditional requests")
+@click.option('--bulk-updates/--no-bulk-updates', default=True, show_default=True,
+              help="Whether the stand-in API supports bulk status updates")
+@click.option('--timeout', type=float, default=3600, show_default=True,
+              help="Give up after this many seconds")
+@click.option('--json', 'json_output', is_flag=True,
+              help="Print the report as JSON")
+@click.option('--min-throughput', type=float,
+              help="Exit with an error if fewer tasks per minute get done (for CI)")
+@click.argument('fdaemon_args', nargs=-1, type=click.UNPROCESSED)
+def main(ntasks, slurm_fraction, duration, output_size, input_size, etags, bulk_updates, timeout,
+         json_output, min_throughput, fdaemon_args):
+    """Run fdaemon against a local stand-in API and report its throughput"""
+
+    work_dir = tempfile.mkdtemp(prefix='fdaemon-bench-')
+    bin_dir = os.path.join(work_dir, 'bin')
+    state_dir = os.path.join(work_dir, 'slurm')
+    data_dir = os.path.join(work_dir, 'data')
+    for dirname in (bin_dir, state_dir, data_dir):
+        os.mkdir(dirname)
+
+    install_mock_slurm(bin_dir, state_dir)
+
+    server = TaskAPI(('127.0.0.1', 0), [], etags, bulk_updates)
+    for task in make_tasks(server.base_url, ntasks, slurm_fraction, duration, output_size, input_size):
+        server.tasks[task['id']] = task
+        server.events[task['id']] = {'created': time.time()}
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    # later arguments take precedence, fdaemon_args may override the defaults
+    args = ['--url', server.base_url, '--data-dir', data_dir, '--hostname', 'benchmark',
+            '--nap-time', '1', '--verbosity', 'WARNING'] + list(fdaemon_args)
+
+    start = time.time()
+    daemon = multiprocessing.Process(target=run_fdaemon, args=(args, bin_dir))
+    daemon.start()
+
+    # stop waiting as soon as fdaemon died, for example due to an invalid option
+    completed = False
+    deadline = start + timeout
+    while not completed and daemon.is_alive() and time.time() < deadline:
+        completed = server.all_finished.wait(min(1, max(deadline - time.time(), 0)))
+    elapsed = time.time() - start
+
+    exitcode = daemon.exitcode
+    daemon.terminate()
+    daemon.join()
+    server.shutdown()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    if not completed and exitcode is not None:
+        click.echo("fdaemon exited with status {} after {:.1f}s, {} of {} tasks finished".format(
+            exitcode, elapsed, sum(1 for e in server.events.values() if 'finished' in e), ntasks), err=True)
+        sys.exit(exitcode or 1)
+
+    finished = [e for e in server.events.values() if 'finished' in e]
+    throughput = len(finished) / elapsed * 60
+
+    report = {
+        'tasks': ntasks,
+        'finished': len(finished),
+        'failed': sum(1 for t in server.tasks.values() if t['status'] == 'error'),
+        'elapsed': elapsed,
+        'tasks_per_minute': throughput,
+        'phases': {},
+        'requests_per_task': {k: v / float(ntasks) for k, v in sorted(server.requests.items())},
+        'fdaemon_args': list(fdaemon_args),
+        }
+    report['requests_per_task']['total'] = sum(server.requests.values()) / float(ntasks)
+
+    for phase, begin, end in PHASES:
+        latencies = [e[end] - e[begin] for e in finished if begin in e and end in e]
+        report['phases'][phase] = {
+            'p50': percentile(latencies, .5), 'p90': percentile(latencies, .9),
+            'p99': percentile(latencies, .99), 'max': max(latencies) if latencies else float('nan'),
+            }
+
+    if json_output:
+        click.echo(json.dumps(report, indent=2, sort_keys=True))
+    else:
+        click.echo("{finished} of {tasks} tasks finished ({failed} failed) in {elapsed:.1f}s: "
+                   "{tasks_per_minute:.1f} tasks/minute".format(**report))
+        click.echo("\nlatencies in seconds:")
+        click.echo("  {:<10} {:>8} {:>8} {:>8} {:>8}".format('phase', 'p50', 'p90', 'p99', 'max'))
+        for phase, _, _ in PHASES:
+            click.echo("  {:<10} {p50:8.3f} {p90:8.3f} {p99:8.3f} {max:8.3f}".format(phase, **report['phases'][phase]))
+        click.echo("\nrequests per task:")
+        for kind, count in report['requests_per_task'].items():
+            click.echo("  {:<20} {:8.2f}".format(kind, count))
+
+    if not completed:
+        raise click.ClickException("timed out after {:.0f}s".format(timeout))
+
+    if min_throughput is not None and throughput < min_throughput:
+        raise click.ClickException("throughput of {:.1f} tasks/minute below the required {:.1f}".format(
+            throughput, min_throughput))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Benchmark: peak memory usage of multipart uploads
+
+Uploads a (sparse) file of the given size to a local stand-in server which reads
+and discards the request body, once using the streaming encoder fdaemon and fclient
+use and optionally once using `requests` with `files=`, which builds the complete
+body in memory. Each upload runs in a separate process to measure its peak RSS.
+"""
+
+import os
+import sys
+import time
+import resource
+import tempfile
+import threading
+import multiprocessing
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import click
+import requests
+
+# run from a checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fatman_clients.multipart import MultipartEncoder
+
+
+class DiscardingHandler(BaseHTTPRequestHandler):
+    """Reads the request body in chunks and throws it away"""
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        remaining = int(self.headers['Content-Length'])
+        while remaining:
+            remaining -= len(self.rfile.read(min(remaining, 1024*1024)))
+
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def upload_worker(method, url, filename, result_queue):
+    """Upload the file using the given method, report the elapsed time and the peak RSS"""
+
+    start = time.time()
+
+    with open(filename, 'rb') as fhandle:
+        if method == 'streaming':
+            encoder = MultipartEncoder(data={'name': 'benchmark'}, files={'data': fhandle})
+            req = requests.post(url, data=encoder, headers={'Content-Type': encoder.content_type})
+        else:
+            req = requests.post(url, data={'name': 'benchmark'}, files={'data': fhandle})
+
+    req.raise_for_status()
+
+    # ru_maxrss is in KiB on Linux
+    result_queue.put((time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+
+
+def baseline_worker(result_queue):
+    """Report the peak RSS of a process doing nothing but importing the modules"""
+    result_queue.put((0., resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+
+
+def run_in_process(target, *args):
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=target, args=args + (results,))
+    proc.start()
+    result = results.get()
+    proc.join()
+    return result
+
+
+@click.command()
+@click.option('--size', type=int, default=4096, show_default=True,
+              help="Size of the uploaded file in MiB")
+@click.option('--compare/--no-compare', default=False, show_default=True,
+              help="Also upload using requests' files= (needs about the file size in free memory)")
+def main(size, compare):
+    """Measure the peak memory usage of a multipart upload of a large file"""
+
+    server = HTTPServer(('127.0.0.1', 0), DiscardingHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}/upload'.format(server.server_port)
+
+    with tempfile.NamedTemporaryFile() as fhandle:
+        # a sparse file: reading it is cheap and it does not take any disk space
+        fhandle.truncate(size*1024*1024)
+        fhandle.flush()
+
+        _, baseline = run_in_process(baseline_worker)
+        click.echo("file size: {} MiB, baseline peak RSS: {:.1f} MiB".format(size, baseline / 2**20))
+
+        for method in ['streaming'] + (['requests'] if compare else []):
+            elapsed, peak = run_in_process(upload_worker, method, url, fhandle.name)
+            click.echo("{:>10}: {:7.1f}s, {:8.1f} MiB/s, peak RSS {:8.1f} MiB (+{:.1f} MiB)".format(
+                method, elapsed, size / elapsed, peak / 2**20, (peak - baseline) / 2**20))
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""Benchmark: resumable chunked uploads over an unreliable connection
+
+Uploads a file of random data to a local stand-in server implementing the upload
+session protocol of `fatman_clients.transfer.resumable_upload`, which injects faults:
+dropped connections in the middle of a chunk, lost acknowledgements, corrupted chunks
+and temporary server errors. Verifies the assembled file and reports how many bytes
+had to be sent in total, compared to the expected number for plain uploads which
+start over from byte zero after every failure.
+"""
+
+import os
+import sys
+import json
+import base64
+import random
+import hashlib
+import logging
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import click
+import requests
+
+# run from a checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fatman_clients import transfer
+
+
+class FaultInjectingServer(ThreadingHTTPServer):
+    """Holds the upload sessions and the fault statistics"""
+
+    def __init__(self, address, fault_rate, rng):
+        ThreadingHTTPServer.__init__(self, address, UploadSessionHandler)
+        self.fault_rate = fault_rate
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.received = 0
+        self.faults = {}
+        self.completed = {}
+
+    def fault(self):
+        """Randomly pick a fault to inject, None for none"""
+        with self.lock:
+            if self.rng.random() >= self.fault_rate:
+                return None
+            fault = self.rng.choice(['drop', 'lose-ack', 'corrupt', 'error'])
+            self.faults[fault] = self.faults.get(fault, 0) + 1
+            return fault
+
+
+class UploadSessionHandler(BaseHTTPRequestHandler):
+    """Stand-in for the upload session endpoints of the server"""
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def send(self, obj, code=200):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        return json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+
+    def session(self):
+        return self.server.sessions.get(self.path.rsplit('/', 1)[-1])
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        if self.path == '/sessions':
+            request = self.read_json()
+            sid = hashlib.sha1(os.urandom(16)).hexdigest()
+            self.server.sessions[sid] = dict(request, offset=0, data=tempfile.TemporaryFile())
+            return self.send({'offset': 0, '_links': {'self': self.url('/sessions/' + sid)}}, 201)
+
+        session = self.session()
+        if session is None:
+            return self.send({'errors': 'unknown session'}, 404)
+
+        request = self.read_json()
+        session['data'].seek(0)
+        checksum = 'sha256:' + transfer._sha256(session['data']).hexdigest()  # pylint: disable=protected-access
+        if session['offset'] != session['size'] or checksum != request['checksum']:
+            return self.send({'errors': 'checksum mismatch'}, 422)
+
+        self.server.completed[session['name']] = checksum
+        return self.send({'name': session['name']}, 201)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        session = self.session()
+        if session is None:
+            return self.send({'errors': 'unknown session'}, 404)
+        return self.send({'offset': session['offset']})
+
+    def do_PUT(self):  # pylint: disable=invalid-name
+        session = self.session()
+        if session is None:
+            return self.send({'errors': 'unknown session'}, 404)
+
+        length = int(self.headers['Content-Length'])
+        first = int(self.headers['Content-Range'].split()[1].split('-')[0])
+        fault = self.server.fault()
+
+        if fault == 'drop':
+            # read part of the chunk, then break the connection
+            self.server.received += len(self.rfile.read(length // 2))
+            self.close_connection = True
+            return None
+
+        data = self.rfile.read(length)
+        self.server.received += len(data)
+
+        if fault == 'error':
+            return self.send({'errors': 'temporarily unavailable'}, 503)
+
+        if fault == 'corrupt':
+            data = bytes([data[0] ^ 0xff]) + data[1:]
+
+        digest = base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')
+        if self.headers['Digest'] != 'sha-256=' + digest:
+            return self.send({'errors': 'digest mismatch'}, 400)
+
+        if first != session['offset']:
+            return self.send({'errors': 'unexpected offset', 'offset': session['offset']}, 409)
+
+        session['data'].seek(first)
+        session['data'].write(data)
+        session['offset'] += len(data)
+
+        if fault == 'lose-ack':
+            self.close_connection = True
+            return None
+
+        return self.send({'offset': session['offset']})
+
+    def url(self, urlpath):
+        return 'http://{}:{}{}'.format(*self.server.server_address[:2], urlpath)
+
+
+@click.command()
+@click.option('--size', type=int, default=256, show_default=True,
+              help="Size of the uploaded file in MiB")
+@click.option('--chunk-size', type=int, default=8, show_default=True,
+              help="Size of the chunks in MiB")
+@click.option('--fault-rate', type=float, default=0.2, show_default=True,
+              help="Probability of a fault for each chunk")
+@click.option('--seed', type=int, default=42, show_default=True,
+              help="Seed for the fault injection")
+@click.option('--max-resumes', type=int, default=100, show_default=True,
+              help="Number of times a given up upload is resumed before failing")
+@click.option('--verbose', is_flag=True, help="Show the retries")
+def main(size, chunk_size, fault_rate, seed, max_resumes, verbose):
+    """Upload a file through a fault-injecting server and report the transferred volume"""
+
+    if verbose:
+        logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
+
+    server = FaultInjectingServer(('127.0.0.1', 0), fault_rate, random.Random(seed))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    size = size*1024*1024
+    chunk_size = chunk_size*1024*1024
+
+    with tempfile.TemporaryFile() as fhandle:
+        for _ in range(0, size, 1024*1024):
+            fhandle.write(os.urandom(1024*1024))
+
+        expected = 'sha256:' + transfer._sha256(fhandle).hexdigest()  # pylint: disable=protected-access
+
+        # resume given up uploads like the daemon does when replaying the spool
+        sessions = {}
+        resumes = 0
+        while True:
+            try:
+                transfer.resumable_upload(
+                    requests.Session(), 'http://{}:{}/sessions'.format(*server.server_address[:2]),
+                    'artifact.bin', fhandle, size, chunk_size, session_url=sessions.get('url'),
+                    on_session=lambda url: sessions.update(url=url), retry_delay=0.01)
+                break
+            except requests.exceptions.RequestException as exc:
+                resumes += 1
+                if resumes > max_resumes:
+                    raise click.ClickException("upload failed after {} resumes: {}".format(max_resumes, exc))
+                logging.info("upload given up, resuming: %s", exc)
+
+    server.shutdown()
+
+    if server.completed.get('artifact.bin') != expected:
+        raise click.ClickException("the assembled file does not match the original")
+
+    # a plain upload of n chunk-sized parts succeeds only if none of them fails
+    nchunks = -(-size // chunk_size)
+    success = (1 - fault_rate)**nchunks
+    plain = size / success if success > 0 else float('inf')
+
+    click.echo("file verified, {} MiB in {} chunks, faults injected: {}".format(
+        size // 2**20, nchunks, ", ".join("{} {}".format(n, f) for f, n in sorted(server.faults.items())) or "none"))
+    click.echo("transferred: {:.1f} MiB ({:.2f}x the file size), resumed {} time(s)".format(
+        server.received / 2**20, server.received / size, resumes))
+    click.echo("expected for plain uploads restarting from zero: {:.1f} MiB ({:.2f}x)".format(
+        plain / 2**20, plain / size))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,135 @@
+"""CPU and NUMA node allocation for concurrently running local tasks"""
+
+import os
+import re
+import glob
+import logging
+import threading
+from os import path
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+NUMA_NODE_PATH = '/sys/devices/system/node'
+
+
+def parse_cpulist(cpulist):
+    """Convert a kernel CPU list like '0-3,8,10-11' into a list of integers"""
+
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus += range(int(first), int(last)+1)
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus):
+    """Convert a collection of CPU numbers into the compact kernel CPU list format"""
+
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu-1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+
+    return ','.join(str(f) if f == l else '{}-{}'.format(f, l) for f, l in ranges)
+
+
+def numa_topology(node_path=NUMA_NODE_PATH):
+    """Returns a dict NUMA node -> list of CPUs usable by this process.
+
+    Falls back to a single node containing all usable CPUs if the topology is unavailable."""
+
+    try:
+        usable = os.sched_getaffinity(0)
+    except AttributeError:  # not available on this platform
+        usable = set(range(os.cpu_count() or 1))
+
+    topology = {}
+    for cpulist_fn in glob.glob(path.join(node_path, 'node*', 'cpulist')):
+        node = int(re.search(r'node(\d+)', cpulist_fn).group(1))
+        with open(cpulist_fn) as fhandle:
+            cpus = [c for c in parse_cpulist(fhandle.read()) if c in usable]
+        if cpus:
+            topology[node] = cpus
+
+    if not topology:
+        topology = {0: sorted(usable)}
+
+    return topology
+
+
+class CpuAllocator(object):
+    """Hands out disjoint sets of CPUs, preferring CPUs from a single NUMA node.
+
+    Since memory is allocated on first touch by default, keeping all threads
+    of a task on one node also keeps its memory local to the node."""
+
+    def __init__(self, topology=None):
+        self._topology = topology if topology is not None else numa_topology()
+        self._free = {node: set(cpus) for node, cpus in self._topology.items()}
+        self._lock = threading.Lock()
+
+    @property
+    def free_cpus(self):
+        """The total number of currently unallocated CPUs"""
+        return sum(len(cpus) for cpus in self._free.values())
+
+    def _available(self, exclude):
+        if not exclude:
+            return self._free
+        return {node: cpus - exclude for node, cpus in self._free.items()}
+
+    def _select(self, ncpus, free):
+        # the node with the fewest free CPUs still fitting the request (best fit),
+        # this keeps larger nodes available for larger tasks
+        fitting = [n for n, cpus in free.items() if len(cpus) >= ncpus]
+        if fitting:
+            node = min(fitting, key=lambda n: (len(free[n]), n))
+            return {node: sorted(free[node])[:ncpus]}
+
+        # otherwise span the nodes with the most free CPUs
+        selected = {}
+        remaining = ncpus
+        for node in sorted(free, key=lambda n: (-len(free[n]), n)):
+            if not remaining:
+                break
+            cpus = sorted(free[node])[:remaining]
+            if cpus:
+                selected[node] = cpus
+                remaining -= len(cpus)
+
+        return selected if not remaining else None
+
+    def can_allocate(self, ncpus, exclude=None):
+        """Whether a request for ncpus could be satisfied right now,
+        without the CPUs in exclude (used by someone else)"""
+        with self._lock:
+            return max(ncpus, 1) <= sum(len(cpus) for cpus in self._available(exclude).values())
+
+    def allocate(self, ncpus, exclude=None):
+        """Reserve ncpus CPUs (not in exclude), returns the set of CPUs or None if not enough are free"""
+
+        with self._lock:
+            selected = self._select(max(ncpus, 1), self._available(exclude))
+            if selected is None:
+                return None
+
+            for node, cpus in selected.items():
+                self._free[node].difference_update(cpus)
+
+        cpuset = {c for cpus in selected.values() for c in cpus}
+        logger.debug("allocated CPUs %s on NUMA node(s) %s", format_cpulist(cpuset), sorted(selected))
+        return cpuset
+
+    def release(self, cpuset):
+        """Return previously allocated CPUs"""
+
+        with self._lock:
+            for node, cpus in self._topology.items():
+                self._free[node].update(cpuset.intersection(cpus))
@@ -0,0 +1,214 @@
+"""Collection of output artifacts from a task directory"""
+
+import os
+import re
+import io
+import logging
+from os import path
+from fnmatch import translate
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+# patterns for files which are considered logs and may be truncated instead of skipped when too large
+LOG_PATTERNS = ['*.out', '*.err', '*.log']
+
+TRUNCATION_MARKER = b"\n\n[... fdaemon: truncated %d bytes ...]\n\n"
+
+
+def parse_size(value):
+    """Convert a size specification like '512', '100K', '10M' or '2G' to bytes (None stays None)"""
+
+    if value is None or isinstance(value, int):
+        return value
+
+    match = re.match(r'^\s*(?P<num>\d+)\s*(?P<unit>[kKmMgGtT]?)i?[bB]?\s*$', value)
+    if not match:
+        raise ValueError("invalid size specification: '{}'".format(value))
+
+    exponent = ' KMGT'.index(match.group('unit').upper() or ' ')
+    return int(match.group('num')) * 1024**exponent
+
+
+class Artifact(object):
+    """An output file to be uploaded, possibly only partially (head and tail) if truncated"""
+
+    def __init__(self, filepath, name, size, keep=None):
+        self.path = filepath
+        self.name = name
+        self.size = size
+        self.keep = keep
+
+    @property
+    def truncated(self):
+        """Whether only head and tail of the file are going to be uploaded"""
+        return self.keep is not None
+
+    @property
+    def upload_size(self):
+        """The number of bytes which are going to be uploaded"""
+        if not self.truncated:
+            return self.size
+        return 2*self.keep + len(TRUNCATION_MARKER % (self.size - 2*self.keep))
+
+    def open(self):
+        """Return a file object for reading the (possibly truncated) content"""
+
+        if not self.truncated:
+            return open(self.path, 'rb')
+
+        with open(self.path, 'rb') as fhandle:
+            head = fhandle.read(self.keep)
+            fhandle.seek(-self.keep, os.SEEK_END)
+            tail = fhandle.read(self.keep)
+
+        return io.BytesIO(head + TRUNCATION_MARKER % (self.size - 2*self.keep) + tail)
+
+
+def _compile_pattern(pattern):
+    """Split a glob pattern into a list of compiled per-component regexes"""
+    return [re.compile(translate(c)) for c in pattern.split('/') if c]
+
+
+def _component_match(regex, pattern_component, name):
+    # follow glob semantics: wildcards do not match a leading dot
+    if name.startswith('.') and not pattern_component.startswith('.'):
+        return False
+    return regex.match(name) is not None
+
+
+def collect_artifacts(task_dir, patterns, outfiles=(),
+                      max_artifact_size=None, max_total_size=None, log_keep_size=None):
+    """Collect the files to upload for a finished task in a single walk of the task directory.
+
+    :param task_dir: the directory to search in
+    :param patterns: list of glob patterns relative to the task_dir (the declared output artifacts)
+    :param outfiles: additional files which get uploaded if they exist and are non-empty
+    :param max_artifact_size: skip (or truncate) files larger than this (in bytes)
+    :param max_total_size: stop adding artifacts once their total size exceeds this (in bytes)
+    :param log_keep_size: keep this many bytes of head and tail of too large log files
+                          instead of skipping them (None to disable truncation)
+    :returns: a tuple `(artifacts, warnings)` with a list of `Artifact` and a list of warning entries
+    """
+
+    compiled = [(p, [c for c in p.split('/') if c], _compile_pattern(p)) for p in patterns]
+    max_depth = max([len(c) for _, c, _ in compiled] + [1])
+
+    outfile_names = {}
+    for filepath in outfiles:
+        relname = path.relpath(filepath, task_dir)
+        outfile_names[relname] = filepath
+
+    # name -> (filepath, size), plus the matched entries per pattern
+    found = {}
+    matched = {p: [] for p in patterns}
+
+    def walk(dirpath, parts):
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError as exc:
+            logger.warning("unable to scan directory '%s': %s", dirpath, exc)
+            return
+
+        for entry in sorted(entries, key=lambda e: e.name):
+            eparts = parts + [entry.name]
+            relname = '/'.join(eparts)
+
+            if entry.is_dir():
+                if len(eparts) < max_depth:
+                    walk(entry.path, eparts)
+                continue
+
+            if not entry.is_file():
+                continue
+
+            depth = len(eparts)
+            pattern_hits = [p for p, pcomps, regexes in compiled
+                            if len(regexes) == depth and all(
+                                _component_match(r, pc, n) for r, pc, n in zip(regexes, pcomps, eparts))]
+
+            if not pattern_hits and relname not in outfile_names:
+                continue
+
+            found[relname] = (entry.path, entry.stat().st_size)
+
+            for pattern in pattern_hits:
+                matched[pattern].append(relname)
+
+    walk(task_dir, [])
+
+    warnings = []
+    candidates = []
+
+    # declared artifacts first (in the declared order), then the runner outfiles
+    for pattern in patterns:
+        if not matched[pattern]:
+            warnings.append({
+                'tag': "output_artifacts",
+                'entry': pattern,
+                'msg': "no files found",
+                })
+            continue
+
+        candidates += matched[pattern]
+
+    # outfiles outside the task dir (or too deep) were not seen during the walk
+    for relname, filepath in sorted(outfile_names.items()):
+        if relname not in found:
+            try:
+                found[relname] = (filepath, os.stat(filepath).st_size)
+            except OSError:
+                continue
+
+        if found[relname][1]:
+            candidates.append(relname)
+
+    log_regexes = [re.compile(translate(p)) for p in LOG_PATTERNS]
+
+    artifacts = []
+    seen = set()
+    total_size = 0
+
+    for relname in candidates:
+        if relname in seen:
+            continue
+        seen.add(relname)
+
+        filepath, size = found[relname]
+        artifact = Artifact(filepath, relname, size)
+
+        if max_artifact_size is not None and size > max_artifact_size:
+            is_log = any(r.match(path.basename(relname)) for r in log_regexes)
+
+            # the truncated file has to fit in the limit as well (the marker can only get shorter)
+            keep = None
+            if log_keep_size is not None:
+                keep = min(log_keep_size, (max_artifact_size - len(TRUNCATION_MARKER % size)) // 2)
+
+            if is_log and keep is not None and 0 < keep and 2*keep < size:
+                artifact = Artifact(filepath, relname, size, keep=keep)
+                warnings.append({
+                    'tag': "output_artifacts",
+                    'entry': relname,
+                    'msg': "file size {} exceeds limit of {}, truncated to head and tail of {} bytes".format(
+                        size, max_artifact_size, keep),
+                    })
+            else:
+                warnings.append({
+                    'tag': "output_artifacts",
+                    'entry': relname,
+                    'msg': "file size {} exceeds limit of {}, skipped".format(size, max_artifact_size),
+                    })
+                continue
+
+        if max_total_size is not None and total_size + artifact.upload_size > max_total_size:
+            warnings.append({
+                'tag': "output_artifacts",
+                'entry': relname,
+                'msg': "total upload size limit of {} reached, skipped".format(max_total_size),
+                })
+            continue
+
+        total_size += artifact.upload_size
+        artifacts.append(artifact)
+
+    return artifacts, warnings
@@ -0,0 +1,248 @@
+"""Isolation and resource accounting of local tasks with cgroups (v2)
+
+Each task gets its own cgroup below the one fdaemon was started in, with its memory
+limit and CPU quota, if the memory and cpu controllers are delegated to us. Without
+them (or without cgroup v2 at all), the tasks are run without limits and only the
+accounting available is reported.
+"""
+
+import os
+import time
+import signal
+import logging
+from os import path
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+# the period in microseconds for the CPU quota of a task
+CPU_PERIOD = 100000
+
+# the resources for which the pressure stall information is reported
+PRESSURE_RESOURCES = ('cpu', 'memory', 'io')
+
+# time to wait for the processes of a killed task to vanish before removing its cgroup
+REMOVE_TIMEOUT = 10
+
+
+def cgroup2_mount(mounts_fn='/proc/self/mounts'):
+    """Returns the mount point of the cgroup v2 hierarchy, None if not mounted"""
+
+    try:
+        with open(mounts_fn, 'r') as fhandle:
+            for line in fhandle:
+                fields = line.split()
+                if len(fields) > 2 and fields[2] == 'cgroup2':
+                    return fields[1]
+    except (OSError, IOError):
+        pass
+
+    return None
+
+
+def own_cgroup(cgroup_fn='/proc/self/cgroup'):
+    """Returns the cgroup v2 path of this process (relative to the mount point), None if unknown"""
+
+    try:
+        with open(cgroup_fn, 'r') as fhandle:
+            for line in fhandle:
+                if line.startswith('0::'):
+                    return line[3:].strip()
+    except (OSError, IOError):
+        pass
+
+    return None
+
+
+def _read(filepath):
+    with open(filepath, 'r') as fhandle:
+        return fhandle.read().strip()
+
+
+def _write(filepath, value):
+    with open(filepath, 'w') as fhandle:
+        fhandle.write(value)
+
+
+def _read_keyed(filepath):
+    """Read a flat keyed file like cpu.stat or memory.events into a dict of integers"""
+    return {k: int(v) for k, v in (l.split() for l in _read(filepath).splitlines())}
+
+
+class TaskCgroup(object):
+    """The cgroup of a single task"""
+
+    def __init__(self, cgroup_dir, memory_limit=None, cpu_quota=None):
+        self.path = cgroup_dir
+        self.memory_limit = memory_limit
+        self.cpu_quota = cpu_quota
+
+    def wrap(self, cmdline):
+        """The command line to run a command in the cgroup, by a shell moving itself into the cgroup
+        before exec'ing the command (no Python code has to run in the forked child)"""
+        return ['/bin/sh', '-c', 'echo 0 > "$0" && exec "$@"', path.join(self.path, 'cgroup.procs')] + cmdline
+
+    def stats(self):
+        """The resource usage of the task so far, only containing what the kernel provides"""
+
+        stats = {}
+
+        if self.memory_limit is not None:
+            stats['memory_limit'] = self.memory_limit
+        if self.cpu_quota is not None:
+            stats['cpu_quota'] = self.cpu_quota
+
+        try:
+            stats['memory_peak'] = int(_read(path.join(self.path, 'memory.peak')))
+        except (OSError, IOError, ValueError):
+            pass  # memory controller not enabled or kernel older than 5.19
+
+        try:
+            stats['oom_kills'] = _read_keyed(path.join(self.path, 'memory.events'))['oom_kill']
+        except (OSError, IOError, ValueError, KeyError):
+            pass
+
+        try:
+            cpu_stat = _read_keyed(path.join(self.path, 'cpu.stat'))
+            for key in ('usage', 'user', 'system', 'throttled'):
+                if key + '_usec' in cpu_stat:
+                    stats['cpu_' + key] = cpu_stat[key + '_usec'] / 1e6
+        except (OSError, IOError, ValueError):
+            pass
+
+        # the total time (in seconds) some or all of the tasks were stalled waiting for a resource
+        pressure = {}
+        for resource in PRESSURE_RESOURCES:
+            try:
+                lines = _read(path.join(self.path, '{}.pressure'.format(resource))).splitlines()
+            except (OSError, IOError):
+                continue
+
+            pressure[resource] = {}
+            for line in lines:
+                kind, *fields = line.split()
+                values = dict(f.split('=', 1) for f in fields)
+                pressure[resource][kind] = int(values['total']) / 1e6
+
+        if pressure:
+            stats['pressure'] = pressure
+
+        return stats
+
+    def remove(self):
+        """Kill all remaining processes of the task and remove the cgroup"""
+
+        kill_fn = path.join(self.path, 'cgroup.kill')
+        procs_fn = path.join(self.path, 'cgroup.procs')
+
+        deadline = time.time() + REMOVE_TIMEOUT
+
+        while True:
+            try:
+                os.rmdir(self.path)
+                return
+            except FileNotFoundError:
+                return
+            except OSError as exc:
+                if time.time() > deadline:
+                    logger.warning("unable to remove the cgroup '%s': %s", self.path, exc)
+                    return
+
+            # busy: some processes survived the task, kill them (cgroup.kill exists since Linux 5.14)
+            try:
+                if path.exists(kill_fn):
+                    _write(kill_fn, '1')
+                else:
+                    for pid in _read(procs_fn).split():
+                        os.kill(int(pid), signal.SIGKILL)
+            except (OSError, IOError):
+                pass
+
+            time.sleep(0.1)
+
+
+class CgroupManager(object):
+    """Creates the cgroups for the tasks below the cgroup fdaemon was started in.
+
+    Since cgroup v2 only allows controllers to be enabled for the children of a cgroup
+    without processes, fdaemon moves itself into a leaf cgroup 'fdaemon' first."""
+
+    def __init__(self, base_dir=None):
+        self.base_dir = base_dir
+        self.controllers = set()
+
+        if self.base_dir is None:
+            mount, own = cgroup2_mount(), own_cgroup()
+            if mount is None or own is None:
+                logger.warning("cgroup v2 not available, running local tasks without cgroups")
+                return
+            self.base_dir = path.join(mount, own.lstrip('/'))
+
+        try:
+            leaf = path.join(self.base_dir, 'fdaemon')
+            if not path.isdir(leaf):
+                os.mkdir(leaf)
+            _write(path.join(leaf, 'cgroup.procs'), str(os.getpid()))
+        except (OSError, IOError) as exc:
+            logger.warning("cgroup '%s' not delegated to us, running local tasks without cgroups: %s",
+                           self.base_dir, exc)
+            self.base_dir = None
+            return
+
+        available = set(_read(path.join(self.base_dir, 'cgroup.controllers')).split())
+
+        for controller in ('memory', 'cpu'):
+            if controller not in available:
+                continue
+            try:
+                _write(path.join(self.base_dir, 'cgroup.subtree_control'), '+' + controller)
+                self.controllers.add(controller)
+            except (OSError, IOError) as exc:
+                logger.debug("unable to enable the %s controller: %s", controller, exc)
+
+        missing = {'memory', 'cpu'} - self.controllers
+        if missing:
+            logger.warning("cgroup controller(s) %s not available, not limiting local tasks accordingly",
+                           ', '.join(sorted(missing)))
+
+    @property
+    def available(self):
+        """Whether tasks get their own cgroups"""
+        return self.base_dir is not None
+
+    def create(self, name, memory_limit=None, cpus=None):
+        """Create the cgroup for a task, returns None if not possible.
+
+        :param memory_limit: the memory limit in bytes, beyond which the task gets killed
+        :param cpus: the number of CPUs the task may use at most (as CPU time)
+        """
+
+        if not self.available:
+            return None
+
+        cgroup_dir = path.join(self.base_dir, 'task-{}'.format(name))
+
+        # a leftover of a previous run of the same task
+        if path.isdir(cgroup_dir):
+            TaskCgroup(cgroup_dir).remove()
+
+        cgroup = TaskCgroup(cgroup_dir)
+
+        try:
+            os.mkdir(cgroup_dir)
+
+            if memory_limit and 'memory' in self.controllers:
+                _write(path.join(cgroup_dir, 'memory.max'), str(memory_limit))
+                # on OOM kill the complete task instead of leaving it in an undefined state
+                _write(path.join(cgroup_dir, 'memory.oom.group'), '1')
+                cgroup.memory_limit = memory_limit
+
+            if cpus and 'cpu' in self.controllers:
+                _write(path.join(cgroup_dir, 'cpu.max'), '{} {}'.format(cpus*CPU_PERIOD, CPU_PERIOD))
+                cgroup.cpu_quota = cpus
+
+        except (OSError, IOError) as exc:
+            logger.warning("unable to set up the cgroup for task %s, running it without: %s", name, exc)
+            cgroup.remove()
+            return None
+
+        return cgroup
@@ -0,0 +1,22 @@
+"""Helpers shared by the command line interfaces"""
+
+import click
+
+from .artifacts import parse_size
+from .runners import parse_duration
+
+
+def validate_size(ctx, param, value):
+    """Convert and validate size arguments"""
+    try:
+        return parse_size(value)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+
+
+def validate_duration(ctx, param, value):
+    """Convert and validate duration arguments"""
+    try:
+        return parse_duration(value)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
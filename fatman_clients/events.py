@@ -0,0 +1,238 @@
+"""Task lifecycle event log of fdaemon, and its offline analysis
+
+The log is a JSON Lines file with one record per event, with the time ('t'), the kind
+of event ('ev'), the task id ('task') and event specific fields:
+
+    acquired   task acquired from the server (runner, priority, queue_wait)
+    released   acquired task handed back to the server
+    download   input file downloaded (name, bytes, duration)
+    staged     all inputs of a task downloaded (files, bytes, duration), or failed (error)
+    started    task started (runner)
+    command    external command terminated (name, returncode, duration)
+    finished   task terminated (runner, success, timed_out, walltime, error)
+    upload     output artifact uploaded (name, bytes, duration)
+    uploaded   results uploaded and final status set (status, artifacts, bytes, duration, spooled)
+
+Durations are in seconds.
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import logging
+import threading
+import calendar
+from datetime import datetime
+from collections import defaultdict, Counter
+
+import click
+import click_log
+
+from .history import quantile
+from .cli import validate_duration
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+
+def parse_timestamp(value):
+    """Convert a server timestamp (seconds since the epoch or ISO 8601, UTC unless specified)
+    to seconds since the epoch, None if not parseable"""
+
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    try:
+        stamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+    if stamp.tzinfo is None:
+        return calendar.timegm(stamp.timetuple()) + stamp.microsecond / 1e6
+
+    return stamp.timestamp()
+
+
+class EventLog(object):
+    """Appends events to the log, safe to be used from several threads and processes"""
+
+    def __init__(self, log_fn):
+        self.log_fn = log_fn
+        self._lock = threading.Lock()
+        # with O_APPEND each record gets written in one piece at the current end of the file
+        self._fdesc = os.open(log_fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def emit(self, event, task_id=None, **fields):
+        """Record an event, fields with a value of None are left out"""
+
+        record = {'t': round(time.time(), 3), 'ev': event, 'task': task_id}
+        record.update((k, round(v, 3) if isinstance(v, float) else v) for k, v in fields.items() if v is not None)
+
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+
+        with self._lock:
+            try:
+                os.write(self._fdesc, line)
+            except OSError as exc:
+                logger.warning("unable to write to the event log '%s': %s", self.log_fn, exc)
+
+    def close(self):
+        """Close the log file"""
+        with self._lock:
+            os.close(self._fdesc)
+
+
+# the phases of a task for which the latencies are reported: (name, event, field with the duration)
+PHASES = (
+    ('queue wait', 'acquired', 'queue_wait'),
+    ('staging', 'staged', 'duration'),
+    ('run', 'finished', 'walltime'),
+    ('upload', 'uploaded', 'duration'),
+    )
+
+# the events needed for the analysis, records of the others are not decoded at all
+ANALYZED_EVENTS = ('acquired', 'staged', 'finished', 'uploaded')
+
+
+class EventStats(object):
+    """Aggregates the events of one or more logs in a single pass"""
+
+    def __init__(self, interval=3600, since=None):
+        self.interval = interval
+        self.since = since
+
+        self.nevents = 0
+        self.latencies = {name: [] for name, _, _ in PHASES}
+        self.latencies['end to end'] = []
+        self.throughput = defaultdict(Counter)  # interval start -> status -> count
+        self.outcomes = defaultdict(Counter)  # runner -> outcome -> count
+        self.errors = defaultdict(Counter)  # runner -> error message -> count
+
+        self._acquired = {}  # task id -> creation time (from the acquisition)
+
+    def add_lines(self, lines):
+        """Aggregate the events of an iterable of log lines"""
+
+        analyzed = set(ANALYZED_EVENTS)
+        loads = json.loads
+
+        for line in lines:
+            self.nevents += 1
+
+            # decoding is what takes the time, look at the kind of event first (written by EventLog.emit)
+            start = line.find('"ev":"') + 6
+            if line[start:line.find('"', start)] not in analyzed:
+                continue
+
+            try:
+                record = loads(line)
+            except ValueError:
+                continue  # partially written, the daemon got killed
+
+            if self.since is not None and record['t'] < self.since:
+                continue
+
+            self._add(record)
+
+    def _add(self, record):
+        event = record['ev']
+
+        for name, phase_event, field in PHASES:
+            if event == phase_event and field in record:
+                self.latencies[name].append(record[field])
+
+        if event == 'acquired':
+            self._acquired[record['task']] = record['t'] - record.get('queue_wait', 0)
+
+        elif event == 'finished':
+            runner = record.get('runner') or 'unknown'
+            if record.get('success'):
+                self.outcomes[runner]['succeeded'] += 1
+            else:
+                self.outcomes[runner]['timed out' if record.get('timed_out') else 'failed'] += 1
+                self.errors[runner][record.get('error') or '(no error message)'] += 1
+
+        elif event == 'uploaded':
+            bucket = int(record['t'] // self.interval * self.interval)
+            self.throughput[bucket][record.get('status', 'unknown')] += 1
+
+            created = self._acquired.pop(record['task'], None)
+            if created is not None:
+                self.latencies['end to end'].append(record['t'] - created)
+
+
+def _open_log(log_fn):
+    if log_fn == '-':
+        return sys.stdin
+    if log_fn.endswith('.gz'):
+        return gzip.open(log_fn, 'rt', encoding='utf-8')
+    return open(log_fn, 'r', encoding='utf-8')
+
+
+def _format_duration(seconds):
+    if seconds >= 3600:
+        return "{:.1f}h".format(seconds / 3600)
+    if seconds >= 60:
+        return "{:.1f}m".format(seconds / 60)
+    return "{:.2f}s".format(seconds)
+
+
+@click.command()
+@click.argument('logs', nargs=-1, required=True, type=click.Path(exists=True, allow_dash=True))
+@click.option('--interval', type=str, callback=validate_duration, default='1h', show_default=True,
+              help="Length of the intervals for the throughput (e.g. '15m', '1h' or '1d')")
+@click.option('--since', type=str, callback=validate_duration,
+              help="Only consider the events of this last period of time (e.g. '7d'), default: all")
+@click.option('--top-errors', type=click.IntRange(min=0), default=5, show_default=True,
+              help="Number of most frequent error messages to show per runner")
+@click_log.simple_verbosity_option()
+@click_log.init(__name__)
+def analyze(logs, interval, since, top_errors):
+    """Latencies, throughput and failures of the tasks in fdaemon event logs
+
+    The logs (plain or gzip compressed, '-' for stdin) are read in a single pass."""
+
+    from .fclient import get_table_instance
+
+    stats = EventStats(interval, since=time.time() - since if since else None)
+
+    start = time.time()
+    for log_fn in logs:
+        with _open_log(log_fn) as fhandle:
+            stats.add_lines(fhandle)
+
+    logger.info("analyzed %d events in %.1fs", stats.nevents, time.time() - start)
+
+    table_data = [["Phase", "Count", "Mean", "p50", "p90", "p99", "Max"]]
+    for name, values in stats.latencies.items():
+        if not values:
+            continue
+        table_data.append([name, len(values), _format_duration(sum(values) / len(values))]
+                          + [_format_duration(quantile(values, q)) for q in (0.5, 0.9, 0.99, 1)])
+    click.echo(get_table_instance(table_data).table)
+
+    statuses = sorted({s for c in stats.throughput.values() for s in c})
+    table_data = [["Interval start"] + statuses + ["Tasks/h"]]
+    for bucket in sorted(stats.throughput):
+        counts = stats.throughput[bucket]
+        table_data.append([time.strftime('%Y-%m-%d %H:%M', time.localtime(bucket))]
+                          + [counts[s] for s in statuses]
+                          + ["{:.1f}".format(sum(counts.values()) * 3600. / interval)])
+    click.echo(get_table_instance(table_data).table)
+
+    table_data = [["Runner", "Succeeded", "Failed", "Timed out", "Failure rate"]]
+    for runner in sorted(stats.outcomes):
+        counts = stats.outcomes[runner]
+        total = sum(counts.values())
+        table_data.append([runner, counts['succeeded'], counts['failed'], counts['timed out'],
+                           "{:.1%}".format((total - counts['succeeded']) / total)])
+    click.echo(get_table_instance(table_data).table)
+
+    if top_errors:
+        table_data = [["Runner", "Count", "Error"]]
+        for runner in sorted(stats.errors):
+            for msg, count in stats.errors[runner].most_common(top_errors):
+                table_data.append([runner, count, msg])
+        if len(table_data) > 1:
+            click.echo(get_table_instance(table_data).table)
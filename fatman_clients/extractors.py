@@ -0,0 +1,206 @@
+"""Extraction of results from the output files of finished tasks, done on the worker
+
+An extractor is a function taking an iterator over the lines of an output file and
+returning a dict with the results found (empty if the file does not contain any).
+Additional extractors can be registered by other packages via the
+'fatman_clients.extractors' entry point group, with the entry point name as extractor name.
+"""
+
+import re
+import os
+import logging
+from fnmatch import fnmatch
+
+try:
+    from importlib.metadata import entry_points
+except ImportError:  # Python < 3.8
+    entry_points = None
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+# name -> (function, list of file name patterns to run it on)
+EXTRACTORS = {}
+
+ENTRY_POINT_GROUP = 'fatman_clients.extractors'
+
+
+def extractor(name, patterns=('*.out',)):
+    """Decorator registering an extractor for files matching one of the given patterns"""
+
+    def register(func):
+        EXTRACTORS[name] = (func, list(patterns))
+        return func
+
+    return register
+
+
+def load_plugins():
+    """Register the extractors provided by other installed packages"""
+
+    if entry_points is None:
+        return
+
+    try:
+        plugins = entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:  # Python < 3.10
+        plugins = entry_points().get(ENTRY_POINT_GROUP, [])
+
+    for plugin in plugins:
+        try:
+            func = plugin.load()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("loading the result extractor '%s' failed", plugin.name)
+            continue
+
+        EXTRACTORS[plugin.name] = (func, list(getattr(func, 'patterns', ['*.out'])))
+
+
+CP2K_ENERGY_RE = re.compile(r'^\s*ENERGY\|\s+Total FORCE_EVAL \( \w+ \) energy[^:]*:\s+(?P<energy>\S+)')
+CP2K_VOLUME_RE = re.compile(r'^\s*CELL\|\s+Volume\s+\[angstrom\^3\]:\s+(?P<volume>\S+)')
+CP2K_NATOMS_RE = re.compile(r'^\s*- Atoms:\s+(?P<natoms>\d+)')
+
+
+@extractor('cp2k')
+def cp2k_energy_volume(lines):
+    """The final total energy (in Hartree), the cell volume (in Angstrom^3)
+    and the number of atoms from a CP2K output"""
+
+    results = {}
+
+    for line in lines:
+        # cheap pre-selection, the expressions only need to run on few lines
+        if 'ENERGY|' in line:
+            match = CP2K_ENERGY_RE.match(line)
+            if match:
+                results['energy'] = float(match.group('energy'))
+
+        elif 'CELL|' in line:
+            match = CP2K_VOLUME_RE.match(line)
+            if match:
+                results['volume'] = float(match.group('volume'))
+
+        elif '- Atoms:' in line and 'natoms' not in results:
+            match = CP2K_NATOMS_RE.match(line)
+            if match:
+                results['natoms'] = int(match.group('natoms'))
+
+    # the number of atoms alone is not a result
+    if 'energy' not in results and 'volume' not in results:
+        return {}
+
+    return results
+
+
+GW_LEVEL_RE = re.compile(r'^\s*(?:MO\s+)?(?P<level>\d+)\s*\(\s*(?P<occ>occ|vir)\s*\)\s+(?P<values>[-+\d.\sE]+)$')
+GW_GAP_RE = re.compile(r'^\s*GW HOMO-LUMO gap \(eV\)\s+(?P<gap>\S+)')
+
+
+@extractor('gw')
+def gw_quasiparticle_energies(lines):
+    """The quasi-particle energies (in eV) of the last GW iteration from a CP2K output:
+    the SCF and GW energy of each level, HOMO and LUMO and the HOMO-LUMO gap"""
+
+    levels = {}
+    gap = None
+    in_block = False
+
+    for line in lines:
+        if 'GW quasiparticle energies' in line or 'E_GW' in line:
+            # a new block (e.g. the next iteration of evGW) replaces the previous one
+            if not in_block:
+                levels = {}
+            in_block = True
+            continue
+
+        if 'GW HOMO-LUMO gap' in line:
+            match = GW_GAP_RE.match(line)
+            if match:
+                gap = float(match.group('gap'))
+            in_block = False
+            continue
+
+        if not in_block or '(' not in line:
+            continue
+
+        match = GW_LEVEL_RE.match(line)
+        if match:
+            values = [float(v) for v in match.group('values').split()]
+            levels[int(match.group('level'))] = {
+                'occupied': match.group('occ') == 'occ',
+                'E_SCF': values[0],
+                'E_GW': values[-1],
+                }
+
+    if not levels:
+        return {}
+
+    results = {'levels': {str(n): levels[n] for n in sorted(levels)}}
+
+    occupied = [n for n in levels if levels[n]['occupied']]
+    virtual = [n for n in levels if not levels[n]['occupied']]
+    if occupied:
+        results['homo'] = levels[max(occupied)]['E_GW']
+    if virtual:
+        results['lumo'] = levels[min(virtual)]['E_GW']
+
+    if gap is not None:
+        results['homo_lumo_gap'] = gap
+    elif occupied and virtual:
+        results['homo_lumo_gap'] = results['lumo'] - results['homo']
+
+    return results
+
+
+def extract_results(task_dir, filepaths, names=None):
+    """Run the extractors on the matching files.
+
+    If several files yield results for an extractor, the most recently modified one wins.
+
+    :param task_dir: the task directory, used to report the file names relative to it
+    :param filepaths: the files to consider
+    :param names: the extractors to run (default: all)
+    :returns: a tuple `(results, warnings)`, results being a dict extractor name -> results
+              (including the 'source' file name), warnings a list of warning entries
+    """
+
+    results = {}
+    warnings = []
+
+    candidates = []
+    for filepath in filepaths:
+        try:
+            candidates.append((os.stat(filepath).st_mtime, filepath))
+        except OSError:
+            continue
+
+    candidates.sort(reverse=True)
+
+    for name in (names if names is not None else sorted(EXTRACTORS)):
+        func, patterns = EXTRACTORS[name]
+
+        for _, filepath in candidates:
+            relname = os.path.relpath(filepath, task_dir)
+            if not any(fnmatch(os.path.basename(relname), p) for p in patterns):
+                continue
+
+            try:
+                with open(filepath, 'r', errors='replace') as fhandle:
+                    result = func(fhandle)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.exception("result extractor '%s' failed on '%s'", name, relname)
+                warnings.append({
+                    'tag': 'results',
+                    'entry': relname,
+                    'msg': "result extractor '{}' failed: {}".format(name, exc),
+                    })
+                continue
+
+            if result:
+                result['source'] = relname
+                results[name] = result
+                break
+
+    return results, warnings
+
+
+load_plugins()
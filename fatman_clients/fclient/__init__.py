@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
+import sys
+import time
 from uuid import UUID
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 from requests.packages import urllib3
@@ -34,6 +37,49 @@ def bool2str(value):
     return u'\N{check mark}' if value else u'\N{heavy multiplication x}'
 
 
+def fetch_details(ctx, urls, max_time=None):
+    """Fetch the objects at the given URLs concurrently and return them in the same order.
+
+    With max_time, the total time is estimated from the first responses, and a
+    UsageError raised if it would take longer than that many seconds."""
+
+    session = ctx.obj['session']
+    max_workers = ctx.obj['max_parallel_requests']
+
+    def fetch(url):
+        req = session.get(url)
+        req.raise_for_status()
+        return req.json()
+
+    results = [None]*len(urls)
+    start = time.time()
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {}
+    try:
+        futures.update((executor.submit(fetch, url), idx) for idx, url in enumerate(urls))
+
+        with click.progressbar(length=len(urls), file=sys.stderr) as bar:
+            for done, future in enumerate(as_completed(futures), 1):
+                results[futures[future]] = future.result()
+                bar.update(1)
+
+                if max_time is not None and done == 2*max_workers:
+                    estimate = (time.time() - start) / done * len(urls)
+                    if estimate > max_time:
+                        raise click.UsageError(
+                            "Fetching the details of {} entries would take about {:.0f}s ({:.1f}/s), "
+                            "narrow down the selection or raise the time limit".format(
+                                len(urls), estimate, done / (time.time() - start)))
+    finally:
+        # if one failed, drop the requests not started yet and only wait for the running ones
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+    return results
+
+
 @click.group()
 @click.option('--url', type=str,
               default='https://tctdb.chem.uzh.ch/fatman', show_default=True,
@@ -41,14 +87,22 @@ def bool2str(value):
 @click.option('--ssl-verify/--no-ssl-verify', required=False,
               default=True, show_default=True,
               help="verify the servers SSL certificate")
+@click.option('--max-parallel-requests', type=click.IntRange(min=1), default=16, show_default=True,
+              help="Maximum number of concurrent requests when fetching details of many entries")
 @click.pass_context
-def cli(ctx, url, ssl_verify):
+def cli(ctx, url, ssl_verify, max_parallel_requests):
     if ctx.obj is None:
         ctx.obj = {}
 
     ctx.obj['url'] = url
+    ctx.obj['max_parallel_requests'] = max_parallel_requests
 
     ctx.obj['session'] = requests.Session()
+
+    # keep a connection per concurrent request
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_parallel_requests)
+    ctx.obj['session'].mount('http://', adapter)
+    ctx.obj['session'].mount('https://', adapter)
     if ssl_verify:
         ctx.obj['session'].verify = try_verify_by_system_ca_bundle()
     else:
@@ -81,6 +135,8 @@ def command(ctx, code, machine):
         click.echo("  - {name}:".format(**cmd))
         click.echo("      cmd: {cmd}".format(**cmd))
         click.echo("      args: {args}".format(**cmd))
+        if 'after' in cmd:
+            click.echo("      after: {}".format(', '.join(cmd['after']) or "-"))
 
     click.echo("Environment:")
 
@@ -12,11 +12,9 @@ from requests.utils import parse_header_links
 import six
 import dpath
 
-from . import cli, json_pretty_dumps, get_table_instance
+from . import cli, json_pretty_dumps, get_table_instance, fetch_details
 
 
-# the maximal number of calculations to fetch details for
-MAX_CALC_DETAILS = 600
 # the maximal number of calculations the server gives us per-page
 MAX_CALC_PER_PAGE = 200
 
@@ -246,11 +244,14 @@ def calc_delete(ctx, calc_id):
 @click.option('--with-details/--without-details',
               default=False, show_default=True,
               help="fetch details for selected calculations")
+@click.option('--max-details-time', type=click.FloatRange(min=0), default=60, show_default=True,
+              help="refuse to fetch the details if this is estimated to take longer (in seconds)")
 @click.option('--sorted-by', type=str, help="sort by the specified column (a posteriori)")
 @click.option('--fetch-all/--no-fetch-all', default=False, show_default=True,
               help="fetch all entries instead of the first N returned by the server")
 @click.pass_context
-def calc_list(ctx, show_ids, columns, csv_output, with_details, sorted_by, fetch_all, **filters):
+def calc_list(ctx, show_ids, columns, csv_output, with_details, max_details_time, sorted_by, fetch_all,
+              **filters):
     """
     List calculations. Use the parameters to limit the list to certain subsets of calculations
     """
@@ -281,16 +282,11 @@ def calc_list(ctx, show_ids, columns, csv_output, with_details, sorted_by, fetch
             click.echo("WARNING: Result list truncated to {} elements of total {}".format(MAX_CALC_PER_PAGE, total_count), err=True)
 
     if with_details:
-        if len(calcs) > MAX_CALC_DETAILS:
-            raise click.UsageError("The number of returned calculations is too high to fetch details")
-
         click.echo('Please wait, fetching details..', err=True)
 
-        with click.progressbar(calcs, file=sys.stderr) as bar:
-            for cal in bar:
-                req = ctx.obj['session'].get(cal['_links']['self'])
-                req.raise_for_status()
-                cal.update(req.json())
+        details = fetch_details(ctx, [cal['_links']['self'] for cal in calcs], max_details_time)
+        for cal, detail in zip(calcs, details):
+            cal.update(detail)
 
     header = []
     table_data = []
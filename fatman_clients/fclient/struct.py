@@ -14,6 +14,7 @@ import requests
 
 from . import cli, json_pretty_dumps, get_table_instance
 from .. import xyz_parser_iterator
+from ..transfer import download
 
 
 @cli.group()
@@ -317,17 +318,14 @@ def structureset_download(ctx, structureset_name):
 
     os.mkdir(target_dir)
 
+    def target_fn(req):
+        """The file name is only known from the response"""
+        _, params = cgi.parse_header(req.headers['content-disposition'])
+        return path.join(target_dir, params['filename'])
+
     for structure in structures:
         click.echo("downloading {}..".format(structure['name']), nl=False)
 
-        req = ctx.obj['session'].get(structure['_links']['download'], stream=True)
-        req.raise_for_status()
-
-        content_disp = req.headers['content-disposition']
-        _, params = cgi.parse_header(content_disp)
-
-        with open(path.join(target_dir, params['filename']), 'wb') as fhandle:
-            for chunk in req.iter_content(4096):
-                fhandle.write(chunk)
+        stats = download(ctx.obj['session'], structure['_links']['download'], target_fn)
 
-        click.echo(" done")
+        click.echo(" done ({})".format(stats))
@@ -7,6 +7,8 @@ from uuid import UUID
 import click
 
 from . import cli
+from ..multipart import MultipartEncoder
+from ..transfer import download
 
 @cli.group()
 @click.pass_context
@@ -56,14 +58,9 @@ def task_download_files(ctx, task_id):
             target_fn = path.join(target_dir, direction, artifact['name'])
             click.echo("downloading {} to {}..".format(artifact['name'], target_fn), nl=False)
 
-            req = ctx.obj['session'].get(artifact['_links']['download'], stream=True)
-            req.raise_for_status()
-
-            with open(target_fn, 'wb') as fhandle:
-                for chunk in req.iter_content(1024):
-                    fhandle.write(chunk)
+            stats = download(ctx.obj['session'], artifact['_links']['download'], target_fn)
 
-            click.echo(" done")
+            click.echo(" done ({})".format(stats))
 
 
 @task.command('upload-artifact')
@@ -78,8 +75,9 @@ def task_upload_artifact(ctx, task_id, filename, name):
     req.raise_for_status()
     task_content = req.json()
 
-    req = ctx.obj['session'].post(task_content['_links']['uploads'],
-                                  data={'name': name}, files={'data': filename})
+    with filename, MultipartEncoder(data={'name': name}, files={'data': filename}) as encoder:
+        req = ctx.obj['session'].post(task_content['_links']['uploads'],
+                                      data=encoder, headers={'Content-Type': encoder.content_type})
     req.raise_for_status()
 
 
@@ -8,7 +8,7 @@ from collections import OrderedDict
 
 import click
 
-from . import cli, get_table_instance, bool2str
+from . import cli, get_table_instance, bool2str, fetch_details
 
 @cli.group()
 @click.pass_context
@@ -194,7 +194,9 @@ def trcollections_show(ctx, extended_info, id):
         table_data[0].append("calc collections")
         table_data[0].append("calc ids")
 
-    for tr in trcoll['testresults']:
+        fulltrs = fetch_details(ctx, [tr['_links']['self'] for tr in trcoll['testresults']])
+
+    for idx, tr in enumerate(trcoll['testresults']):
         entry = [tr['id'], tr['test']]
 
         tdata = tr['data']
@@ -209,11 +211,7 @@ def trcollections_show(ctx, extended_info, id):
             entry.append("")
 
         if extended_info:
-            req = ctx.obj['session'].get(tr['_links']['self'])
-            req.raise_for_status()
-            fulltr = req.json()
-
-            calcs = fulltr['calculations']
+            fulltr = fulltrs[idx]
 
             entry.append("\n".join(set(calc['collection'] for calc in fulltr['calculations'])))
             entry.append("\n".join(calc['id'] for calc in fulltr['calculations']))
@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 
 import socket
+import signal
 import logging
-import shutil
+import hashlib
 import getpass
+import threading
+import time
+import copy
 import os
 from os import path
-from time import sleep
-from glob import glob
 
 import click
 import click_log
@@ -15,16 +17,43 @@ import requests
 from requests.packages import urllib3
 
 from . import try_verify_by_system_ca_bundle
-from .runners import ClientError, DirectRunner, SlurmRunner, MPIRunner
+from .runners import ClientError, DirectRunner, SlurmRunner, MPIRunner, kill_running_commands
+from .artifacts import Artifact, collect_artifacts
+from .extractors import EXTRACTORS, extract_results
+from .resultstore import ResultStore
+from .wakeup import Wakeup
+from .affinity import CpuAllocator
+from .cgroups import CgroupManager
+from .transfer import (TransferPolicy, UploadSessions, FSYNC_POLICIES,
+                       upload, resumable_upload, download)
+from .taskcache import TaskCache
+from .spool import Spool, is_transient
+from .statusqueue import StatusQueue
+from .leases import TaskLeases, Registry
+from .volumes import DataVolumes
+from .history import RuntimeHistory, runner_runtime
+from .events import EventLog, parse_timestamp
+from .cli import validate_size, validate_duration
+from .staging import (prepare_task_dir, parse_checksum,
+                      load_manifest, save_manifest, manifest_entry)
 
 TASKS_URL = '{}/api/v2/tasks'
 
+# added to the predicted time limit of Slurm jobs, for the startup and staging on the nodes
+SLURM_TIME_MARGIN = 10*60
+
 logger = logging.getLogger(__name__)  # pylint: disable=invalid-name
 
 
-def task_iterator(sess, url, hostname,
-                  ignore_pending=False, ignore_running=False, acquire=True):
-    """Fetches new tasks and yields them"""
+def task_iterator(cache, url, hostname,
+                  ignore_pending=False, ignore_running=False, acquire=True, acquire_window=1,
+                  predict=None):
+    """Fetches tasks to continue and candidates for acquisition and yields them.
+
+    The candidates are ordered by descending priority and then by age (oldest first),
+    the caller is expected to skip candidates it is unable to run. With a function
+    predicting the runtime of a task, the pending tasks and the candidates of the same
+    priority are ordered shortest first instead."""
 
     states = []
     if not ignore_pending:
@@ -32,25 +61,242 @@ def task_iterator(sess, url, hostname,
     if not ignore_running:
         states.append('running')
 
+    tasks = []
     if states:
         logger.info("checking for %s tasks to continue", ' or '.join(states))
 
-        req = sess.get(TASKS_URL.format(url),
-                       params={'machine': hostname, 'status': 'pending,running'})
-        req.raise_for_status()
-        tasks = req.json()
-
-        if tasks:
-            for task in tasks:
-                yield task
+        tasks = cache.fetch(TASKS_URL.format(url),
+                            params={'machine': hostname, 'status': 'pending,running'})
 
+    candidates = []
     if acquire:
-        logger.info("fetching new task")
-        req = sess.get(TASKS_URL.format(url), params={'limit': 1, 'status': 'new'})
+        logger.info("fetching new tasks")
+        candidates = list(cache.fetch(TASKS_URL.format(url), params={'limit': acquire_window, 'status': 'new'}))
+
+    if states:
+        # forget about tasks which are no longer ours (or candidates)
+        cache.prune([t['id'] for t in tasks + candidates])
+
+    def predicted(task):
+        # the listing entries lack the infiles and possibly the settings the prediction is based on
+        try:
+            return predict(cache.task(task))
+        except requests.exceptions.RequestException as exc:
+            # for example deleted since the listing, handling the task shows what is up with it
+            logger.debug("task %s: unable to fetch it for the runtime prediction: %s", task['id'], exc)
+            return 0
+
+    if predict is not None:
+        tasks = sorted(tasks, key=lambda t: predicted(t) if t['status'] == 'pending' else 0)
+
+    for task in tasks:
+        yield task
+
+    candidates.sort(key=lambda t: (-(t.get('priority') or 0),
+                                   predicted(t) if predict else 0,
+                                   t.get('ctime') or ''))
+
+    for task in candidates:
+        yield task
+
+
+def release_task(task, spool, execute, events=None):
+    """Hand back an acquired task to the server for someone else to run it (spooled while the
+    server is unreachable), raises if the server refuses to take it back"""
+
+    ops = [{'op': 'patch', 'url': task['_links']['self'], 'json': {'status': 'new', 'machine': None}}]
+
+    if spool.submit(task['id'], ops, execute) is not None:
+        logger.info("task %s: released", task['id'])
+
+    if events is not None:
+        events.emit('released', task['id'])
+
+
+def task_runner_name(task):
+    """Returns the name of the runner for a task, None if the task does not (yet) specify one"""
+
+    try:
+        return task['settings']['machine']['runner']
+    except (KeyError, TypeError):
+        return None
+
+
+def task_runner_class(task):
+    """Returns the runner class for a task, None if the task does not (yet) specify a runner,
+    and raises a NotImplementedError if the runner is unknown"""
+
+    runner_name = task_runner_name(task)
+    if runner_name is None:
+        return None
+
+    try:
+        return RUNNERS[runner_name]
+    except KeyError:
+        raise NotImplementedError(
+            "runner '{}' is not (yet) implemented".format(runner_name))
+
+
+def upload_results(sess, task, task_dir, runner, collect_opts, transfer_policy,
+                   extractors=None, result_store=None, spool=None, status_queue=None, events=None):
+    """Upload the output artifacts of a finished task and set its final status,
+    together with the results parsed by the given extractors (if any).
+
+    The outputs of successful tasks are kept in the result store (if any) for re-use.
+    If the server is unreachable, the uploads and the status update are spooled (if possible).
+    With a status queue, the final status is sent together with other status updates."""
+
+    start = time.time()
+
+    if runner.timed_out:
+        logger.warning("task %s: timed out, collecting partial output", task['id'])
+    else:
+        logger.info("task %s: finished, collecting output", task['id'])
+
+    # the data as reported by the runner, without the additions below
+    run_data = copy.deepcopy(runner.data)
+
+    # collect files to upload as declared by the server, and
+    # also the additional existing non-empty output files from all commands
+    artifacts, warnings = collect_artifacts(
+        task_dir, task['settings']['output_artifacts'], runner.outfiles, **collect_opts)
+
+    for warning in warnings:
+        logger.warning("task %s: output artifact '%s': %s", task['id'], warning['entry'], warning['msg'])
+    runner.data['warnings'] += warnings
+
+    if extractors and runner.success:
+        results, warnings = extract_results(task_dir, [a.path for a in artifacts], extractors)
+
+        for warning in warnings:
+            logger.warning("task %s: output artifact '%s': %s", task['id'], warning['entry'], warning['msg'])
+        runner.data['warnings'] += warnings
+
+        if results:
+            logger.info("task %s: extracted results: %s", task['id'], ", ".join(sorted(results)))
+            runner.data['results'] = results
+
+    if result_store is not None and runner.success and 'memoized' not in runner.data:
+        result_store.save(task, task_dir, runner, run_data)
+
+    # upload the small, result-critical files first and the bulk artifacts last
+    artifacts.sort(key=lambda a: transfer_policy.is_bulk(a.upload_size))
+
+    # the operations are plain dicts to be able to spool them while the server is unreachable
+    ops = [{
+        'op': 'upload',
+        'task': task['id'],
+        'url': task['_links']['uploads'],
+        # servers supporting resumable uploads announce it with the link to create upload sessions
+        'sessions_url': task['_links'].get('upload_sessions'),
+        'task_dir': task_dir,
+        'path': artifact.path,
+        'name': artifact.name,
+        'size': artifact.size,
+        'keep': artifact.keep,
+        } for artifact in artifacts]
+
+    status = {'status': 'done' if runner.success else 'error', 'data': runner.data}
+
+    if status_queue is None:
+        ops.append({'op': 'patch', 'url': task['_links']['self'], 'json': status})
+
+    def execute(oper):
+        return execute_operation(sess, oper, transfer_policy, events)
+
+    if spool is not None:
+        if ops:
+            spool.submit(task['id'], ops, execute)
+    else:
+        for oper in ops:
+            execute(oper)
+
+    if status_queue is not None:
+        status_queue.put(task['id'], task['_links']['self'], status)
+
+    if events is not None:
+        events.emit('uploaded', task['id'], status=status['status'], artifacts=len(artifacts),
+                    bytes=sum(a.upload_size for a in artifacts), duration=time.time() - start,
+                    spooled=spool is not None and spool.has(task['id']))
+
+
+def execute_operation(sess, oper, transfer_policy, events=None):
+    """Execute a single upload or status update operation as created by upload_results,
+    returns the response"""
+
+    if oper['op'] == 'upload':
+        artifact = Artifact(oper['path'], oper['name'], oper['size'], oper['keep'])
+        upload_sessions = UploadSessions(oper['task_dir'])
+
+        logger.info("uploading '%s' from '%s'", artifact.name, oper['task_dir'])
+        buckets, priority = transfer_policy.upload_buckets(artifact.upload_size)
+
+        start = time.time()
+
+        with artifact.open() as data_fh:
+            if oper['sessions_url'] and transfer_policy.is_chunked(artifact.upload_size):
+                req = resumable_upload(
+                    sess, oper['sessions_url'], artifact.name, data_fh, artifact.upload_size,
+                    transfer_policy.chunk_size, buckets, priority,
+                    session_url=upload_sessions.get(artifact.name, artifact.upload_size),
+                    on_session=lambda url: upload_sessions.set(artifact.name, artifact.upload_size, url))
+            else:
+                req = upload(sess, oper['url'], {'name': artifact.name}, 'data', data_fh, buckets, priority)
+                req.raise_for_status()
+
+        if events is not None:
+            events.emit('upload', oper.get('task'), name=artifact.name, bytes=artifact.upload_size,
+                        duration=time.time() - start)
+
+        return req
+
+    if oper['op'] == 'patch':
+        req = sess.patch(oper['url'], json=oper['json'])
         req.raise_for_status()
-        tasks = req.json()
-        if tasks:
-            yield tasks[0]
+        return req
+
+    raise ValueError("unknown operation '{}'".format(oper['op']))
+
+
+class LocalTask(object):
+    """Runs a blocking runner in a background thread and wakes up the main loop when done"""
+
+    def __init__(self, task, task_dir, runner, wakeup, cpus=0):
+        self.task = task
+        self.task_dir = task_dir
+        self.runner = runner
+        self.cpus = cpus
+        self.client_error = False
+
+        self._done = threading.Event()
+        self._wakeup = wakeup
+        self._thread = threading.Thread(target=self._run, name="task-{}".format(task['id']))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            # the task was already set to running by the main thread
+            self.runner.run(lambda: None)
+
+        except ClientError:
+            logger.exception("client error occurred, leave the task as is")
+            self.client_error = True
+
+        except Exception:
+            logger.exception("task %s: error occurred during run", self.task['id'])
+
+        finally:
+            self._done.set()
+            self._wakeup.notify()
+
+    def is_alive(self):
+        """Whether the runner is still running"""
+        return not self._done.is_set()
+
+    def join(self):
+        """Wait for the runner to terminate"""
+        self._done.wait()
 
 
 # Register runners here:
@@ -68,10 +314,45 @@ RUNNERS = {
               help="Override hostname-detection")
 @click.option('--nap-time', type=int, default=5*60,
               show_default=True,
-              help="Time to sleep if no new tasks are available")
-@click.option('--data-dir', type=click.Path(exists=True, resolve_path=True),
-              default='./fdaemon-data', show_default=True,
-              help="Data directory")
+              help="Time to sleep if no new tasks are available (cut short when a task terminates)")
+@click.option('--max-local-tasks', type=click.IntRange(min=1), default=1,
+              show_default=True,
+              help="Maximum number of tasks run concurrently by the direct and mpirun runners")
+@click.option('--max-cpus', type=click.IntRange(min=1), default=lambda: os.cpu_count() or 1,
+              help="Maximum number of CPUs used by concurrently running local tasks, "
+                   "including the ones of other fdaemons sharing the data directory (default: all)")
+@click.option('--walltime', type=str, callback=validate_duration,
+              help="Default walltime for tasks run locally (e.g. '3600', '90m', '12h' or '1-00:00:00'), "
+                   "unless specified in the task settings, default: unlimited")
+@click.option('--stall-timeout', type=str, callback=validate_duration,
+              help="Kill locally run tasks whose output files did not grow for this long, "
+                   "unless specified in the task settings, default: disabled")
+@click.option('--pin-cpus/--no-pin-cpus',
+              default=False, show_default=True,
+              help="Pin each local task to its own set of CPUs, preferably on a single NUMA node")
+@click.option('--cgroups/--no-cgroups',
+              default=False, show_default=True,
+              help="Run each local task in its own cgroup (v2) limited to its memory and CPUs, "
+                   "and report its resource usage (as far as delegated to fdaemon)")
+@click.option('--memory-limit', type=str, callback=validate_size,
+              help="Default memory limit for tasks run locally in cgroups (e.g. '8G'), "
+                   "unless specified in the task settings, default: unlimited")
+@click.option('--runner', 'runners', type=click.Choice(sorted(RUNNERS.keys())), multiple=True,
+              help="Only acquire tasks for the given runner(s) (default: all implemented)")
+@click.option('--max-pending-jobs', type=click.IntRange(min=0),
+              help="Stop acquiring Slurm tasks while this many of our jobs are pending in the queue")
+@click.option('--max-queued-jobs', type=click.IntRange(min=0),
+              help="Stop acquiring Slurm tasks while this many of our jobs are pending or running")
+@click.option('--acquire-window', type=click.IntRange(min=1), default=20,
+              show_default=True,
+              help="Number of new tasks to consider (ordered by priority and age) when acquiring")
+@click.option('--acquire-limit', type=click.IntRange(min=1), default=1,
+              show_default=True,
+              help="Maximum number of new tasks to acquire per cycle")
+@click.option('--data-dir', 'data_dirs', type=click.Path(exists=True, resolve_path=True), multiple=True,
+              default=['./fdaemon-data'], show_default=True,
+              help="Data directory, can be given multiple times to spread the task directories across "
+                   "several volumes (the first one also holds the state of fdaemon itself)")
 @click.option('--run/--no-run',
               default=True, show_default=True,
               help="Run new jobs, otherwise only prepare and download them (running jobs are still checked)")
@@ -90,15 +371,92 @@ RUNNERS = {
 @click.option('--ssl-verify/--no-ssl-verify',
               default=True, show_default=True,
               help="verify the servers SSL certificate")
+@click.option('--max-artifact-size', type=str, callback=validate_size,
+              help="Do not upload output files larger than this (e.g. '500M'), default: unlimited")
+@click.option('--max-upload-size', type=str, callback=validate_size,
+              help="Limit the total size of the files uploaded per task (e.g. '2G'), default: unlimited")
+@click.option('--log-keep-size', type=str, callback=validate_size,
+              default='1M', show_default=True,
+              help="Upload head and tail of this size of too large log files instead of skipping them")
+@click.option('--truncate-logs/--no-truncate-logs',
+              default=True, show_default=True,
+              help="Truncate too large log files (*.out, *.err, *.log) instead of skipping them")
+@click.option('--upload-limit', type=str, callback=validate_size,
+              help="Limit the total upload bandwidth in bytes per second (e.g. '10M'), default: unlimited")
+@click.option('--download-limit', type=str, callback=validate_size,
+              help="Limit the total download bandwidth in bytes per second (e.g. '10M'), default: unlimited")
+@click.option('--bulk-limit', type=str, callback=validate_size,
+              help="Limit the bandwidth of each bulk transfer in bytes per second, default: unlimited")
+@click.option('--bulk-threshold', type=str, callback=validate_size,
+              default='8M', show_default=True,
+              help="Transfers of files larger than this are bulk transfers, "
+                   "which are done after and yield to the smaller ones")
+@click.option('--extract-results/--no-extract-results', 'extract',
+              default=False, show_default=True,
+              help="Parse the results from the output of successful tasks and send them along")
+@click.option('--extractor', 'extractors', type=click.Choice(sorted(EXTRACTORS.keys())), multiple=True,
+              help="Only run the specified result extractors (can be given multiple times), default: all")
+@click.option('--result-store', type=click.Path(file_okay=False, resolve_path=True),
+              help="Keep the outputs of successful tasks in this directory and re-use them "
+                   "for tasks with identical inputs and settings (unless 'memoize' is false "
+                   "in the task settings), default: disabled")
+@click.option('--result-store-size', type=str, callback=validate_size,
+              default='10G', show_default=True,
+              help="Maximum total size of the result store, least recently used outputs are removed first")
+@click.option('--download-buffer-size', type=str, callback=validate_size,
+              default='4M', show_default=True,
+              help="Size of the buffer downloads are read into")
+@click.option('--fsync', type=click.Choice(FSYNC_POLICIES), default='none', show_default=True,
+              help="Flush downloaded input files to disk before renaming them into place ('file'), "
+                   "and also the directory after renaming ('full')")
+@click.option('--chunked-upload-threshold', type=str, callback=validate_size,
+              default='64M', show_default=True,
+              help="Upload artifacts larger than this in resumable chunks (if supported by the server)")
+@click.option('--upload-chunk-size', type=str, callback=validate_size,
+              default='16M', show_default=True,
+              help="Size of the chunks of resumable uploads")
+@click.option('--status-batch-window', type=click.FloatRange(min=0), default=5, show_default=True,
+              help="Time in seconds status updates may be held back to send them together "
+                   "(at the latest at the end of each cycle), 0 to send them right away")
+@click.option('--history-file', type=click.Path(dir_okay=False, resolve_path=True),
+              help="Keep the runtimes of successful tasks in this file to predict the runtime of new ones, "
+                   "default: '.fdaemon-history.jsonl' in the data directory")
+@click.option('--shortest-first/--no-shortest-first',
+              default=False, show_default=True,
+              help="Start the tasks with the shortest predicted runtime first (within the same priority)")
+@click.option('--predict-slurm-time/--no-predict-slurm-time',
+              default=False, show_default=True,
+              help="Request the predicted runtime (see --slurm-time-factor) as time limit for Slurm jobs "
+                   "to get them backfilled, if shorter than the one in the batch script")
+@click.option('--slurm-time-factor', type=click.FloatRange(min=1), default=2, show_default=True,
+              help="Safety factor applied to the 95th percentile of the runtimes of similar tasks "
+                   "for the predicted Slurm time limit (plus 10 minutes)")
+@click.option('--event-log', type=click.Path(dir_okay=False, resolve_path=True),
+              help="Append the task lifecycle events to this JSON Lines file (see fdaemon-events "
+                   "to analyze it), default: '.fdaemon-events.jsonl' in the data directory")
+@click.option('--spool-dir', type=click.Path(file_okay=False, resolve_path=True),
+              help="Keep status updates and uploads in this directory while the server is unreachable "
+                   "and send them once it is back, default: '.fdaemon-spool' in the data directory")
 @click_log.simple_verbosity_option()
 @click_log.init(__name__)
-def main(url, hostname, nap_time, data_dir,
+def main(url, hostname, nap_time, max_local_tasks, max_cpus, walltime, stall_timeout, pin_cpus,
+         cgroups, memory_limit, runners,
+         max_pending_jobs, max_queued_jobs, acquire_window, acquire_limit, data_dirs,
          run, ignore_pending, ignore_running, acquire, one_shot,
-         ssl_verify):
+         ssl_verify, max_artifact_size, max_upload_size, log_keep_size, truncate_logs,
+         upload_limit, download_limit, bulk_limit, bulk_threshold,
+         extract, extractors, result_store, result_store_size,
+         download_buffer_size, fsync, chunked_upload_threshold, upload_chunk_size,
+         status_batch_window, history_file, shortest_first, predict_slurm_time, slurm_time_factor,
+         event_log, spool_dir):
     """FATMAN Calculation Runner Daemon"""
 
     logging.basicConfig(format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s')
 
+    # new task dirs are placed on the least busy volume, existing ones are found on any
+    volumes = DataVolumes(data_dirs)
+    data_dir = volumes.primary
+
     os.chdir(data_dir)
 
     sess = requests.Session()
@@ -114,17 +472,284 @@ def main(url, hostname, nap_time, data_dir,
         'x-fatman-worker-username': getpass.getuser(),  # easily fakeable, but only used for filtering, not auth
         })
 
+    allowed_runners = {RUNNERS[r] for r in (runners or RUNNERS.keys())}
+
+    allocator = CpuAllocator() if pin_cpus else None
+
+    cgroups = CgroupManager() if cgroups else None
+
+    transfer_policy = TransferPolicy(upload_limit, download_limit, bulk_limit, bulk_threshold,
+                                     chunked_upload_threshold, upload_chunk_size)
+
+    wakeup = Wakeup()
+
+    task_cache = TaskCache(sess)
+
+    # local tasks running in the background: task id -> LocalTask
+    local_tasks = {}
+
+    # the result extractors to run on the output of successful tasks
+    extractors = (sorted(extractors) or sorted(EXTRACTORS.keys())) if extract else None
+
+    if result_store is not None:
+        result_store = ResultStore(result_store, result_store_size)
+
+    # status updates and uploads waiting for the server to be reachable again
+    spool = Spool(spool_dir or path.join(data_dir, '.fdaemon-spool'))
+
+    def execute(oper):
+        return execute_operation(sess, oper, transfer_policy, events)
+
+    def status_updated(task):
+        """Keep the task objects returned for status updates of tasks which are still ours"""
+        if task['status'] in ('pending', 'running'):
+            task_cache.update(task)
+
+    # status updates are sent in bulk (if supported by the server)
+    status_queue = StatusQueue(TASKS_URL.format(url), spool, execute, status_batch_window, status_updated)
+
+    # state transitions, transfers and commands of the tasks, for offline analysis
+    events = EventLog(event_log or path.join(data_dir, '.fdaemon-events.jsonl'))
+
+    # the runtimes of past tasks, to predict the ones of new tasks
+    history = RuntimeHistory(history_file or path.join(data_dir, '.fdaemon-history.jsonl'))
+
+    def predicted_runtime(task):
+        """The median runtime of similar tasks, 0 if unknown (to try them early and learn about them)"""
+        return history.predict(task) or 0
+
+    def task_finished(task, runner):
+        """Record a terminated task in the event log, and its runtime in the history if successful"""
+
+        runtime = runner_runtime(runner)
+
+        events.emit('finished', task['id'], runner=task_runner_name(task), success=runner.success,
+                    timed_out=runner.timed_out, walltime=runtime,
+                    error=runner.data['errors'][0].get('msg') if runner.data['errors'] else None)
+
+        if runner.success and runtime is not None and 'memoized' not in runner.data:
+            try:
+                history.record(task, runtime)
+            except (OSError, IOError) as exc:
+                logger.warning("task %s: unable to record the runtime: %s", task['id'], exc)
+
+    # other daemons on this host may share the data directory, the tasks are leased
+    # while being handled and the CPUs of local tasks are announced in a registry
+    leases = TaskLeases(path.join(data_dir, '.fdaemon-leases'))
+    registry = Registry(path.join(data_dir, '.fdaemon-registry'))
+
+    collect_opts = {
+        'max_artifact_size': max_artifact_size,
+        'max_total_size': max_upload_size,
+        'log_keep_size': log_keep_size if truncate_logs else None,
+        }
+
+    def finalize_local_tasks():
+        """Upload the results of local tasks which terminated since the last cycle"""
+
+        for task_id, local_task in list(local_tasks.items()):
+            if local_task.is_alive():
+                continue
+
+            del local_tasks[task_id]
+            publish_local_tasks()
+
+            if local_task.runner.cpuset:
+                allocator.release(local_task.runner.cpuset)
+
+            if local_task.runner.cgroup is not None:
+                local_task.runner.cgroup.remove()
+
+            if local_task.client_error:
+                continue  # leave the task as is
+
+            task_finished(local_task.task, local_task.runner)
+            upload_task_results(local_task.task, local_task.task_dir, local_task.runner)
+
+    def upload_task_results(task, task_dir, runner):
+        """Upload the results of a finished task, set it to 'error' if the server rejects them"""
+
+        try:
+            upload_results(sess, task, task_dir, runner, collect_opts, transfer_policy,
+                           extractors, result_store, spool, status_queue, events)
+        except requests.exceptions.RequestException as exc:
+            # the uploads got spooled if the server is unreachable, retrying this would fail again
+            logger.exception("task %s: uploading the results failed", task['id'])
+            runner.data['errors'].append({
+                'tag': 'upload',
+                'entry': 'results',
+                'msg': "uploading the results failed: {}".format(exc),
+                })
+            status_queue.put(task['id'], task['_links']['self'], {'status': 'error', 'data': runner.data})
+
+        task_cache.discard(task['id'])
+
+    def fail_task(task, msg):
+        """Set a task we are unable to run to 'error', with the reason"""
+
+        logger.error("task %s: %s", task['id'], msg)
+
+        status_queue.put(task['id'], task['_links']['self'], {'status': 'error', 'data': {
+            'warnings': [],
+            'errors': [{'tag': 'settings', 'entry': 'settings', 'msg': msg}],
+            'runner': {},
+            }})
+        events.emit('finished', task['id'], runner=task_runner_name(task), success=False, error=msg)
+        task_cache.discard(task['id'])
+
+    def publish_local_tasks():
+        """Announce the CPUs used by our local tasks to the other daemons"""
+        registry.publish({t: (local.cpus, local.runner.cpuset) for t, local in local_tasks.items()})
+
+    def has_capacity(runner_class, settings):
+        """Whether a task with the given runner and settings can be started right now"""
+
+        if not runner_class.blocking:
+            return True
+
+        reserved_cpus, reserved_cpuset = registry.reserved()
+
+        cpus = runner_class.local_cpus(settings)
+        used_cpus = sum(t.cpus for t in local_tasks.values()) + reserved_cpus
+        return (len(local_tasks) < max_local_tasks
+                and used_cpus + cpus <= max_cpus
+                and (allocator is None or allocator.can_allocate(cpus, reserved_cpuset)))
+
+    # the batch system queue states of our jobs: task id -> state
+    queue_states = {}
+
+    def queue_has_room(runner_class):
+        """Whether the high-water marks for queued jobs permit submitting another job"""
+
+        if not issubclass(runner_class, SlurmRunner):
+            return True
+
+        pending = sum(1 for s in queue_states.values() if s == 'PENDING')
+        return ((max_pending_jobs is None or pending < max_pending_jobs)
+                and (max_queued_jobs is None or len(queue_states) < max_queued_jobs))
+
+    def terminate(signum, _):
+        """Do not leave the commands of the local tasks behind when getting interrupted,
+        nor the queued status updates (of finished tasks) unsent"""
+        logger.warning("terminated by signal %d", signum)
+        kill_running_commands()
+
+        try:
+            status_queue.flush()
+        except requests.exceptions.RequestException:
+            logger.exception("sending the queued status updates failed")
+
+        raise SystemExit(128 + signum)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGINT, terminate)
+
     while True:
-        for task in task_iterator(sess, url, hostname, ignore_pending, ignore_running, acquire):
-            task_dir = path.join(data_dir, task['id'])
+        # send what piled up while the server was unreachable before anything else
+        if len(spool):
+            spool.replay(execute)
+
+        finalize_local_tasks()
+
+        # the server has to know about the status changes before listing the tasks
+        # (and before other daemons may lease the finished tasks)
+        status_queue.flush()
+        leases.release_all(keep=local_tasks)
+
+        acquired = 0
+
+        if not ignore_running:
+            # all our queued jobs are going to be checked again in this cycle
+            queue_states.clear()
+
+        try:
+            tasks = list(task_iterator(task_cache, url, hostname, ignore_pending, ignore_running,
+                                       acquire, acquire_window,
+                                       predicted_runtime if shortest_first else None))
+            offline = False
+
+        except requests.exceptions.RequestException as exc:
+            if not is_transient(exc):
+                raise
+
+            # keep checking the running tasks we know about, their results get spooled
+            logger.warning("server unreachable, only checking known running tasks: %s", exc)
+            tasks = [t for t in task_cache.tasks() if t['status'] == 'running']
+            offline = True
+
+        for task in tasks:
+            status_queue.flush_due()
+
+            if task['id'] in local_tasks:
+                logger.debug("task %s: still running locally", task['id'])
+                continue
+
+            if spool.has(task['id']):
+                # the state on the server is outdated until the spooled operations are sent
+                logger.debug("task %s: operations spooled, skipping", task['id'])
+                continue
+
+            if spool.has_failed(task['id']):
+                # the state on the server is outdated, the failed operations need to be looked at
+                logger.warning("task %s: operations failed, see '%s', skipping", task['id'], spool.failed_dir)
+                continue
+
+            # held until the end of the cycle, or until finalized for local tasks
+            # (for new tasks only once they passed the checks, to leave the others to the other daemons)
+            if task['status'] != 'new' and not leases.acquire(task['id']):
+                logger.debug("task %s: handled by another fdaemon, skipping", task['id'])
+                continue
+
+            newly_acquired = False
 
             if task['status'] == 'new':
+                if acquired >= acquire_limit:
+                    continue
+
+                # the settings might only be complete after acquisition, but if
+                # they are available, skip tasks we can't run without claiming them
+                try:
+                    runner_class = task_runner_class(task)
+                except NotImplementedError:
+                    logger.debug("task %s: runner not implemented, skipping", task['id'])
+                    continue
+
+                if runner_class is not None:
+                    if runner_class not in allowed_runners:
+                        logger.debug("task %s: runner not enabled, skipping", task['id'])
+                        continue
+
+                    try:
+                        capacity = has_capacity(runner_class, task['settings'])
+                    except (ValueError, TypeError):
+                        capacity = True  # invalid settings, the task gets acquired and failed below
+
+                    if not capacity:
+                        logger.debug("task %s: not enough free local resources, skipping", task['id'])
+                        continue
+
+                    if not queue_has_room(runner_class):
+                        logger.debug("task %s: too many jobs queued already, skipping", task['id'])
+                        continue
+
+                if not leases.acquire(task['id']):
+                    logger.debug("task %s: handled by another fdaemon, skipping", task['id'])
+                    continue
+
                 try:
                     req = sess.patch(task['_links']['self'],
                                      json={'status': 'pending', 'machine': hostname})
                     req.raise_for_status()
                     task = req.json()
+                    task_cache.update(task)
                     logger.info("acquired new task %s", task['id'])
+                    acquired += 1
+                    newly_acquired = True
+
+                    created = parse_timestamp(task.get('ctime'))
+                    events.emit('acquired', task['id'], runner=task_runner_name(task),
+                                priority=task.get('priority'),
+                                queue_wait=time.time() - created if created is not None else None)
 
                 except requests.exceptions.HTTPError as error:
                     try:
@@ -133,71 +758,201 @@ def main(url, hostname, nap_time, data_dir,
                     except (ValueError, KeyError):
                         logger.exception("task %s: acquisition failed: %s\n", task['id'], error.response.text)
 
+                    leases.release(task['id'])
                     continue
                 except requests.exceptions.RequestException:
+                    leases.release(task['id'])
                     continue
 
-            elif task['status'] == 'pending':
-                logger.info("continue pending task %s", task['id'])
-                # fetch the complete object
-                req = sess.get(task['_links']['self'])
-                req.raise_for_status()
-                task = req.json()
             else:
-                logger.info("checking %s task %s", task['status'], task['id'])
-                # fetch the complete object
-                req = sess.get(task['_links']['self'])
-                req.raise_for_status()
-                task = req.json()
+                if task['status'] == 'pending':
+                    logger.info("continue pending task %s", task['id'])
+                else:
+                    logger.info("checking %s task %s", task['status'], task['id'])
+
+                # fetch the complete object (unless unchanged since the last time)
+                if not offline:
+                    try:
+                        task = task_cache.task(task)
+                    except requests.exceptions.RequestException as exc:
+                        logger.error("task %s: fetching the task failed: %s", task['id'], exc)
+                        continue
 
             # extract the runner info
 
-            runner_name = None
-            runner = None
+            try:
+                runner_class = task_runner_class(task)
+                if runner_class is None:
+                    raise NotImplementedError("no runner specified")
+                if runner_class not in allowed_runners:
+                    raise NotImplementedError("runner not enabled for this daemon")
+
+            except NotImplementedError as exc:
+                logger.error("task %s: unable to handle the task: %s", task['id'], exc)
 
+                if newly_acquired:
+                    # hand back tasks we just acquired, someone else might be able to run them
+                    try:
+                        release_task(task, spool, execute, events)
+                    except requests.exceptions.RequestException as release_exc:
+                        # it would stay ours, and be skipped again in every cycle
+                        fail_task(task, "unable to handle the task: {} (releasing it failed: {})".format(
+                            exc, release_exc))
+
+                continue
+
+            # the existing task dir, or the best volume for the inputs of a new one
+            task_dir = volumes.task_dir(task['id'], sum(i.get('size') or 0 for i in task.get('infiles') or []),
+                                        [t.task_dir for t in local_tasks.values()])
+
+            # runners parse their settings when created, the task can not be run if they are invalid
             try:
-                runner_name = task['settings']['machine']['runner']
-                runner = RUNNERS[runner_name](task['settings'], task_dir)
-            except KeyError:
-                raise NotImplementedError(
-                    "runner '{}' is not (yet) implemented".format(runner_name))
+                # runners may alter the settings, but the task object might be reused from the cache
+                runner = runner_class(copy.deepcopy(task['settings']), task_dir)
+                runner_class.local_cpus(task['settings'])
+
+            except (ValueError, TypeError) as exc:
+                fail_task(task, "invalid task settings: {}".format(exc))
+                continue
+
+            if newly_acquired and not queue_has_room(runner_class):
+                logger.info("task %s: too many jobs queued already, handing it back", task['id'])
+                try:
+                    release_task(task, spool, execute, events)
+                except requests.exceptions.RequestException as exc:
+                    # it stays ours and gets submitted in one of the next cycles
+                    logger.warning("task %s: releasing failed, keeping it: %s", task['id'], exc)
+                continue
+
+            if (task['status'] == 'pending' and run
+                    and not has_capacity(runner_class, task['settings'])):
+                logger.info("task %s: not enough free local resources, deferring", task['id'])
+                continue
+
+            runner.events = events
+            runner.task_id = task['id']
+
+            if runner.blocking:
+                # the task settings take precedence over the daemon defaults
+                if runner.walltime is None:
+                    runner.walltime = walltime
+                if runner.stall_timeout is None:
+                    runner.stall_timeout = stall_timeout
+                if runner.memory_limit is None:
+                    runner.memory_limit = memory_limit
+
+            elif predict_slurm_time and isinstance(runner, SlurmRunner):
+                # only a rare similar task should have taken longer (the limit is not
+                # applied if the batch script asks for less)
+                predicted = history.predict(task, 0.95)
+                if predicted is not None:
+                    runner.time_limit = predicted*slurm_time_factor + SLURM_TIME_MARGIN
+                    logger.info("task %s: requesting a time limit of %.0f seconds", task['id'], runner.time_limit)
 
             # prepare the input data for pending tasks (new tasks are at this point also pending)
 
             if task['status'] == 'pending':
-                if path.exists(task_dir):
-                    logger.info("removing already existing task dir '%s'", task_dir)
-                    shutil.rmtree(task_dir)
+                # re-use verified inputs from a previous attempt, remove everything else
+                infiles = prepare_task_dir(task_dir, task['infiles'])
 
-                os.mkdir(task_dir)
+                logger.info("task %s: downloading %d of %d inputs",
+                            task['id'], len(infiles), len(task['infiles']))
 
-                logger.info("task %s: downloading inputs", task['id'])
+                manifest = load_manifest(task_dir)
+                staging_start = time.time()
 
-                # download each input file by streaming
-                for infile in task['infiles']:
-                    req = sess.get(infile['_links']['download'], stream=True)
-                    req.raise_for_status()
-                    with open(path.join(task_dir, infile['name']), 'wb') as fhandle:
-                        for chunk in req.iter_content(1024):
-                            fhandle.write(chunk)
+                try:
+                    # download each input file by streaming
+                    for infile in infiles:
+                        checksum = parse_checksum(infile.get('checksum'))
+                        hasher = hashlib.new(checksum[0]) if checksum else None
+
+                        buckets, priority = transfer_policy.download_buckets(infile.get('size'))
+                        filepath = path.join(task_dir, infile['name'])
+                        stats = download(sess, infile['_links']['download'], filepath,
+                                         download_buffer_size, fsync, buckets, priority, hasher)
+                        logger.info("task %s: downloaded '%s': %s", task['id'], infile['name'], stats)
+                        events.emit('download', task['id'], name=infile['name'], bytes=stats.nbytes,
+                                    duration=stats.elapsed)
+
+                        if hasher and hasher.hexdigest() != checksum[1]:
+                            os.unlink(filepath)
+                            raise ClientError("checksum mismatch for input file '{}'".format(infile['name']))
+
+                        manifest[infile['name']] = manifest_entry(filepath, checksum)
+
+                except ClientError as exc:
+                    logger.exception("task %s: staging failed, leave the task as is", task['id'])
+                    events.emit('staged', task['id'], error=str(exc))
+                    continue
+
+                except requests.exceptions.RequestException as exc:
+                    logger.error("task %s: staging failed, retrying in the next cycle: %s", task['id'], exc)
+                    events.emit('staged', task['id'], error=str(exc))
+                    continue
+
+                finally:
+                    save_manifest(task_dir, manifest)
+
+                events.emit('staged', task['id'], files=len(infiles),
+                            bytes=sum(i.get('size') or 0 for i in infiles), duration=time.time() - staging_start)
+
+                if result_store is not None:
+                    result_store.prepare(task, task_dir)
 
             # define a function object to be called by the runners once they started the task
             def set_task_running():
                 logger.info("task %s: started", task['id'])
-                req = sess.patch(task['_links']['self'], json={'status': 'running'})
-                req.raise_for_status()
+                events.emit('started', task['id'], runner=task_runner_name(task))
+                status_queue.put(task['id'], task['_links']['self'], {'status': 'running'})
+                # not held back: a task still pending on the server would be started again
+                # (wiping the task dir of the job) if the update got lost
+                status_queue.flush()
+                task_cache.update(dict(task, status='running'))
 
             # running tasks should be checked, while pending task get executed
             try:
                 if task['status'] == 'running':
                     runner.check()
                 elif run:
-                    if run:
-                        # there are blocking runners, which is why we use a callback here
-                        # to give them the chance of setting a task to running
-                        runner.run(set_task_running)
+                    if result_store is not None and result_store.restore(task, task_dir, runner):
+                        set_task_running()
+
+                    elif runner.blocking:
+                        # check and reserve the CPUs atomically among the daemons sharing the host
+                        with registry.lock():
+                            if not has_capacity(runner_class, task['settings']):
+                                logger.info("task %s: CPUs taken by another fdaemon, deferring", task['id'])
+                                continue
+
+                            if allocator is not None:
+                                runner.cpuset = allocator.allocate(runner_class.local_cpus(task['settings']),
+                                                                   registry.reserved()[1])
+                                if runner.cpuset is None:
+                                    logger.info("task %s: no free CPUs to pin the task to, deferring", task['id'])
+                                    continue
+
+                            if cgroups is not None:
+                                runner.cgroup = cgroups.create(task['id'], runner.memory_limit,
+                                                               runner_class.local_cpus(task['settings']))
+
+                            # blocking runners are run in the background, the task gets
+                            # finalized in the first cycle after they terminated
+                            try:
+                                set_task_running()
+                            except Exception:
+                                if runner.cpuset:
+                                    allocator.release(runner.cpuset)
+                                if runner.cgroup is not None:
+                                    runner.cgroup.remove()
+                                raise
+
+                            local_tasks[task['id']] = LocalTask(task, task_dir, runner, wakeup,
+                                                                runner_class.local_cpus(task['settings']))
+                            publish_local_tasks()
+                        continue
                     else:
-                        logger.info("task %s: skip running the task", task['id'])
+                        runner.run(set_task_running)
 
             except requests.exceptions.HTTPError as error:
                 logger.exception("task %s: HTTP error occurred: %s\n%s",
@@ -214,48 +969,41 @@ def main(url, hostname, nap_time, data_dir,
             # we need this check to not upload partial files, another option
             # would be to check the upload files for duplicate and checksum
             # to determine whether we have to re-upload
-            if runner.finished:
-                logger.info("task %s: finished, collecting output", task['id'])
-
-                filepaths = []
-
-                # collect files to upload as declared by the server
-                for a_name in task['settings']['output_artifacts']:
-                    add_filepaths = glob(path.join(task_dir, a_name))
-
-                    if not add_filepaths:
-                        runner.data['warnings'].append({
-                            'tag': "output_artifacts",
-                            'entry': a_name,
-                            'msg': "no files found",
-                            })
-                        logger.warning("task %s: glob for '%s' returned 0 files",
-                                       task['id'], a_name)
-                        continue
+            if runner.queue_state is not None and not runner.finished:
+                queue_states[task['id']] = runner.queue_state
+            else:
+                queue_states.pop(task['id'], None)
 
-                    else:
-                        filepaths += add_filepaths
-
-                # also upload additional existing non-empty output files from all commands
-                filepaths += [f for f in runner.outfiles if path.exists(f) and path.getsize(f)]
-
-                for filepath in filepaths:
-                    data = {'name': path.relpath(filepath, task_dir)}
-                    logger.info("task %s: uploading '%s'", task['id'], data['name'])
-                    with open(filepath, 'rb') as data_fh:
-                        req = sess.post(task['_links']['uploads'],
-                                        data=data, files={'data': data_fh})
-                        req.raise_for_status()
-
-                req = sess.patch(task['_links']['self'],
-                                 json={'status': 'done' if runner.success else 'error',
-                                       'data': runner.data})
-                req.raise_for_status()
+            if runner.finished:
+                wakeup.unwatch(task_dir)
+                task_finished(task, runner)
+                upload_task_results(task, task_dir, runner)
+            else:
+                # get notified as soon as a detached task writes its final output
+                wakeup.watch(task_dir, runner.sentinels)
 
         if one_shot:
+            for local_task in local_tasks.values():
+                local_task.join()
+
+            finalize_local_tasks()
+            status_queue.flush()
+            leases.release_all()
+
+            if len(spool) and not spool.replay(execute):
+                logger.warning("server unreachable, %d spooled entries are going to be sent by the next run",
+                               len(spool))
+
+            registry.close()
+            events.close()
+
             logger.info("one-shot complete, exiting as requested")
             break
 
         else:
+            status_queue.flush()
+            leases.release_all(keep=local_tasks)
+
             logger.info("all done for now, taking a nap")
-            sleep(nap_time)
+            if wakeup.wait(nap_time):
+                logger.info("woken up by a terminated task")
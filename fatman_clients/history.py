@@ -0,0 +1,152 @@
+"""Local history of task runtimes, used to predict the runtime of new tasks"""
+
+import os
+import json
+import math
+import time
+import logging
+from os import path
+from collections import deque
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+# the number of runtimes kept per group of similar tasks
+MAX_SAMPLES = 50
+
+# the number of runtimes required for a prediction
+MIN_SAMPLES = 3
+
+# the feature sets identifying groups of similar tasks, from the most to the least specific
+LEVELS = (
+    ('runner', 'code', 'test', 'basis_set_family', 'size'),
+    ('runner', 'code', 'test', 'basis_set_family'),
+    ('runner', 'code'),
+    ('runner',),
+    )
+
+
+def task_features(task):
+    """The properties of a task which determine its runtime.
+
+    The test, code and basis set family are taken from the task settings if the server
+    provides them, the code otherwise from the first command. The total size of the
+    input files (in powers of two) stands in for the size of the structure, it is None
+    (matching no recorded task) for task objects without the input files."""
+
+    settings = task.get('settings') or {}
+    commands = settings.get('commands') or [{}]
+
+    try:
+        runner = settings['machine']['runner']
+    except (KeyError, TypeError):
+        runner = None
+
+    basis = settings.get('basis_set_family')
+    if isinstance(basis, dict):
+        basis = ','.join('{}:{}'.format(k, basis[k]) for k in sorted(basis))
+
+    size = None
+    if task.get('infiles') is not None:
+        size = sum(i.get('size') or 0 for i in task['infiles'])
+        size = int(math.log(size, 2)) if size > 0 else 0
+
+    return {
+        'runner': runner,
+        'code': settings.get('code') or path.basename(str(commands[0].get('cmd', ''))) or None,
+        'test': settings.get('test'),
+        'basis_set_family': basis,
+        'size': size,
+        }
+
+
+def runner_runtime(runner):
+    """The runtime in seconds of a finished task as reported by its runner, None if unknown"""
+    return runner.data.get('runner', {}).get('walltime')
+
+
+def quantile(values, fraction):
+    """The given quantile of the values (nearest rank)"""
+    values = sorted(values)
+    return values[min(int(math.ceil(fraction*len(values))) - 1, len(values) - 1) if fraction > 0 else 0]
+
+
+class RuntimeHistory(object):
+    """The runtimes of successful tasks, kept in a JSON Lines file"""
+
+    def __init__(self, history_fn):
+        self.history_fn = history_fn
+        self._samples = {}  # (level, feature values) -> deque of runtimes
+
+        nrecords = 0
+        try:
+            with open(history_fn, 'r') as fhandle:
+                for line in fhandle:
+                    try:
+                        record = json.loads(line)
+                        self._add(record['features'], record['runtime'])
+                    except (ValueError, KeyError):
+                        continue  # a partially written record
+                    nrecords += 1
+        except (OSError, IOError):
+            pass
+
+        # only the latest records are used, drop the others now and then
+        if nrecords > 4*self._nsamples():
+            self._compact()
+
+    @staticmethod
+    def _keys(features):
+        return [(level, tuple(features.get(f) for f in level)) for level in LEVELS]
+
+    def _add(self, features, runtime):
+        for key in self._keys(features):
+            self._samples.setdefault(key, deque(maxlen=MAX_SAMPLES)).append(runtime)
+
+    def _nsamples(self):
+        return sum(len(s) for (level, _), s in self._samples.items() if level == LEVELS[0])
+
+    def _compact(self):
+        records = []
+        with open(self.history_fn, 'r') as fhandle:
+            for line in fhandle:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+
+        # keep the most recent records of each group of the most specific level
+        kept = {}
+        for record in reversed(records):
+            key = self._keys(record['features'])[0]
+            if len(kept.setdefault(key, [])) < MAX_SAMPLES:
+                kept[key].append(record)
+
+        logger.debug("compacting the runtime history, keeping %d of %d records",
+                     sum(len(r) for r in kept.values()), len(records))
+
+        tmp_fn = self.history_fn + '.tmp'
+        with open(tmp_fn, 'w') as fhandle:
+            for record in sorted((r for rs in kept.values() for r in rs), key=lambda r: r.get('time', 0)):
+                fhandle.write(json.dumps(record) + '\n')
+        os.rename(tmp_fn, self.history_fn)
+
+    def record(self, task, runtime):
+        """Add the runtime of a successful task"""
+
+        features = task_features(task)
+        self._add(features, runtime)
+
+        with open(self.history_fn, 'a') as fhandle:
+            fhandle.write(json.dumps({'task': task['id'], 'time': time.time(),
+                                      'features': features, 'runtime': runtime}) + '\n')
+
+    def predict(self, task, fraction=0.5):
+        """The predicted runtime of a task in seconds, as the given quantile of the runtimes
+        of the most similar tasks with enough samples, None without enough history"""
+
+        for key in self._keys(task_features(task)):
+            samples = self._samples.get(key)
+            if samples and len(samples) >= MIN_SAMPLES:
+                return quantile(samples, fraction)
+
+        return None
@@ -0,0 +1,194 @@
+"""Coordination of several fdaemons sharing a data directory on one host
+
+Tasks are leased by holding an exclusive lock on a per-task lease file, which the kernel
+releases if the daemon dies. The daemons additionally announce the local tasks they run,
+with the CPUs they occupy, in a shared registry to not oversubscribe the host together.
+"""
+
+import os
+import json
+import time
+import fcntl
+import logging
+import contextlib
+from os import path
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+
+def _lock_file(filepath, blocking=False):
+    """Open and exclusively lock a file, returns the file descriptor or None if locked by someone else.
+
+    Lock files get removed by their holders, retry if the locked file is not the one
+    at the path anymore."""
+
+    while True:
+        fdesc = os.open(filepath, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fdesc, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(fdesc)
+            return None
+
+        try:
+            if os.fstat(fdesc).st_ino == os.stat(filepath).st_ino:
+                return fdesc
+        except FileNotFoundError:
+            pass
+
+        os.close(fdesc)
+
+
+class TaskLeases(object):
+    """Exclusive leases on tasks, to be held while handling a task"""
+
+    def __init__(self, lease_dir):
+        self.lease_dir = lease_dir
+        self._held = {}  # task id -> file descriptor
+
+        if not path.exists(lease_dir):
+            os.makedirs(lease_dir)
+
+    def _lease_fn(self, task_id):
+        return path.join(self.lease_dir, '{}.lease'.format(task_id))
+
+    def __contains__(self, task_id):
+        return task_id in self._held
+
+    def acquire(self, task_id):
+        """Lease the task, returns False if another daemon holds it"""
+
+        if task_id in self._held:
+            return True
+
+        fdesc = _lock_file(self._lease_fn(task_id))
+        if fdesc is None:
+            return False
+
+        # for inspection only
+        os.ftruncate(fdesc, 0)
+        os.write(fdesc, '{}\n'.format(os.getpid()).encode('ascii'))
+
+        self._held[task_id] = fdesc
+        return True
+
+    def release(self, task_id):
+        """Release the lease of a task (if held)"""
+
+        fdesc = self._held.pop(task_id, None)
+        if fdesc is None:
+            return
+
+        # remove the file while still holding the lock, see _lock_file
+        try:
+            os.unlink(self._lease_fn(task_id))
+        except FileNotFoundError:
+            pass
+        os.close(fdesc)
+
+    def release_all(self, keep=()):
+        """Release all leases except the ones of the given tasks"""
+        for task_id in set(self._held) - set(keep):
+            self.release(task_id)
+
+
+class Registry(object):
+    """The daemons sharing the data directory and the CPUs of their local tasks.
+
+    Each daemon has an entry `<pid>.json`, and holds the lock on `<pid>.lock` while
+    alive. Entries whose lock is not held anymore are stale and get removed."""
+
+    def __init__(self, registry_dir):
+        self.registry_dir = registry_dir
+
+        if not path.exists(registry_dir):
+            os.makedirs(registry_dir)
+
+        self._name = str(os.getpid())
+        self._fdesc = _lock_file(path.join(registry_dir, self._name + '.lock'))
+        self._started = time.time()
+
+        self.publish({})
+
+    @contextlib.contextmanager
+    def lock(self):
+        """Exclusive access to the registry, to check and reserve resources atomically"""
+
+        fdesc = os.open(path.join(self.registry_dir, '.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fdesc, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fdesc)
+
+    def publish(self, tasks):
+        """Announce our local tasks, given as dict task id -> (number of CPUs, cpuset or None)"""
+
+        entry_fn = path.join(self.registry_dir, self._name + '.json')
+        tmp_fn = path.join(self.registry_dir, '.' + self._name + '.tmp')
+
+        with open(tmp_fn, 'w') as fhandle:
+            json.dump({
+                'pid': os.getpid(),
+                'started': self._started,
+                'tasks': {t: {'cpus': c, 'cpuset': sorted(s) if s else None} for t, (c, s) in tasks.items()},
+                }, fhandle)
+
+        os.rename(tmp_fn, entry_fn)
+
+    def others(self):
+        """The entries of the other running daemons"""
+
+        entries = []
+
+        for entry_fn in os.listdir(self.registry_dir):
+            name, ext = path.splitext(entry_fn)
+            if ext != '.lock' or name == self._name or name.startswith('.'):
+                continue
+
+            lock_fn = path.join(self.registry_dir, entry_fn)
+            fdesc = _lock_file(lock_fn)
+
+            if fdesc is not None:
+                # the daemon is gone
+                logger.info("removing the registry entry of the terminated fdaemon %s", name)
+                for filepath in (path.join(self.registry_dir, name + '.json'), lock_fn):
+                    try:
+                        os.unlink(filepath)
+                    except FileNotFoundError:
+                        pass
+                os.close(fdesc)
+                continue
+
+            try:
+                with open(path.join(self.registry_dir, name + '.json'), 'r') as fhandle:
+                    entries.append(json.load(fhandle))
+            except (OSError, IOError, ValueError):
+                continue  # just starting
+
+        return entries
+
+    def reserved(self):
+        """The number of CPUs and the set of pinned CPUs used by the local tasks of the other daemons"""
+
+        cpus = 0
+        cpuset = set()
+        for entry in self.others():
+            for task in entry['tasks'].values():
+                cpus += task['cpus']
+                cpuset.update(task['cpuset'] or ())
+
+        return cpus, cpuset
+
+    def close(self):
+        """Remove our entry"""
+
+        for ext in ('.json', '.lock'):
+            try:
+                os.unlink(path.join(self.registry_dir, self._name + ext))
+            except FileNotFoundError:
+                pass
+
+        if self._fdesc is not None:
+            os.close(self._fdesc)
+            self._fdesc = None
@@ -0,0 +1,159 @@
+"""Streaming multipart/form-data encoder for uploads of arbitrarily large files"""
+
+import os
+import uuid
+import tempfile
+from io import BytesIO, UnsupportedOperation
+from os import path
+
+# the maximal number of bytes returned by a single read()
+CHUNK_SIZE = 64*1024
+
+# unseekable inputs (like stdin) are buffered, in memory up to this size and on disk beyond
+SPOOL_SIZE = 8*1024*1024
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+def _remaining_size(fhandle):
+    """The number of bytes left to read from fhandle, None if it can not be determined"""
+
+    try:
+        pos = fhandle.tell()
+        size = os.fstat(fhandle.fileno()).st_size
+    except (AttributeError, OSError, UnsupportedOperation):
+        try:
+            pos = fhandle.tell()
+            size = fhandle.seek(0, os.SEEK_END)
+            fhandle.seek(pos)
+        except (AttributeError, OSError, UnsupportedOperation):
+            return None
+
+    return max(size - pos, 0)
+
+
+def _spool(fhandle):
+    """Copy an unseekable file object into a temporary file, returns (file object, size)"""
+
+    spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    for chunk in iter(lambda: fhandle.read(CHUNK_SIZE), b''):
+        spooled.write(_to_bytes(chunk))
+
+    size = spooled.tell()
+    spooled.seek(0)
+    return spooled, size
+
+
+class MultipartEncoder(object):
+    """A file-like multipart/form-data body, reading the files only as the body is read.
+
+    Takes the same data and files arguments as `requests.post`, but never holds more
+    than one chunk of a file in memory. Pass it as data together with its content type:
+
+        with MultipartEncoder(data={'name': 'foo'}, files={'data': fhandle}) as encoder:
+            sess.post(url, data=encoder, headers={'Content-Type': encoder.content_type})
+
+    For small in-memory data there is no gain over `files=`.
+    """
+
+    def __init__(self, data=None, files=None, boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+
+        self._parts = []  # list of (file object, size)
+        self._spooled = []
+
+        for name, value in (data.items() if isinstance(data, dict) else data or []):
+            values = value if isinstance(value, (list, tuple)) else [value]
+            for val in values:
+                if val is not None:  # like requests, skip fields without value
+                    self._add_part(name, BytesIO(_to_bytes(val)))
+
+        for name, value in (files.items() if isinstance(files, dict) else files or []):
+            filename, content_type = None, None
+
+            if isinstance(value, (list, tuple)):
+                filename, fhandle = value[0], value[1]
+                if len(value) > 2:
+                    content_type = value[2]
+            else:
+                fhandle = value
+                filename = getattr(fhandle, 'name', None)
+                if not isinstance(filename, str) or filename.startswith('<'):  # like '<stdin>'
+                    filename = name
+                filename = path.basename(filename)
+
+            if isinstance(fhandle, (bytes, str)):
+                fhandle = BytesIO(_to_bytes(fhandle))
+
+            self._add_part(name, fhandle, filename, content_type)
+
+        self._add(BytesIO('--{}--\r\n'.format(self.boundary).encode('ascii')))
+
+        self._remaining = sum(size for _, size in self._parts)
+        self._current = 0
+
+    def _add(self, fhandle, size=None):
+        if size is None:
+            size = _remaining_size(fhandle)
+
+        if size is None:
+            fhandle, size = _spool(fhandle)
+            self._spooled.append(fhandle)
+
+        self._parts.append((fhandle, size))
+
+    def _add_part(self, name, fhandle, filename=None, content_type=None):
+        header = '--{}\r\nContent-Disposition: form-data; name="{}"'.format(self.boundary, name)
+        if filename is not None:
+            header += '; filename="{}"'.format(filename)
+            header += '\r\nContent-Type: {}'.format(content_type or 'application/octet-stream')
+        header += '\r\n\r\n'
+
+        self._add(BytesIO(header.encode('utf-8')))
+        self._add(fhandle)
+        self._add(BytesIO(b'\r\n'))
+
+    def __len__(self):
+        return self._remaining
+
+    def read(self, size=-1):
+        """Read at most size bytes (at most CHUNK_SIZE if unspecified) of the encoded body"""
+
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+
+        while self._current < len(self._parts):
+            fhandle, _ = self._parts[self._current]
+            data = _to_bytes(fhandle.read(size))
+
+            if data:
+                self._remaining -= len(data)
+                return data
+
+            self._current += 1
+
+        return b''
+
+    def __iter__(self):
+        while True:
+            data = self.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        """Remove the temporary copies of unseekable inputs"""
+        for fhandle in self._spooled:
+            fhandle.close()
+        self._spooled = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,204 @@
+"""Local store of the outputs of successful tasks, to re-use them for identical tasks"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+from os import path
+
+from .staging import file_checksum
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+# the fingerprint of the staged task is kept in the task dir until the task is finished
+FINGERPRINT_NAME = '.fdaemon-fingerprint'
+
+# files written by fdaemon itself into the task dir, never part of the outputs
+INTERNAL_PREFIX = '.fdaemon-'
+
+# the settings which determine the outcome of a task, besides the input files
+FINGERPRINT_SETTINGS = ('commands', 'environment', 'machine')
+
+
+def task_fingerprint(task, task_dir):
+    """Hash of the commands, environment and machine settings of a task
+    and the content of its staged input files"""
+
+    settings = task['settings']
+    hasher = hashlib.sha256(json.dumps(
+        {k: settings.get(k) for k in FINGERPRINT_SETTINGS}, sort_keys=True).encode('utf-8'))
+
+    for infile in sorted(task['infiles'], key=lambda i: i['name']):
+        hasher.update(infile['name'].encode('utf-8') + b'\0')
+        hasher.update(file_checksum(path.join(task_dir, infile['name']), 'sha256').encode('ascii'))
+
+    return hasher.hexdigest()
+
+
+def memoizable(task):
+    """Whether the outputs of a task may be stored and re-used, tasks can opt out
+    by setting 'memoize' to false in their settings (for example benchmarks)"""
+    return task['settings'].get('memoize', True) is not False
+
+
+class ResultStore(object):
+    """Stores the outputs of successful tasks by fingerprint, up to max_size bytes in total.
+
+    The least recently used entries are removed first when exceeding the size."""
+
+    def __init__(self, store_dir, max_size=None):
+        self.store_dir = store_dir
+        self.max_size = max_size
+
+        if not path.exists(store_dir):
+            os.makedirs(store_dir)
+
+    def prepare(self, task, task_dir):
+        """Record the fingerprint of a freshly staged task, returns it (None if not memoizable)"""
+
+        fingerprint_fn = path.join(task_dir, FINGERPRINT_NAME)
+
+        if not memoizable(task):
+            if path.exists(fingerprint_fn):
+                os.unlink(fingerprint_fn)
+            return None
+
+        fingerprint = task_fingerprint(task, task_dir)
+        with open(fingerprint_fn, 'w') as fhandle:
+            fhandle.write(fingerprint)
+
+        return fingerprint
+
+    def _entry_dir(self, task_dir):
+        try:
+            with open(path.join(task_dir, FINGERPRINT_NAME), 'r') as fhandle:
+                fingerprint = fhandle.read().strip()
+        except (OSError, IOError):
+            return None, None
+
+        return fingerprint, path.join(self.store_dir, fingerprint)
+
+    def restore(self, task, task_dir, runner):
+        """Copy the outputs of a previous identical run into the task dir and mark the runner
+        as finished successfully, returns False if there is no previous run"""
+
+        fingerprint, entry_dir = self._entry_dir(task_dir)
+        if fingerprint is None or not memoizable(task):
+            return False
+
+        meta_fn = path.join(entry_dir, 'meta.json')
+
+        try:
+            with open(meta_fn, 'r') as fhandle:
+                meta = json.load(fhandle)
+
+            for relname in meta['files']:
+                target = path.join(task_dir, relname)
+                if not path.isdir(path.dirname(target)):
+                    os.makedirs(path.dirname(target))
+                shutil.copy2(path.join(entry_dir, 'files', relname), target)
+
+            # mark the entry as recently used
+            os.utime(meta_fn, None)
+
+        except (OSError, IOError, ValueError, KeyError) as exc:
+            if path.exists(meta_fn):  # otherwise simply not stored
+                logger.warning("task %s: unable to re-use the stored outputs of %s: %s",
+                               task['id'], fingerprint, exc)
+            return False
+
+        logger.info("task %s: re-using the outputs of the identical task %s", task['id'], meta['task'])
+
+        runner.data = meta['data']
+        runner.data['memoized'] = {'fingerprint': fingerprint, 'task': meta['task']}
+        runner.outfiles = {path.join(task_dir, o) for o in meta['outfiles']}
+        runner.finished = True
+        runner.success = True
+
+        return True
+
+    def save(self, task, task_dir, runner, data=None):
+        """Store the outputs of a successfully finished task, together with data
+        (default: the runner data) to be reported again when re-using them"""
+
+        fingerprint, entry_dir = self._entry_dir(task_dir)
+        if fingerprint is None or not memoizable(task) or path.exists(entry_dir):
+            return
+
+        inputs = {i['name'] for i in task['infiles']}
+
+        files = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(task_dir):
+            dirnames[:] = [d for d in dirnames if not d.startswith(INTERNAL_PREFIX)]
+            for filename in filenames:
+                relname = path.relpath(path.join(dirpath, filename), task_dir)
+                if relname in inputs or filename.startswith(INTERNAL_PREFIX):
+                    continue
+                files.append(relname)
+                total += os.lstat(path.join(dirpath, filename)).st_size
+
+        if self.max_size is not None and total > self.max_size:
+            logger.info("task %s: outputs too large to be stored for re-use", task['id'])
+            return
+
+        # assemble the entry next to its final place and move it there at once
+        tmp_dir = path.join(self.store_dir, '.tmp-{}-{}'.format(fingerprint, os.getpid()))
+
+        try:
+            for relname in files:
+                target = path.join(tmp_dir, 'files', relname)
+                if not path.isdir(path.dirname(target)):
+                    os.makedirs(path.dirname(target))
+                shutil.copy2(path.join(task_dir, relname), target, follow_symlinks=False)
+
+            with open(path.join(tmp_dir, 'meta.json'), 'w') as fhandle:
+                json.dump({
+                    'task': task['id'],
+                    'stored': time.time(),
+                    'size': total,
+                    'files': files,
+                    'outfiles': [path.relpath(o, task_dir) for o in runner.outfiles],
+                    'data': data if data is not None else runner.data,
+                    }, fhandle)
+
+            os.rename(tmp_dir, entry_dir)
+
+        except OSError as exc:
+            logger.warning("task %s: unable to store the outputs for re-use: %s", task['id'], exc)
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        logger.info("task %s: stored %d outputs (%d bytes) for re-use", task['id'], len(files), total)
+
+        self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries until the store fits into max_size"""
+
+        if self.max_size is None:
+            return
+
+        entries = []
+        for entry in os.scandir(self.store_dir):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            try:
+                meta_fn = path.join(entry.path, 'meta.json')
+                with open(meta_fn, 'r') as fhandle:
+                    size = json.load(fhandle)['size']
+                entries.append((os.stat(meta_fn).st_mtime, size, entry.path))
+            except (OSError, IOError, ValueError, KeyError):
+                continue
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            logger.info("removing stored outputs '%s' (%d bytes) to free space", path.basename(entry_dir), size)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
@@ -2,27 +2,219 @@
 
 import logging
 import subprocess
+import signal
 import time
+import json
+import sys
+import re
 import os
+import threading
 from os import path
 from abc import ABCMeta, abstractmethod
 from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # py2/3 compat calls
-from six import raise_from, exec_
+from six import raise_from
+
+from .affinity import format_cpulist
+from .artifacts import parse_size
 
 logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
 
 
+# the sacct columns we are interested in (the header is used to build the keys)
+SACCT_FIELDS = ['JobID', 'JobName', 'State', 'ExitCode', 'Elapsed', 'Start', 'End',
+                'NNodes', 'NCPUS', 'MaxRSS', 'NodeList']
+
+# look for the job in the accounting data starting this many seconds before its submission
+SACCT_STARTTIME_MARGIN = 60*60
+
+# the squeue states of jobs which did not terminate yet, squeue also lists terminated jobs
+# for a while when they are requested by their ID (states like COMPLETED, FAILED or TIMEOUT)
+SQUEUE_ACTIVE_STATES = ('PENDING', 'RUNNING', 'CONFIGURING', 'COMPLETING', 'SUSPENDED',
+                        'REQUEUED', 'RESIZING', 'SIGNALING', 'STAGE_OUT', 'STOPPED')
+
+
+# interval in seconds at which the local runners check walltime and progress of their commands
+POLL_INTERVAL = 5
+
+# the signals sent to the process group of a command to be killed, and the time to wait after each
+KILL_SIGNALS = [(signal.SIGTERM, 30), (signal.SIGKILL, 10)]
+
+
 class ClientError(Exception):
     """For errors which are completely on the client side and are thus recoverable"""
     pass
 
 
+class TimeLimitExceeded(RuntimeError):
+    """A command was killed since it exceeded its walltime or did not make progress"""
+
+    def __init__(self, reason, limit):
+        self.reason = reason
+        self.limit = limit
+
+        if reason == 'stall':
+            msg = "command produced no output for {:.0f} seconds and got killed".format(limit)
+        else:
+            msg = "command exceeded its walltime of {:.0f} seconds and got killed".format(limit)
+
+        super(TimeLimitExceeded, self).__init__(msg)
+
+
+def parse_duration(value):
+    """Convert a duration like '3600', '90m', '12h', '2d' or '[D-]HH:MM:SS' to seconds (None stays None)"""
+
+    if value is None or isinstance(value, (int, float)):
+        return value
+
+    match = re.match(r'^\s*(?P<num>\d+(\.\d*)?)\s*(?P<unit>[smhd]?)\s*$', value)
+    if match:
+        return float(match.group('num')) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group('unit')]
+
+    match = re.match(r'^\s*((?P<days>\d+)-)?(?P<hours>\d+):(?P<minutes>\d{2})(:(?P<seconds>\d{2}))?\s*$', value)
+    if match:
+        return float(((int(match.group('days') or 0)*24 + int(match.group('hours')))*60
+                      + int(match.group('minutes')))*60 + int(match.group('seconds') or 0))
+
+    raise ValueError("invalid duration specification: '{}'".format(value))
+
+
+def parse_slurm_time(value):
+    """Convert a Slurm time limit ('MM', 'MM:SS', 'HH:MM:SS', 'D-HH', 'D-HH:MM' or 'D-HH:MM:SS')
+    to seconds, None for unlimited or invalid ones"""
+
+    match = re.match(r'^(?:(?P<days>\d+)-)?(?P<fields>\d+(?::\d+){0,2})$', value.strip())
+    if not match:
+        return None
+
+    fields = [int(f) for f in match.group('fields').split(':')]
+
+    if match.group('days') is not None:
+        # D-HH[:MM[:SS]]
+        fields += [0]*(3 - len(fields))
+        hours, minutes, seconds = fields
+        hours += int(match.group('days'))*24
+    elif len(fields) == 3:
+        hours, minutes, seconds = fields
+    else:
+        # MM[:SS]
+        hours, (minutes, seconds) = 0, (fields + [0])[:2]
+
+    return (hours*60 + minutes)*60 + seconds
+
+
+def format_slurm_time(seconds):
+    """Format a duration in seconds as a Slurm time limit 'D-HH:MM:SS' (rounded up to minutes)"""
+
+    minutes = int(-(-seconds // 60))
+    return '{}-{:02d}:{:02d}:00'.format(minutes // (24*60), minutes // 60 % 24, minutes % 60)
+
+
+def script_time_limit(script_fn):
+    """The time limit in seconds requested by the #SBATCH directives of a batch script, None if unset"""
+
+    limit = None
+
+    try:
+        with open(script_fn, 'r') as fhandle:
+            for line in fhandle:
+                match = re.match(r'^#SBATCH\s+(?:--time[=\s]|-t\s*)\s*(\S+)', line)
+                if match:
+                    limit = parse_slurm_time(match.group(1))
+    except (OSError, IOError):
+        pass
+
+    return limit
+
+
+def command_dependencies(commands):
+    """Returns a dict command name -> set of names of the commands it has to wait for.
+
+    A command runs after the commands listed in its 'after' setting, or after the
+    previous command if it has none, which gives the plain sequential execution.
+    Raises a ValueError for unknown commands and cyclic dependencies."""
+
+    names = [c['name'] for c in commands]
+
+    dependencies = {}
+    for num, command in enumerate(commands):
+        if 'after' in command:
+            after = command['after']
+            unknown = set(after) - set(names)
+            if unknown:
+                raise ValueError("command '{}' is to run after the unknown command(s) {}".format(
+                    command['name'], ', '.join(sorted(unknown))))
+            dependencies[command['name']] = set(after)
+        else:
+            dependencies[command['name']] = {names[num-1]} if num else set()
+
+    # remove commands without unresolved dependencies until none are left
+    remaining = dict(dependencies)
+    while remaining:
+        ready = [n for n, deps in remaining.items() if not deps & set(remaining)]
+        if not ready:
+            raise ValueError("cyclic dependencies between the commands {}".format(', '.join(sorted(remaining))))
+        for name in ready:
+            del remaining[name]
+
+    return dependencies
+
+
+# the commands of local tasks running right now, and whether no further ones may be started
+_RUNNING_COMMANDS = set()
+_RUNNING_COMMANDS_LOCK = threading.Lock()
+_SHUTTING_DOWN = threading.Event()
+
+
+def kill_running_commands():
+    """Kill the process groups of all running commands and start no new ones.
+
+    The commands run in their own sessions and would be left behind otherwise
+    when the daemon gets interrupted."""
+
+    with _RUNNING_COMMANDS_LOCK:
+        _SHUTTING_DOWN.set()
+        procs = list(_RUNNING_COMMANDS)
+
+    if procs:
+        logger.warning("killing %d running command(s)", len(procs))
+
+    remaining = procs
+    for signum, grace_time in KILL_SIGNALS:
+        for proc in remaining:
+            try:
+                os.killpg(proc.pid, signum)
+            except (ProcessLookupError, PermissionError):
+                pass
+
+        deadline = time.time() + grace_time
+        while any(p.poll() is None for p in remaining) and time.time() < deadline:
+            time.sleep(0.1)
+
+        remaining = [p for p in remaining if p.poll() is None]
+        if not remaining:
+            break
+
+    # the leaders are gone, make sure no other processes of the groups survive
+    for proc in procs:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
 class RunnerBase:
     """The runner abstract base class"""
     __metaclass__ = ABCMeta
 
+    # whether run() blocks until the task terminated
+    blocking = False
+
+    # names of files in the task dir which get written when a detached task terminates
+    sentinels = ()
+
     """Base class to implement runners"""
     def __init__(self, settings, task_dir):
         self._settings = settings
@@ -36,6 +228,21 @@ class RunnerBase:
             }
         self.finished = False
         self.success = False
+        self.timed_out = False
+
+        # the state of the job in a batch system queue ('PENDING', 'RUNNING', ..) as seen
+        # by the last check() or run(), None if not queued (anymore) or unknown
+        self.queue_state = None
+
+        # the event log to record the external commands in, and the task id
+        # to record them for (to be set by the caller)
+        self.events = None
+        self.task_id = None
+
+    @classmethod
+    def local_cpus(cls, settings):  # pylint: disable=unused-argument
+        """The number of CPUs on the local host a task with the given settings occupies"""
+        return 0
 
     @abstractmethod
     def run(self, running_task_func):
@@ -53,6 +260,8 @@ class RunnerBase:
 class SlurmRunner(RunnerBase):
     """Runner implementation to run FATMAN tasks via SLURM"""
 
+    sentinels = ("slurm.out", "slurm.err")
+
     def __init__(self, *args, **kwargs):
         super(SlurmRunner, self).__init__(*args, **kwargs)
 
@@ -73,33 +282,73 @@ class SlurmRunner(RunnerBase):
 
         self._sbatch_out_fn = path.join(self._task_dir, "sbatch.out")
         self._sbatch_err_fn = path.join(self._task_dir, "sbatch.err")
+        self._job_info_fn = path.join(self._task_dir, "slurm.job")
+
+        # the time limit in seconds to request from Slurm, used instead of the
+        # one given in the batch script if shorter (to be set by the caller)
+        self.time_limit = None
+
+    def _load_job_info(self):
+        """Read the job ID and submission time stored by run(), returns None if unavailable"""
+
+        try:
+            with open(self._job_info_fn, 'r') as fhandle:
+                return json.load(fhandle)
+        except (OSError, IOError, ValueError):
+            return None
 
     def check(self):
         """Use squeue and sacct to check for the task."""
 
         tname = self._settings['name']
+        job_info = self._load_job_info()
+
+        if job_info:
+            self.data['runner']['jobid'] = job_info['jobid']
+            job_selector = ['--jobs=' + job_info['jobid']]
+        else:
+            # tasks submitted by an older fdaemon can only be found by their name
+            logger.warning("no job ID found for task %s, falling back to a lookup by name", tname)
+            job_selector = ['--name=' + tname]
 
         # squeue does not have a --parsable flag
         # what we want is: JOBID|STATE|TIME|NODES
-        squeue_out = subprocess.check_output(
-            ['squeue', '--noheader', '--format=%i|%T|%M|%D', '--name=' + tname])
+        try:
+            squeue_out = subprocess.check_output(
+                ['squeue', '--noheader', '--format=%i|%T|%M|%D'] + job_selector,
+                stderr=subprocess.PIPE, universal_newlines=True)
+        except subprocess.CalledProcessError as exc:
+            # squeue fails with an 'Invalid job id' if the job was already purged from the queue,
+            # anything else (like an unreachable controller) says nothing about the job
+            if not job_info or 'invalid job id' not in (exc.stderr or '').lower():
+                logger.error("squeue failed: %s", (exc.stderr or '').strip())
+                raise
+            squeue_out = ""
+
         squeue_out = squeue_out.strip()
 
         # TODO: we might want to store some data in the database:
         # jobid, state, time, nodes = squeue_out.split('|')
 
-        # Anyway, if the job is still in the slurm queue, we can expect it
-        # to be either pending, or running or to be terminated.
-        # In the latter case we catch eventually it in the next iteration
-        if squeue_out:
+        # if the job is still in the slurm queue and did not terminate, we check again in the next iteration
+        states = [line.split('|')[1] for line in squeue_out.split('\n') if line]
+        active = [state for state in states if state in SQUEUE_ACTIVE_STATES]
+        if active:
+            self.queue_state = active[0]
             return
 
-        # if the job isn't in the queue anymore, it is surely done
+        # if the job isn't in the queue anymore (or terminated already), it is surely done
         self.finished = True
 
+        sacct_cmd = ['sacct', '--parsable2', '--format=' + ','.join(SACCT_FIELDS)] + job_selector
+
+        # without a start time, sacct would scan the complete accounting history
+        if job_info:
+            sacct_cmd.append('--starttime=' + time.strftime(
+                '%Y-%m-%dT%H:%M:%S', time.localtime(job_info['submitted'] - SACCT_STARTTIME_MARGIN)))
+
         # Check the slurm database for more information
-        sacct_out = subprocess.check_output(
-            ['sacct', '--long', '--parsable2', '--name=' + tname])
+        sacct_out = subprocess.check_output(sacct_cmd, universal_newlines=True)
         sacct_lines = sacct_out.strip().split('\n')
 
         # we keep the header for this command to use the columns as keys
@@ -121,12 +370,22 @@ class SlurmRunner(RunnerBase):
         sacct_data = {d['jobname']: d for d in [dict(zip(headers, l.split('|'))) for l in sacct_lines[1:]]}
 
         # we are going to upload all metadata in the runner key
-        self.data['runner'] = {'commands': sacct_data}
+        self.data['runner']['commands'] = sacct_data
 
-        # check the parent job:
-        if sacct_data[tname]['state'] == 'COMPLETED':
+        # check the parent job, identified by the job ID if available
+        if job_info:
+            parent = [d for d in sacct_data.values() if d['jobid'] == job_info['jobid']]
+        else:
+            parent = [sacct_data[tname]]
+
+        if parent and parent[0]['state'] == 'COMPLETED':
             self.success = True
 
+        try:
+            self.data['runner']['walltime'] = parse_duration(parent[0]['elapsed'])
+        except (IndexError, KeyError, ValueError):
+            pass
+
         # try to extract errors from the sacct data
         for entry in self._settings['commands']:
             name = entry['name']
@@ -158,10 +417,41 @@ class SlurmRunner(RunnerBase):
                 ClientError("error when opening {}".format(exc.filename)),
                 exc)
 
+        sbatch_cmd = ['sbatch', "--parsable"]
+
+        # a shorter time limit lets Slurm backfill the job into gaps of the schedule
+        if self.time_limit:
+            script_limit = script_time_limit(path.join(self._task_dir, "run.sh"))
+            if not script_limit or self.time_limit < script_limit:
+                sbatch_cmd.append('--time=' + format_slurm_time(self.time_limit))
+                self.data['runner']['time_limit'] = self.time_limit
+
         try:
-            subprocess.check_call(['sbatch', "run.sh"],
-                                  stdout=stdout, stderr=stderr,
-                                  cwd=self._task_dir)
+            submitted = time.time()
+            returncode = subprocess.call(sbatch_cmd + ["run.sh"],
+                                         stdout=stdout, stderr=stderr,
+                                         cwd=self._task_dir)
+
+            if self.events is not None:
+                self.events.emit('command', self.task_id, name='sbatch', returncode=returncode,
+                                 duration=time.time() - submitted)
+
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, sbatch_cmd)
+
+            # with --parsable, sbatch prints '<jobid>[;<cluster>]'
+            with open(self._sbatch_out_fn, 'r') as fhandle:
+                jobid = fhandle.read().strip().split(';')[0]
+
+            self.queue_state = 'PENDING'
+
+            if jobid:
+                self.data['runner']['jobid'] = jobid
+                with open(self._job_info_fn, 'w') as fhandle:
+                    json.dump({'jobid': jobid, 'submitted': submitted}, fhandle)
+            else:
+                logger.warning("unable to determine the job ID from the sbatch output")
+
             running_task_func()
 
         except subprocess.CalledProcessError as exc:
@@ -191,9 +481,38 @@ class SlurmRunner(RunnerBase):
 class DirectRunner(RunnerBase):
     """A runner to directly run jobs (in a blocking manner)"""
 
+    blocking = True
+
     def __init__(self, *args, **kwargs):
         super(DirectRunner, self).__init__(*args, **kwargs)
 
+        # the set of CPUs to pin the processes to (assigned by the daemon), None to not pin them
+        self.cpuset = None
+
+        # the cgroup to run the processes in (assigned by the daemon), None to not use one
+        self.cgroup = None
+
+        # the memory limit in bytes, only enforced if running in a cgroup, None means unlimited
+        self.memory_limit = parse_size(self._settings.get('memory'))
+
+        # time limits in seconds for the complete task and for the time without output growing,
+        # commands may specify their own 'walltime' in addition, None means unlimited
+        self.walltime = parse_duration(self._settings.get('walltime'))
+        self.stall_timeout = parse_duration(self._settings.get('stall_timeout'))
+
+        # fail invalid settings before anything gets started
+        for entry in self._settings['commands']:
+            parse_duration(entry.get('walltime'))
+
+        # the number of commands run at the same time if their dependencies permit, each
+        # command may use all CPUs of the task, so only one at a time unless specified
+        self.max_parallel_commands = int(self._settings.get('max_parallel_commands') or 1)
+
+    @classmethod
+    def local_cpus(cls, settings):
+        variables = settings.get('environment', {}).get('variables', {})
+        return int(variables.get('OMP_NUM_THREADS', 1))
+
     def check(self):
         """This is a blocking runner and check() is only called when the event loop encounters
            a task for this machine in a 'running' state, which basically means that we crashed
@@ -223,7 +542,31 @@ class DirectRunner(RunnerBase):
         # no matter how we exit this function, the task will have terminated
         self.finished = True
 
-        mod_env_changes = ""
+        env = self._command_env()
+
+        self.data['runner']['commands'] = {}
+
+        if self.cpuset:
+            self.data['runner']['cpuset'] = format_cpulist(self.cpuset)
+
+        start = time.time()
+
+        try:
+            self._run_commands(env)
+        finally:
+            self.data['runner']['walltime'] = time.time() - start
+            if self.cgroup is not None:
+                self._record_cgroup_stats()
+
+        self.success = True
+
+    def _command_env(self):
+        """The environment for the commands: ours with the variables from the settings,
+        modified by loading the modules from the settings"""
+
+        env = dict(os.environ)
+        env.update({k: str(v) for k, v in self._settings['environment'].get('variables', {}).items()})
+
         modules = self._settings['environment'].get('modules', [])
 
         if modules:
@@ -231,77 +574,249 @@ class DirectRunner(RunnerBase):
                 mod_env_changes = subprocess.check_output(
                     map(str, ['modulecmd', 'python', 'load'] + modules),  # pylint: disable=locally-disabled,bad-builtin
                     stderr=devnull)
-                # TODO: add check to ensure mod_env_changes
-                #       contains only assignments for os.environ
 
-        def preexec_fn():
-            '''pre-exec function for further Popen calls to load
-            the environment as specified by the user.
+            # apply the changes (Python code modifying os.environ) in a separate interpreter,
+            # to neither alter the environment of fdaemon nor run Python code in forked children
+            env = json.loads(subprocess.check_output(
+                [sys.executable, '-c',
+                 'import os, sys, json; exec(sys.stdin.read()); print(json.dumps(dict(os.environ)))'],
+                input=mod_env_changes, env=env))
 
-            we are injecting  the environment variables here instead
-            of using Popen's env= to inherit the parent environment first'''
+        return env
 
-            os.environ.update({k: str(v) for k, v in (self._settings['environment']
-                                                      .get('variables', {})
-                                                      .items())})
-            exec_(mod_env_changes)
+    def _record_cgroup_stats(self):
+        """Add the resource usage of the task to the runner data, and an error if it ran out of memory"""
 
-        self.data['runner']['commands'] = {}
+        stats = self.cgroup.stats()
+        self.data['runner']['cgroup'] = stats
 
-        for entry in self._settings['commands']:
-            name = entry['name']
-            stdout_fn = path.join(self._task_dir, "{}.out".format(name))
-            stderr_fn = path.join(self._task_dir, "{}.err".format(name))
+        if stats.get('oom_kills'):
+            self.data['errors'].append({
+                'tag': 'runner',
+                'entry': 'cgroup',
+                'msg': "task exceeded its memory limit of {} bytes, {} process(es) got killed".format(
+                    stats.get('memory_limit'), stats['oom_kills']),
+                })
+
+    def _run_commands(self, env):
+        """Run the commands in the order given by their dependencies, up to max_parallel_commands
+        at the same time. No further commands are started after one failed, and the error of
+        the first failing one is raised after the running ones terminated."""
+
+        task_deadline = time.time() + self.walltime if self.walltime else None
 
-            d_resp = {
+        commands = self._settings['commands']
+
+        try:
+            dependencies = command_dependencies(commands)
+        except ValueError as exc:
+            self.data['errors'].append({
                 'tag': 'commands',
-                'entry': name,
+                'entry': 'after',
+                'msg': str(exc),
+                })
+            raise
+
+        pending = list(commands)
+        running = {}  # future -> command name
+        terminated = set()
+        failure = None
+
+        with ThreadPoolExecutor(max_workers=max(self.max_parallel_commands, 1)) as executor:
+            while True:
+                if failure is None:
+                    for entry in [e for e in pending if dependencies[e['name']] <= terminated]:
+                        if len(running) >= self.max_parallel_commands:
+                            break
+                        pending.remove(entry)
+                        running[executor.submit(self._run_command, entry, env, task_deadline)] = entry['name']
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    terminated.add(running.pop(future))
+                    if future.exception() is not None and failure is None:
+                        failure = future.exception()
+
+        if failure is not None:
+            raise failure
+
+    def _run_command(self, entry, env, task_deadline):
+        """Run a single command, raises if it failed (unless its return code is to be ignored)"""
+
+        name = entry['name']
+        stdout_fn = path.join(self._task_dir, "{}.out".format(name))
+        stderr_fn = path.join(self._task_dir, "{}.err".format(name))
+
+        d_resp = {
+            'tag': 'commands',
+            'entry': name,
+            }
+
+        logger.info("running command %s", name)
+
+        # validated by the constructor already
+        command_walltime = parse_duration(entry.get('walltime'))
+
+        try:
+            stdout = open(stdout_fn, 'w')
+            stderr = open(stderr_fn, 'w')
+        except (OSError, IOError) as exc:
+            raise_from(
+                ClientError("error when opening {}".format(exc.filename)),
+                exc)
+
+        start = time.time()
+        returncode = None
+
+        deadlines = [task_deadline]
+        if command_walltime:
+            deadlines.append(start + command_walltime)
+        deadline = min([d for d in deadlines if d is not None] or [None])
+
+        try:
+            cmdline = list(map(str, [entry['cmd']] + entry['args']))  # pylint: disable=locally-disabled,bad-builtin
+            returncode = self._execute(cmdline, stdout, stderr, env, deadline)
+
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, cmdline)
+
+        except subprocess.CalledProcessError as exc:
+            d_resp['msg'] = "command terminated with non-zero exit status"
+            d_resp['returncode'] = exc.returncode
+
+            if entry.get('ignore_returncode', False):
+                self.data['warnings'].append(d_resp)
+            else:
+                self.data['errors'].append(d_resp)
+                raise
+
+        except TimeLimitExceeded as exc:
+            d_resp['msg'] = str(exc)
+            self.data['errors'].append(d_resp)
+            self.data['runner']['timeout'] = {
+                'reason': exc.reason,
+                'limit': exc.limit,
+                'command': name,
                 }
+            self.timed_out = True
+            raise
+
+        except Exception as exc:
+            d_resp['msg'] = "error occurred while running: {}".format(exc)
+            self.data['errors'].append(d_resp)
+            raise
+
+        finally:
+            stdout.close()
+            stderr.close()
+            self.outfiles.add(stdout_fn)
+            self.outfiles.add(stderr_fn)
+
+            self.data['runner']['commands'][name] = {
+                'walltime': time.time() - start,
+                }
+
+            if self.events is not None:
+                self.events.emit('command', self.task_id, name=name, returncode=returncode,
+                                 duration=time.time() - start)
+
+    def _output_progress(self):
+        """Returns the total size and latest modification time of the files in the task dir"""
+
+        size = 0
+        mtime = 0
+        for entry in os.scandir(self._task_dir):
+            if entry.is_file():
+                stat = entry.stat()
+                size += stat.st_size
+                mtime = max(mtime, stat.st_mtime)
+
+        return size, mtime
 
-            logger.info("running command %s", name)
+    @staticmethod
+    def _kill(proc):
+        """Kill the process group of the given process with escalating signals"""
 
+        for signum, grace_time in KILL_SIGNALS:
             try:
-                stdout = open(stdout_fn, 'w')
-                stderr = open(stderr_fn, 'w')
-            except (OSError, IOError) as exc:
-                raise_from(
-                    ClientError("error when opening {}".format(exc.filename)),
-                    exc)
+                os.killpg(proc.pid, signum)
+            except (ProcessLookupError, PermissionError):
+                break
 
-            start = time.time()
+            try:
+                proc.wait(grace_time)
+            except subprocess.TimeoutExpired:
+                continue
 
+            # the leader is gone, make sure no other processes of the group survive
             try:
-                subprocess.check_call(
-                    map(str, [entry['cmd']] + entry['args']),  # pylint: disable=locally-disabled,bad-builtin
-                    stdout=stdout, stderr=stderr,
-                    cwd=self._task_dir, preexec_fn=preexec_fn)
-
-            except subprocess.CalledProcessError as exc:
-                d_resp['msg'] = "command terminated with non-zero exit status"
-                d_resp['returncode'] = exc.returncode
-
-                if entry.get('ignore_returncode', False):
-                    self.data['warnings'].append(d_resp)
-                else:
-                    self.data['errors'].append(d_resp)
-                    raise
-
-            except Exception as exc:
-                d_resp['msg'] = "error occurred while running: {}".format(exc)
-                self.data['errors'].append(d_resp)
-                raise
+                os.killpg(proc.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            break
 
-            finally:
-                stdout.close()
-                stderr.close()
-                self.outfiles.add(stdout_fn)
-                self.outfiles.add(stderr_fn)
+        proc.wait()
 
-                self.data['runner']['commands'][name] = {
-                    'walltime': time.time() - start,
-                    }
+    def _execute(self, cmdline, stdout, stderr, env, deadline):
+        """Run a command in its own process group and wait for it while enforcing the deadline
+           and the stall timeout, returns the exit status"""
 
-        self.success = True
+        if self.cpuset:
+            # only pins the calling thread (a worker of _run_commands), the command inherits it
+            os.sched_setaffinity(0, self.cpuset)
+
+        with _RUNNING_COMMANDS_LOCK:
+            if _SHUTTING_DOWN.is_set():
+                raise ClientError("not starting command {}, shutting down".format(cmdline[0]))
+
+            start = time.time()
+            proc = subprocess.Popen(self.cgroup.wrap(cmdline) if self.cgroup is not None else cmdline,
+                                    stdout=stdout, stderr=stderr, cwd=self._task_dir, env=env,
+                                    start_new_session=True)
+            _RUNNING_COMMANDS.add(proc)
+
+        try:
+            progress = self._output_progress()
+            last_change = start
+
+            while True:
+                timeout = POLL_INTERVAL
+                if deadline is not None:
+                    timeout = max(min(timeout, deadline - time.time()), 0)
+
+                try:
+                    return proc.wait(timeout)
+                except subprocess.TimeoutExpired:
+                    pass
+
+                now = time.time()
+
+                if deadline is not None and now >= deadline:
+                    logger.warning("command %s exceeded its walltime, killing it", cmdline[0])
+                    self._kill(proc)
+                    raise TimeLimitExceeded('walltime', deadline - start)
+
+                if self.stall_timeout:
+                    current = self._output_progress()
+                    if current != progress:
+                        progress, last_change = current, now
+                    elif now - last_change > self.stall_timeout:
+                        logger.warning("command %s stalled, killing it", cmdline[0])
+                        self._kill(proc)
+                        raise TimeLimitExceeded('stall', self.stall_timeout)
+
+        except BaseException:
+            if proc.poll() is None:
+                self._kill(proc)
+            raise
+
+        finally:
+            with _RUNNING_COMMANDS_LOCK:
+                _RUNNING_COMMANDS.discard(proc)
 
 
 class MPIRunner(DirectRunner):
@@ -309,6 +824,10 @@ class MPIRunner(DirectRunner):
        This re-uses the direct runner, by patching the settings to prefix them with the mpirun options.
     """
 
+    # mpirun options to bind each rank to as many of the assigned CPUs as it has OpenMP threads
+    # (Open MPI syntax), can be overridden by the machine settings (key: 'bind_args')
+    bind_args = ['--cpu-set', '{cpuset}', '--map-by', 'slot:PE={threads}', '--bind-to', 'core']
+
     def __init__(self, *args, **kwargs):
         super(MPIRunner, self).__init__(*args, **kwargs)
 
@@ -320,3 +839,20 @@ class MPIRunner(DirectRunner):
             # the new arguments are all passed to mpirun
             command['args'] = runner_args + [command['cmd']] + command['args']
             command['cmd'] = "mpirun"
+
+    @classmethod
+    def local_cpus(cls, settings):
+        runner_args = settings.get('machine', {}).get('runner_args', {})
+        nprocs = runner_args.get('np', runner_args.get('n', 1))
+        return int(nprocs) * super(MPIRunner, cls).local_cpus(settings)
+
+    def run(self, running_task_func):
+        if self.cpuset:
+            threads = DirectRunner.local_cpus(self._settings)
+            bind_args = [a.format(cpuset=format_cpulist(self.cpuset), threads=threads)
+                         for a in self._settings['machine'].get('bind_args', self.bind_args)]
+
+            for command in self._settings['commands']:
+                command['args'] = bind_args + command['args']
+
+        super(MPIRunner, self).run(running_task_func)
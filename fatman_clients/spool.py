@@ -0,0 +1,163 @@
+"""Durable spool of requests to the server, replayed in order once it is reachable again"""
+
+import os
+import json
+import fcntl
+import logging
+import contextlib
+from os import path
+
+import requests
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+# HTTP status codes of a server (or proxy in front of it) which is temporarily unavailable
+TRANSIENT_STATUS_CODES = (502, 503, 504)
+
+
+def is_transient(exc):
+    """Whether a requests exception means that the server is (temporarily) unreachable"""
+
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+
+    response = getattr(exc, 'response', None)
+    return response is not None and response.status_code in TRANSIENT_STATUS_CODES
+
+
+class Spool(object):
+    """Operations for the server (like the final status update and the uploads of a task),
+    kept on disk while the server is unreachable.
+
+    Each entry is a list of operations for one task, stored as `<sequence>-<task id>.json`.
+    Entries are replayed in the order they were added, and completed operations are
+    removed from an entry right away, to not repeat uploads after an interruption.
+    Entries failing for other reasons than the server being unreachable are moved
+    to the 'failed' subdirectory for inspection, to not block the following ones.
+    Several daemons may share the spool, adding and replaying entries is serialized.
+    """
+
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        self.failed_dir = path.join(spool_dir, 'failed')
+
+        for dirpath in (self.spool_dir, self.failed_dir):
+            if not path.exists(dirpath):
+                os.makedirs(dirpath)
+
+    @contextlib.contextmanager
+    def _lock(self):
+        fdesc = os.open(path.join(self.spool_dir, '.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fdesc, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fdesc)
+
+    def _entries(self):
+        """The entry file names in order"""
+        return sorted((f for f in os.listdir(self.spool_dir) if f.endswith('.json')),
+                      key=lambda f: int(f.split('-', 1)[0]))
+
+    def __len__(self):
+        return len(self._entries())
+
+    def has(self, task_id):
+        """Whether there are spooled operations for the given task"""
+        return any(f.split('-', 1)[1] == '{}.json'.format(task_id) for f in self._entries())
+
+    def has_failed(self, task_id):
+        """Whether there are failed operations for the given task"""
+        return any(f.split('-', 1)[1] == '{}.json'.format(task_id)
+                   for f in os.listdir(self.failed_dir) if f.endswith('.json'))
+
+    def _save(self, entry_fn, ops):
+        tmp_fn = path.join(self.spool_dir, '.' + entry_fn + '.tmp')
+        with open(tmp_fn, 'w') as fhandle:
+            json.dump(ops, fhandle)
+            fhandle.flush()
+            os.fsync(fhandle.fileno())
+        os.rename(tmp_fn, path.join(self.spool_dir, entry_fn))
+
+    def add(self, task_id, ops):
+        """Append the operations for a task to the spool"""
+
+        with self._lock():
+            entries = self._entries()
+            seq = int(entries[-1].split('-', 1)[0]) + 1 if entries else 1
+            self._save('{:08d}-{}.json'.format(seq, task_id), ops)
+
+    def add_failed(self, task_id, ops):
+        """Keep operations which failed for other reasons than the server being unreachable"""
+
+        with self._lock():
+            entries = self._entries() + [f for f in os.listdir(self.failed_dir) if f.endswith('.json')]
+            seq = max([int(f.split('-', 1)[0]) for f in entries] or [0]) + 1
+            entry_fn = '{:08d}-{}.json'.format(seq, task_id)
+            self._save(entry_fn, ops)
+            os.rename(path.join(self.spool_dir, entry_fn), path.join(self.failed_dir, entry_fn))
+
+    def submit(self, task_id, ops, execute):
+        """Execute the operations, spooling them (and all following ones) if the server is
+        unreachable. Operations are also spooled as long as there are spooled ones already,
+        to keep the order.
+
+        :param execute: called with each operation, returns the response
+        :returns: the response of the last operation, None if spooled
+        """
+
+        if self._entries():
+            self.add(task_id, ops)
+            return None
+
+        response = None
+        for num, oper in enumerate(ops):
+            try:
+                response = execute(oper)
+            except requests.exceptions.RequestException as exc:
+                if not is_transient(exc):
+                    raise
+
+                logger.warning("task %s: server unreachable, spooling %d operation(s): %s",
+                               task_id, len(ops) - num, exc)
+                self.add(task_id, ops[num:])
+                return None
+
+        return response
+
+    def replay(self, execute):
+        """Execute the spooled operations in order, returns False if the server is still unreachable"""
+
+        with self._lock():
+            return self._replay(execute)
+
+    def _replay(self, execute):
+        for entry_fn in self._entries():
+            task_id = entry_fn.split('-', 1)[1][:-len('.json')]
+
+            with open(path.join(self.spool_dir, entry_fn), 'r') as fhandle:
+                ops = json.load(fhandle)
+
+            logger.info("task %s: replaying %d spooled operation(s)", task_id, len(ops))
+
+            while ops:
+                try:
+                    execute(ops[0])
+                except Exception as exc:  # pylint: disable=broad-except
+                    if isinstance(exc, requests.exceptions.RequestException) and is_transient(exc):
+                        logger.info("server still unreachable, keeping %d spooled entries", len(self))
+                        return False
+
+                    logger.exception("task %s: spooled operation failed, moving the entry to '%s'",
+                                     task_id, self.failed_dir)
+                    os.rename(path.join(self.spool_dir, entry_fn), path.join(self.failed_dir, entry_fn))
+                    break
+
+                ops.pop(0)
+
+                if ops:
+                    self._save(entry_fn, ops)
+                else:
+                    os.unlink(path.join(self.spool_dir, entry_fn))
+
+        return True
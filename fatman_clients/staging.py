@@ -0,0 +1,144 @@
+"""Staging of task input files, re-using already downloaded and verified files"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+from os import path
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+# records size, modification time and checksum of the downloaded inputs in the task dir,
+# the leading dot keeps it from being matched by the output artifact patterns
+MANIFEST_NAME = '.fdaemon-inputs.json'
+
+# hash algorithms by length of the hex digest, for checksums without algorithm prefix
+DIGEST_LENGTHS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+
+def parse_checksum(value):
+    """Split a checksum like 'sha256:0123..' (or a plain hex digest) into (algorithm, hexdigest),
+    returns None if the checksum is not usable"""
+
+    if not value:
+        return None
+
+    if ':' in value:
+        algo, digest = value.split(':', 1)
+        algo = algo.lower().replace('-', '')
+    else:
+        digest = value
+        algo = DIGEST_LENGTHS.get(len(value))
+
+    if algo not in hashlib.algorithms_available:
+        return None
+
+    return algo, digest.lower()
+
+
+def file_checksum(filepath, algo, blocksize=1024*1024):
+    """Compute the hex digest of a file"""
+
+    hasher = hashlib.new(algo)
+    with open(filepath, 'rb') as fhandle:
+        for block in iter(lambda: fhandle.read(blocksize), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def load_manifest(task_dir):
+    """Read the manifest of a task dir, an empty dict if missing or invalid"""
+
+    try:
+        with open(path.join(task_dir, MANIFEST_NAME), 'r') as fhandle:
+            return json.load(fhandle)
+    except (OSError, IOError, ValueError):
+        return {}
+
+
+def save_manifest(task_dir, manifest):
+    """Write the manifest of a task dir"""
+
+    tmp_fn = path.join(task_dir, MANIFEST_NAME + '.tmp')
+    with open(tmp_fn, 'w') as fhandle:
+        json.dump(manifest, fhandle)
+    os.rename(tmp_fn, path.join(task_dir, MANIFEST_NAME))
+
+
+def manifest_entry(filepath, checksum=None):
+    """Build the manifest entry for a file, checksum being a tuple (algorithm, hexdigest)"""
+
+    stat = os.stat(filepath)
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'checksum': '{}:{}'.format(*checksum) if checksum else None,
+        }
+
+
+def is_staged(task_dir, infile, manifest):
+    """Whether the input file is present in the task dir and matches the server's metadata.
+
+    Files are only re-hashed if they changed since they were recorded in the manifest."""
+
+    filepath = path.join(task_dir, infile['name'])
+
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return False
+
+    # without any metadata to compare against, we can not trust the file
+    checksum = parse_checksum(infile.get('checksum'))
+    if infile.get('size') is None and checksum is None:
+        return False
+
+    if infile.get('size') is not None and stat.st_size != infile['size']:
+        return False
+
+    if checksum is None:
+        return True
+
+    algo, digest = checksum
+    recorded = manifest.get(infile['name'], {})
+
+    if (recorded.get('size') == stat.st_size and recorded.get('mtime_ns') == stat.st_mtime_ns
+            and recorded.get('checksum') == '{}:{}'.format(algo, digest)):
+        return True
+
+    return file_checksum(filepath, algo) == digest
+
+
+def prepare_task_dir(task_dir, infiles):
+    """Create the task dir or clean up an existing one, keeping only input files which
+    are verified to be identical to the ones on the server.
+
+    :returns: the list of infiles which have to be downloaded
+    """
+
+    if not path.exists(task_dir):
+        os.mkdir(task_dir)
+        return list(infiles)
+
+    manifest = load_manifest(task_dir)
+    staged = {i['name'] for i in infiles if is_staged(task_dir, i, manifest)}
+
+    # remove everything else, like outputs of a previous (partial) run
+    for entry in os.scandir(task_dir):
+        if entry.name in staged:
+            continue
+
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.unlink(entry.path)
+
+    save_manifest(task_dir, {i['name']: manifest_entry(path.join(task_dir, i['name']),
+                                                       parse_checksum(i.get('checksum')))
+                             for i in infiles if i['name'] in staged})
+
+    if staged:
+        logger.info("re-using %d already staged input file(s) in '%s'", len(staged), task_dir)
+
+    return [i for i in infiles if i['name'] not in staged]
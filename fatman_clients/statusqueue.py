@@ -0,0 +1,134 @@
+"""Batching of task status updates to reduce the number of requests to the server"""
+
+import time
+import logging
+from collections import OrderedDict
+
+import requests
+
+from .spool import is_transient
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+# the maximum number of task updates sent in one bulk request
+MAX_BATCH_SIZE = 100
+
+# HTTP status codes besides the client errors (4xx) meaning that the server does not support bulk updates
+UNSUPPORTED_STATUS_CODES = (501,)
+
+
+class StatusQueue(object):
+    """Collects status updates of tasks for up to `window` seconds and sends them at once.
+
+    Updates for the same task are merged, a later status superseding the previous one
+    (a task finishing before its 'running' update was sent is only set to 'done').
+    All updates are sent with one bulk PATCH of the task collection (a list of partial
+    task objects including their id) if the server supports it, and one PATCH per task
+    otherwise. Updates go through the spool, if there are spooled operations already
+    or the server is unreachable.
+    """
+
+    def __init__(self, bulk_url, spool, execute, window=0, on_update=None):
+        """
+        :param bulk_url: the URL of the task collection for bulk updates, None to not use them
+        :param execute: function executing a spool operation, returns the response
+        :param window: the time in seconds updates may be held back, 0 to send them right away
+        :param on_update: called with each updated task object returned by the server
+        """
+
+        self._bulk_url = bulk_url
+        self._spool = spool
+        self._execute = execute
+        self._window = window
+        self._on_update = on_update
+
+        self._updates = OrderedDict()  # task id -> (url, fields)
+        self._since = None
+
+        self.sent_requests = 0
+        self.sent_updates = 0
+
+    def __len__(self):
+        return len(self._updates)
+
+    def __contains__(self, task_id):
+        return task_id in self._updates
+
+    def put(self, task_id, url, fields):
+        """Queue an update of the given fields of a task, sent at the latest after the window"""
+
+        if task_id in self._updates:
+            merged = dict(self._updates.pop(task_id)[1])
+            merged.update(fields)
+            logger.debug("task %s: coalescing status update %s", task_id, merged.get('status'))
+            fields = merged
+
+        self._updates[task_id] = (url, fields)
+
+        if self._since is None:
+            self._since = time.time()
+
+        self.flush_due()
+
+    def flush_due(self):
+        """Send the queued updates if the oldest one waited for the window already"""
+        if self._updates and time.time() - self._since >= self._window:
+            self.flush()
+
+    def flush(self):
+        """Send all queued updates"""
+
+        updates, self._updates, self._since = self._updates, OrderedDict(), None
+
+        items = list(updates.items())
+        while items:
+            batch, items = items[:MAX_BATCH_SIZE], items[MAX_BATCH_SIZE:]
+
+            # only bypass the spool if there is nothing in there (to keep the order)
+            if self._bulk_url and len(batch) > 1 and not len(self._spool):
+                try:
+                    self._send_bulk(batch)
+                    continue
+                except requests.exceptions.RequestException as exc:
+                    if isinstance(exc, requests.exceptions.HTTPError) and (
+                            400 <= exc.response.status_code < 500
+                            or exc.response.status_code in UNSUPPORTED_STATUS_CODES):
+                        logger.info("bulk status updates rejected, sending them per task from now on: %s", exc)
+                        self._bulk_url = None
+                    elif not is_transient(exc):
+                        # let the updates of the other tasks not fail with the one causing this
+                        logger.warning("bulk status update failed, sending the updates per task: %s", exc)
+
+            for task_id, (url, fields) in batch:
+                ops = [{'op': 'patch', 'url': url, 'json': fields}]
+                try:
+                    req = self._spool.submit(task_id, ops, self._execute)
+                except requests.exceptions.RequestException:
+                    # keep it, the task must not be handled again as if the update was never made
+                    logger.exception("task %s: status update to '%s' failed, keeping it in '%s'",
+                                     task_id, fields.get('status'), self._spool.failed_dir)
+                    self._spool.add_failed(task_id, ops)
+                    continue
+
+                if req is None:
+                    continue  # spooled
+
+                self.sent_requests += 1
+                self.sent_updates += 1
+                if self._on_update:
+                    self._on_update(req.json())
+
+    def _send_bulk(self, batch):
+        req = self._execute({
+            'op': 'patch',
+            'url': self._bulk_url,
+            'json': [dict(fields, id=task_id) for task_id, (_, fields) in batch],
+            })
+
+        self.sent_requests += 1
+        self.sent_updates += len(batch)
+        logger.debug("sent %d status updates in one request", len(batch))
+
+        if self._on_update:
+            for task in req.json():
+                self._on_update(task)
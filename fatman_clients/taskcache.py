@@ -0,0 +1,89 @@
+"""Local cache of task objects to avoid re-fetching unchanged tasks"""
+
+import logging
+
+import requests
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+
+class TaskCache(object):
+    """Caches the complete task objects fetched from the server.
+
+    A task is only fetched again if the modification time in the (abbreviated) task
+    listing differs from the cached one. Without modification times, or for other
+    resources like the listing itself, conditional requests are used if the server
+    sends an ETag, which at least avoids transferring unchanged content again."""
+
+    def __init__(self, sess):
+        self._sess = sess
+        self._tasks = {}  # task id -> (task object, etag)
+        self._responses = {}  # url -> (etag, json content)
+
+        self.hits = 0
+        self.misses = 0
+
+    def fetch(self, url, params=None):
+        """GET the JSON content of url, using a conditional request if possible"""
+
+        key = requests.Request('GET', url, params=params).prepare().url
+
+        headers = {}
+        if key in self._responses:
+            headers['If-None-Match'] = self._responses[key][0]
+
+        req = self._sess.get(url, params=params, headers=headers)
+
+        if req.status_code == 304 and key in self._responses:
+            self.hits += 1
+            return self._responses[key][1]
+
+        req.raise_for_status()
+        content = req.json()
+
+        etag = req.headers.get('ETag')
+        if etag:
+            self._responses[key] = (etag, content)
+
+        return content
+
+    def task(self, entry):
+        """Returns the complete task object for the given task listing entry"""
+
+        cached, etag = self._tasks.get(entry['id'], (None, None))
+
+        if cached is not None and entry.get('mtime') and cached.get('mtime') == entry['mtime']:
+            logger.debug("task %s: unchanged, using cached object", entry['id'])
+            self.hits += 1
+            return cached
+
+        headers = {'If-None-Match': etag} if etag else {}
+        req = self._sess.get(entry['_links']['self'], headers=headers)
+
+        if req.status_code == 304 and cached is not None:
+            self.hits += 1
+            return cached
+
+        req.raise_for_status()
+        self.misses += 1
+
+        task = req.json()
+        self._tasks[task['id']] = (task, req.headers.get('ETag'))
+        return task
+
+    def update(self, task):
+        """Store a task object received otherwise (for example as response to a PATCH)"""
+        self._tasks[task['id']] = (task, None)
+
+    def discard(self, task_id):
+        """Remove a task from the cache"""
+        self._tasks.pop(task_id, None)
+
+    def prune(self, task_ids):
+        """Remove all tasks from the cache except the given ones"""
+        for task_id in set(self._tasks) - set(task_ids):
+            del self._tasks[task_id]
+
+    def tasks(self):
+        """The cached task objects, for example to continue working while the server is unreachable"""
+        return [task for task, _ in self._tasks.values()]
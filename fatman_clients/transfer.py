@@ -0,0 +1,474 @@
+"""Transfers between the clients and the FATMAN server, optionally bandwidth-limited"""
+
+import os
+import json
+import time
+import base64
+import hashlib
+import logging
+import threading
+from os import path
+
+import requests
+
+from .multipart import MultipartEncoder
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+# the maximal number of bytes read (and accounted for) at once
+CHUNK_SIZE = 64*1024
+
+# the default size of the buffer downloads are read into and written from
+DOWNLOAD_BUFFER_SIZE = 4*1024*1024
+
+# when to fsync downloaded files: never, the file before renaming it into place,
+# or in addition the directory after renaming (to make the rename itself durable)
+FSYNC_POLICIES = ('none', 'file', 'full')
+
+# failed attempts in a row without progress (including restarts of lost sessions) after which
+# a resumable upload is given up, to be resumed later from the spool if the server is unreachable
+UPLOAD_RETRIES = 5
+
+# seconds to wait before retrying a failed attempt
+RETRY_DELAY = 2
+
+# HTTP status codes which mean the server does not want the upload at all
+FATAL_STATUS_CODES = (401, 403, 413)
+
+# records the open upload sessions of a task dir, to resume them after a restart
+UPLOAD_SESSIONS_NAME = '.fdaemon-uploads.json'
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket to limit the rate of transferred bytes.
+
+    Consumers flagged as priority are served first: while one of them is waiting
+    for tokens, the other consumers do not get any."""
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: the sustained rate in bytes per second
+        :param burst: the bucket size in bytes (default: the amount for one second)
+        """
+
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, CHUNK_SIZE))
+
+        self._tokens = self.burst
+        self._last = time.time()
+        self._priority_waiting = 0
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._last)*self.rate)
+        self._last = now
+
+    def consume(self, amount, priority=False):
+        """Block until amount tokens (bytes) are available and take them"""
+
+        # requests larger than the bucket are served in bucket-sized portions
+        while amount > self.burst:
+            self.consume(self.burst, priority)
+            amount -= self.burst
+
+        with self._cond:
+            if priority:
+                self._priority_waiting += 1
+
+            try:
+                while True:
+                    self._refill()
+
+                    if self._tokens >= amount and (priority or not self._priority_waiting):
+                        self._tokens -= amount
+                        return
+
+                    missing = max(amount - self._tokens, 0)
+                    self._cond.wait(max(missing / self.rate, 0.01))
+
+            finally:
+                if priority:
+                    self._priority_waiting -= 1
+                    self._cond.notify_all()
+
+
+class ThrottledReader(object):
+    """A file-like wrapper reading at most CHUNK_SIZE bytes at once and taking
+    tokens for them from all given buckets.
+
+    Having a length and being iterable makes requests stream it as the request body."""
+
+    def __init__(self, fhandle, length, buckets=(), priority=False):
+        self._fhandle = fhandle
+        self._remaining = length
+        self._buckets = [b for b in buckets if b is not None]
+        self._priority = priority
+
+    def __len__(self):
+        return self._remaining
+
+    def read(self, size=-1):
+        """Read at most size bytes, blocking as needed by the buckets"""
+
+        if size is None or size < 0 or size > CHUNK_SIZE:
+            size = CHUNK_SIZE
+
+        # never read beyond the announced length, the file might be read in several parts
+        size = min(size, self._remaining)
+        if size <= 0:
+            return b''
+
+        data = self._fhandle.read(size)
+
+        for bucket in self._buckets:
+            bucket.consume(len(data), self._priority)
+
+        self._remaining -= len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+
+class TransferPolicy(object):
+    """Bandwidth limits (in bytes per second) for the transfers of a daemon.
+
+    The upload and download limits are shared by all transfers, while bulk transfers
+    (larger than bulk_threshold bytes) are in addition limited to bulk_limit each
+    and yield to the smaller, result-critical ones.
+
+    Uploads larger than chunked_threshold are done in resumable chunks of chunk_size bytes,
+    if the server supports it."""
+
+    def __init__(self, upload_limit=None, download_limit=None, bulk_limit=None, bulk_threshold=None,
+                 chunked_threshold=None, chunk_size=None):
+        self.upload_bucket = TokenBucket(upload_limit) if upload_limit else None
+        self.download_bucket = TokenBucket(download_limit) if download_limit else None
+        self.bulk_limit = bulk_limit
+        self.bulk_threshold = bulk_threshold
+        self.chunked_threshold = chunked_threshold
+        self.chunk_size = chunk_size
+
+    def is_bulk(self, size):
+        """Whether a transfer of the given size is considered a bulk transfer"""
+        return self.bulk_threshold is not None and size > self.bulk_threshold
+
+    def is_chunked(self, size):
+        """Whether an upload of the given size should be done in resumable chunks"""
+        return self.chunked_threshold is not None and size > self.chunked_threshold
+
+    def upload_buckets(self, size):
+        """Returns the buckets and the priority flag for an upload of the given size"""
+
+        if not self.is_bulk(size):
+            return [self.upload_bucket], True
+
+        return [self.upload_bucket, TokenBucket(self.bulk_limit) if self.bulk_limit else None], False
+
+    def download_buckets(self, size=None):
+        """Returns the buckets and the priority flag for a download of the given size (if known)"""
+
+        if size is None or not self.is_bulk(size):
+            return [self.download_bucket], True
+
+        return [self.download_bucket, TokenBucket(self.bulk_limit) if self.bulk_limit else None], False
+
+
+class TransferStats(object):
+    """Amount and duration of a completed transfer"""
+
+    def __init__(self, nbytes, elapsed):
+        self.nbytes = nbytes
+        self.elapsed = elapsed
+
+    @property
+    def rate(self):
+        """The average rate in bytes per second"""
+        return self.nbytes / self.elapsed if self.elapsed > 0 else float('inf')
+
+    def __str__(self):
+        return "{} bytes in {:.3f}s, {:.1f} MiB/s".format(self.nbytes, self.elapsed, self.rate / 2**20)
+
+
+def _body_reader(req, buffer_size):
+    """Returns a function reading the response body into a given buffer, returning the number
+    of bytes read (0 at the end)"""
+
+    raw = req.raw
+
+    if req.headers.get('Content-Encoding', 'identity').lower() == 'identity':
+        # nothing needs to be decoded
+        return raw.readinto
+
+    def readinto(view):
+        data = raw.read(min(len(view), buffer_size), decode_content=True)
+        view[:len(data)] = data
+        return len(data)
+
+    return readinto
+
+
+def download(sess, url, target, buffer_size=DOWNLOAD_BUFFER_SIZE, fsync='none',
+             buckets=(), priority=False, hasher=None):
+    """Download url to the file target (or the path returned by target(response) if callable).
+
+    The body is read into a preallocated buffer and written to a temporary file next to
+    the target, which is renamed into place once complete, so the target never contains
+    partial content.
+
+    :param fsync: one of FSYNC_POLICIES
+    :param hasher: a hashlib object to be updated with the content
+    :returns: a `TransferStats` object
+    """
+
+    start = time.time()
+    buckets = [b for b in buckets if b is not None]
+
+    req = sess.get(url, stream=True)
+
+    with req:
+        req.raise_for_status()
+
+        if callable(target):
+            target = target(req)
+
+        tmp_fn = path.join(path.dirname(target) or '.', '.{}.part'.format(path.basename(target)))
+
+        expected = req.headers.get('Content-Length')
+        encoded = req.headers.get('Content-Encoding', 'identity').lower() != 'identity'
+
+        readinto = _body_reader(req, buffer_size)
+        view = memoryview(bytearray(buffer_size))
+        nbytes = 0
+
+        try:
+            with open(tmp_fn, 'wb', buffering=0) as fhandle:
+                while True:
+                    nread = readinto(view)
+                    if not nread:
+                        break
+
+                    chunk = view[:nread]
+
+                    for bucket in buckets:
+                        bucket.consume(nread, priority)
+
+                    if hasher is not None:
+                        hasher.update(chunk)
+
+                    # unbuffered writes may be partial
+                    while chunk:
+                        chunk = chunk[fhandle.write(chunk):]
+
+                    nbytes += nread
+
+                if fsync in ('file', 'full'):
+                    os.fsync(fhandle.fileno())
+
+            if expected is not None and not encoded and nbytes != int(expected):
+                raise requests.exceptions.ConnectionError(
+                    "incomplete download of {}: got {} of {} bytes".format(url, nbytes, expected))
+
+            os.replace(tmp_fn, target)
+
+        except BaseException:
+            if path.exists(tmp_fn):
+                os.unlink(tmp_fn)
+            raise
+
+    if fsync == 'full':
+        dir_fd = os.open(path.dirname(target) or '.', os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    return TransferStats(nbytes, time.time() - start)
+
+
+def upload(sess, url, data, field, fhandle, buckets=(), priority=False):
+    """POST the file object fhandle as multipart/form-data field together with the
+    form fields in data, streamed and limited by the given token buckets.
+
+    Equivalent to `sess.post(url, data=data, files={field: fhandle})`."""
+
+    with MultipartEncoder(data, {field: fhandle}) as encoder:
+        return sess.post(url,
+                         data=ThrottledReader(encoder, len(encoder), buckets, priority),
+                         headers={'Content-Type': encoder.content_type})
+
+
+def _sha256(fhandle, offset=0, length=None):
+    """Hash length bytes (all remaining if None) of fhandle, starting at offset"""
+
+    hasher = hashlib.sha256()
+    fhandle.seek(offset)
+
+    while length is None or length > 0:
+        data = fhandle.read(CHUNK_SIZE if length is None else min(CHUNK_SIZE, length))
+        if not data:
+            break
+        hasher.update(data)
+        if length is not None:
+            length -= len(data)
+
+    return hasher
+
+
+def resumable_upload(sess, sessions_url, name, fhandle, size, chunk_size,
+                     buckets=(), priority=False, session_url=None, on_session=None,
+                     retry_delay=RETRY_DELAY):
+    """Upload the seekable file object fhandle in chunks, resuming from the last offset
+    acknowledged by the server after errors instead of starting over.
+
+    The protocol:
+
+    1. `POST sessions_url` with JSON `{name, size, checksum}` creates an upload session,
+       the response contains its URL as `_links.self` and the current `offset`.
+    2. `PUT` to the session URL sends a chunk, with `Content-Range: bytes first-last/size`
+       and a `Digest: sha-256=<base64>` header. The server verifies the chunk and
+       responds with the acknowledged `offset`.
+    3. `GET` on the session URL returns the acknowledged `offset`, used to resume after
+       failed requests (or an unknown session, 404, in which case a new one is created).
+    4. `POST` to the session URL with JSON `{checksum}` completes the upload once
+       all bytes are acknowledged and the server verified the checksum of the whole file.
+
+    Failed attempts are retried after a short delay, until UPLOAD_RETRIES attempts in a row
+    failed without the server acknowledging more data. The error is raised then (to spool
+    the upload if the server is unreachable, and resume the session later).
+
+    :param session_url: the URL of a session to resume, if any
+    :param on_session: called with the session URL when a new session was created,
+                       and with None when the session is finished or discarded
+    :returns: the response completing the upload
+    """
+
+    checksum = 'sha256:' + _sha256(fhandle).hexdigest()
+    chunk_size = max(chunk_size, 1)
+
+    offset = None
+    acknowledged = 0  # the offset acknowledged by the server before the last failure
+    failures = 0
+
+    while True:
+        try:
+            if session_url is None:
+                req = sess.post(sessions_url, json={'name': name, 'size': size, 'checksum': checksum})
+                req.raise_for_status()
+                session_url = req.json()['_links']['self']
+                offset = acknowledged = req.json()['offset']
+
+                if on_session:
+                    on_session(session_url)
+
+            elif offset is None:
+                req = sess.get(session_url)
+                if req.status_code == 404:
+                    if on_session:
+                        on_session(None)
+
+                    failures += 1
+                    if failures > UPLOAD_RETRIES:
+                        req.raise_for_status()
+
+                    logger.warning("upload session for '%s' is gone, starting over", name)
+                    session_url = None
+                    continue
+
+                req.raise_for_status()
+                offset = req.json()['offset']
+                logger.info("resuming upload of '%s' at %d of %d bytes", name, offset, size)
+
+                if offset > acknowledged:
+                    # the data got through, only the acknowledgement was lost
+                    failures = 0
+                acknowledged = offset
+
+            if offset >= size:
+                req = sess.post(session_url, json={'checksum': checksum})
+
+                if 400 <= req.status_code < 500 and req.status_code not in FATAL_STATUS_CODES:
+                    # the assembled file is broken, there is no point in resuming this session
+                    logger.warning("server rejected the assembled '%s', starting over", name)
+                    session_url = None
+                    if on_session:
+                        on_session(None)
+
+                req.raise_for_status()
+
+                if on_session:
+                    on_session(None)
+
+                return req
+
+            length = min(chunk_size, size - offset)
+            digest = base64.b64encode(_sha256(fhandle, offset, length).digest()).decode('ascii')
+
+            fhandle.seek(offset)
+            req = sess.put(session_url,
+                           data=ThrottledReader(fhandle, length, buckets, priority),
+                           headers={
+                               'Content-Type': 'application/octet-stream',
+                               'Content-Range': 'bytes {}-{}/{}'.format(offset, offset+length-1, size),
+                               'Digest': 'sha-256=' + digest,
+                               })
+            req.raise_for_status()
+
+            offset = acknowledged = req.json()['offset']
+            failures = 0
+
+        except (requests.exceptions.RequestException, ValueError, KeyError) as exc:
+            response = getattr(exc, 'response', None)
+            if response is not None and response.status_code in FATAL_STATUS_CODES:
+                raise
+
+            failures += 1
+            if failures > UPLOAD_RETRIES:
+                raise
+
+            logger.warning("upload of '%s' failed at offset %s, retrying in %ds: %s",
+                           name, offset, retry_delay, exc)
+            time.sleep(retry_delay)
+
+            # re-synchronize with the server before sending the next chunk
+            offset = None
+
+
+class UploadSessions(object):
+    """The open resumable upload sessions of a task dir, persisted to continue
+    interrupted uploads of the same artifact after a restart"""
+
+    def __init__(self, task_dir):
+        self._fn = path.join(task_dir, UPLOAD_SESSIONS_NAME)
+
+        try:
+            with open(self._fn, 'r') as fhandle:
+                self._sessions = json.load(fhandle)
+        except (OSError, IOError, ValueError):
+            self._sessions = {}
+
+    def get(self, name, size):
+        """The URL of an open session for the artifact of the given size, if any"""
+
+        session = self._sessions.get(name)
+        if session and session['size'] == size:
+            return session['url']
+        return None
+
+    def set(self, name, size, url):
+        """Record (or with url None, forget) the session for an artifact"""
+
+        if url is None:
+            self._sessions.pop(name, None)
+        else:
+            self._sessions[name] = {'size': size, 'url': url}
+
+        tmp_fn = self._fn + '.tmp'
+        with open(tmp_fn, 'w') as fhandle:
+            json.dump(self._sessions, fhandle)
+        os.rename(tmp_fn, self._fn)
@@ -0,0 +1,135 @@
+"""Placement of task directories on several data volumes"""
+
+import os
+import time
+import logging
+from os import path
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+# the io_ticks field (milliseconds spent doing I/O) in /sys/dev/block/<major>:<minor>/stat
+IO_TICKS_FIELD = 9
+
+# the minimal time in seconds between two samples for the device utilization
+MIN_SAMPLE_INTERVAL = 1
+
+# space to leave free on a volume in addition to the expected size of a new task dir
+FREE_SPACE_MARGIN = 1024**3
+
+
+def _device_stat_fn(dirpath):
+    """The block device statistics file of the device a directory resides on, None if not a block device"""
+
+    dev = os.stat(dirpath).st_dev
+    stat_fn = '/sys/dev/block/{}:{}/stat'.format(os.major(dev), os.minor(dev))
+    return stat_fn if path.exists(stat_fn) else None
+
+
+class DataVolume(object):
+    """A data directory, with the utilization of the underlying device"""
+
+    def __init__(self, data_dir):
+        self.path = data_dir
+        self._stat_fn = _device_stat_fn(data_dir)
+        self._sample = None
+        self.utilization = 0.
+
+    @property
+    def free(self):
+        """The free space in bytes"""
+        stat = os.statvfs(self.path)
+        return stat.f_bavail * stat.f_frsize
+
+    def update(self):
+        """Update the utilization (fraction of the time the device was busy) since the last update"""
+
+        if self._stat_fn is None:
+            return
+
+        try:
+            with open(self._stat_fn, 'r') as fhandle:
+                ticks = int(fhandle.read().split()[IO_TICKS_FIELD])
+        except (OSError, IOError, ValueError, IndexError):
+            return
+
+        now = time.time()
+        if self._sample is not None and now - self._sample[0] < MIN_SAMPLE_INTERVAL:
+            return
+
+        if self._sample is not None:
+            self.utilization = min((ticks - self._sample[1]) / 1000. / (now - self._sample[0]), 1.)
+        self._sample = (now, ticks)
+
+
+class DataVolumes(object):
+    """Several data directories, usually on different devices, for the task directories.
+
+    Existing task dirs are used wherever they are. New ones are placed on the volume
+    with the fewest task dirs in use, then the lowest device utilization, provided
+    it has enough free space."""
+
+    def __init__(self, data_dirs):
+        self.volumes = [DataVolume(d) for d in data_dirs]
+
+        for volume in self.volumes:
+            volume.update()
+
+    @property
+    def primary(self):
+        """The first data directory, used for the state of fdaemon itself"""
+        return self.volumes[0].path
+
+    def _volume_of(self, task_dir):
+        for volume in self.volumes:
+            if path.dirname(task_dir) == volume.path:
+                return volume
+        return None
+
+    def find(self, task_id):
+        """The existing directory of a task, None if there is none"""
+
+        for volume in self.volumes:
+            task_dir = path.join(volume.path, task_id)
+            if path.isdir(task_dir):
+                return task_dir
+
+        return None
+
+    def task_dir(self, task_id, size=0, in_use=()):
+        """The directory of a task, either the existing one or the one on the best volume for a new one.
+
+        :param size: the expected size of the task dir in bytes
+        :param in_use: the directories of the tasks which are currently running
+        """
+
+        task_dir = self.find(task_id)
+        if task_dir is not None or len(self.volumes) == 1:
+            return task_dir or path.join(self.primary, task_id)
+
+        counts = {v.path: 0 for v in self.volumes}
+        for other_dir in in_use:
+            volume = self._volume_of(other_dir)
+            if volume is not None:
+                counts[volume.path] += 1
+
+        candidates = []
+        for volume in self.volumes:
+            volume.update()
+            try:
+                free = volume.free
+            except OSError as exc:
+                logger.warning("data volume '%s' not usable: %s", volume.path, exc)
+                continue
+            candidates.append((free >= (size or 0) + FREE_SPACE_MARGIN,
+                               -counts[volume.path], -round(volume.utilization, 1), free, volume))
+
+        if not candidates:
+            return path.join(self.primary, task_id)
+
+        # the volume with enough space, fewest tasks, lowest utilization and most space
+        volume = max(candidates, key=lambda c: c[:4])[4]
+
+        logger.debug("placing task %s on '%s' (%d tasks, %.0f%% utilized)",
+                     task_id, volume.path, counts[volume.path], 100*volume.utilization)
+
+        return path.join(volume.path, task_id)
@@ -0,0 +1,171 @@
+"""Interruptible sleep for the fdaemon main loop"""
+
+import os
+import time
+import errno
+import struct
+import select
+import logging
+import ctypes
+import ctypes.util
+
+logger = logging.getLogger(__name__)  # pylint: disable=locally-disabled,invalid-name
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """Minimal ctypes-based wrapper for the Linux inotify API"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._rm_watch = libc.inotify_rm_watch
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, dirpath, mask):
+        """Add a watch for the given directory, returns the watch descriptor"""
+        wdesc = self._add_watch(self.fd, os.fsencode(dirpath), mask)
+        if wdesc < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dirpath)
+        return wdesc
+
+    def rm_watch(self, wdesc):
+        """Remove a watch, errors (the watch might already be gone) are ignored"""
+        self._rm_watch(self.fd, wdesc)
+
+    def read_events(self):
+        """Read all pending events as a list of tuples `(wd, mask, name)`"""
+
+        events = []
+
+        while True:
+            try:
+                buf = os.read(self.fd, 64*1024)
+            except OSError as exc:
+                if exc.errno == errno.EAGAIN:
+                    break
+                raise
+
+            offset = 0
+            while offset < len(buf):
+                wdesc, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+                offset += _EVENT_HEADER.size
+                name = buf[offset:offset+length].rstrip(b'\0').decode('utf-8', 'replace')
+                offset += length
+                events.append((wdesc, mask, name))
+
+        return events
+
+
+class Wakeup(object):
+    """Sleep until a timeout expires, another thread calls `notify()`,
+       or one of the watched sentinel files in a task directory gets written.
+
+    Local tasks run in the background call `notify()` when their processes terminate,
+    detached (Slurm) tasks are detected via inotify on their output files.
+    Without inotify support, only the local notification and the timeout remain.
+    """
+
+    def __init__(self):
+        self._rfd, self._wfd = os.pipe()
+        for fdesc in (self._rfd, self._wfd):
+            os.set_blocking(fdesc, False)
+
+        self._watches = {}  # directory -> (watch descriptor, set of sentinel names)
+
+        try:
+            self._inotify = Inotify()
+        except (OSError, AttributeError) as exc:
+            logger.info("inotify not available, detached tasks are only checked periodically: %s", exc)
+            self._inotify = None
+
+    def notify(self):
+        """Wake up the sleeping main loop (may be called from any thread)"""
+        try:
+            os.write(self._wfd, b'\0')
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:  # the pipe is full, a wakeup is pending anyway
+                raise
+
+    def watch(self, dirpath, sentinels):
+        """Wake up as soon as one of the files named in sentinels gets written in dirpath"""
+
+        if self._inotify is None or dirpath in self._watches:
+            return
+
+        try:
+            wdesc = self._inotify.add_watch(dirpath, IN_CLOSE_WRITE | IN_MOVED_TO)
+        except OSError as exc:
+            logger.warning("unable to watch directory '%s': %s", dirpath, exc)
+            return
+
+        self._watches[dirpath] = (wdesc, set(sentinels))
+
+    def unwatch(self, dirpath):
+        """Stop watching the given directory"""
+
+        try:
+            wdesc, _ = self._watches.pop(dirpath)
+        except KeyError:
+            return
+
+        self._inotify.rm_watch(wdesc)
+
+    def wait(self, timeout):
+        """Sleep for at most timeout seconds, returns True if woken up early"""
+
+        deadline = time.time() + timeout
+
+        fds = [self._rfd]
+        if self._inotify is not None:
+            fds.append(self._inotify.fd)
+
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+
+            try:
+                readable, _, _ = select.select(fds, [], [], remaining)
+            except InterruptedError:
+                continue
+
+            if self._rfd in readable:
+                try:
+                    while os.read(self._rfd, 4096):
+                        pass
+                except OSError as exc:
+                    if exc.errno != errno.EAGAIN:
+                        raise
+                return True
+
+            if self._inotify is not None and self._inotify.fd in readable and self._sentinel_written():
+                return True
+
+    def _sentinel_written(self):
+        """Consume the inotify events and check whether one of them concerns a sentinel file"""
+
+        sentinels = {wdesc: names for wdesc, names in self._watches.values()}
+        written = False
+
+        for wdesc, mask, name in self._inotify.read_events():
+            if mask & IN_IGNORED:  # the directory was removed
+                self._watches = {d: w for d, w in self._watches.items() if w[0] != wdesc}
+            elif name in sentinels.get(wdesc, ()):
+                logger.debug("woken up by '%s' being written", name)
+                written = True
+
+        return written
@@ -7,6 +7,7 @@ setup(
     version='0.1.dev0',
     packages=find_packages(),
     license='GPL3',
+    python_requires='>=3.7',
     install_requires=[
         'click>=6.6',
         'click-log>=0.1.4',
@@ -20,5 +21,6 @@ setup(
         [console_scripts]
         fdaemon=fatman_clients.fdaemon:main
         fclient=fatman_clients.fclient:cli
+        fdaemon-events=fatman_clients.events:analyze
         ''',
     )
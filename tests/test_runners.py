@@ -0,0 +1,63 @@
+"""Tests for the helpers of the command runners"""
+
+import pytest
+
+from fatman_clients.runners import command_dependencies, parse_duration
+
+
+def commands(*specs):
+    """Build command settings from (name, after) tuples, after being None to leave it out"""
+    result = []
+    for name, after in specs:
+        command = {'name': name, 'cmd': 'true', 'args': []}
+        if after is not None:
+            command['after'] = after
+        result.append(command)
+    return result
+
+
+def test_commands_run_sequentially_by_default():
+    assert command_dependencies(commands(('a', None), ('b', None), ('c', None))) == {
+        'a': set(), 'b': {'a'}, 'c': {'b'}}
+
+
+def test_explicit_dependencies():
+    deps = command_dependencies(commands(('prep', None), ('x', ['prep']), ('y', ['prep']), ('post', ['x', 'y'])))
+    assert deps == {'prep': set(), 'x': {'prep'}, 'y': {'prep'}, 'post': {'x', 'y'}}
+
+
+def test_empty_after_runs_right_away():
+    assert command_dependencies(commands(('a', None), ('b', []))) == {'a': set(), 'b': set()}
+
+
+def test_unknown_dependencies():
+    with pytest.raises(ValueError, match='unknown'):
+        command_dependencies(commands(('a', None), ('b', ['nope'])))
+
+
+def test_cyclic_dependencies():
+    with pytest.raises(ValueError, match='cyclic'):
+        command_dependencies(commands(('a', ['c']), ('b', ['a']), ('c', ['b'])))
+
+    with pytest.raises(ValueError, match='cyclic'):
+        command_dependencies(commands(('a', ['a'])))
+
+
+@pytest.mark.parametrize('value,seconds', [
+    (None, None),
+    (90, 90),
+    ('3600', 3600),
+    ('90m', 5400),
+    ('1.5h', 5400),
+    ('2d', 172800),
+    ('01:30', 5400),
+    ('1-00:00:10', 86410),
+    ])
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == seconds
+
+
+@pytest.mark.parametrize('value', ['soon', '1-0', '1h30m', ''])
+def test_parse_duration_invalid(value):
+    with pytest.raises(ValueError):
+        parse_duration(value)
@@ -0,0 +1,110 @@
+"""Tests for the spool of operations kept while the server is unreachable"""
+
+import os
+
+import pytest
+import requests
+
+from fatman_clients.spool import Spool, is_transient
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError("{} error".format(status_code), response=response)
+
+
+class Server(object):
+    """Executes operations by recording them, raising the queued errors first"""
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.executed = []
+
+    def __call__(self, oper):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.executed.append(oper)
+        return oper
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return Spool(str(tmp_path / 'spool'))
+
+
+def test_is_transient():
+    assert is_transient(requests.exceptions.ConnectionError())
+    assert is_transient(requests.exceptions.Timeout())
+    assert is_transient(http_error(503))
+    assert not is_transient(http_error(400))
+    assert not is_transient(http_error(500))
+
+
+def test_submit_executes_right_away(spool):
+    server = Server()
+    assert spool.submit('t1', [{'op': 'a'}, {'op': 'b'}], server) == {'op': 'b'}
+    assert server.executed == [{'op': 'a'}, {'op': 'b'}]
+    assert len(spool) == 0
+
+
+def test_submit_spools_the_remaining_operations(spool):
+    server = Server(requests.exceptions.ConnectionError())
+    assert spool.submit('t1', [{'op': 'a'}, {'op': 'b'}], server) is None
+    assert spool.has('t1') and not spool.has('t2')
+
+    # the following operations are spooled as well to keep the order
+    assert spool.submit('t2', [{'op': 'c'}], server) is None
+    assert server.executed == []
+
+    assert spool.replay(server)
+    assert server.executed == [{'op': 'a'}, {'op': 'b'}, {'op': 'c'}]
+    assert len(spool) == 0
+
+
+def test_submit_raises_other_errors(spool):
+    with pytest.raises(requests.exceptions.HTTPError):
+        spool.submit('t1', [{'op': 'a'}], Server(http_error(400)))
+    assert len(spool) == 0
+
+
+def test_replay_keeps_the_entries_while_unreachable(spool):
+    spool.add('t1', [{'op': 'a'}, {'op': 'b'}])
+
+    server = Server()
+
+    # the first operation goes through, the server is unreachable for the second one
+    def flaky(oper):
+        if oper['op'] == 'b':
+            raise requests.exceptions.ConnectionError()
+        return server(oper)
+
+    assert not spool.replay(flaky)
+    assert server.executed == [{'op': 'a'}]
+
+    # completed operations are not repeated
+    assert spool.replay(server)
+    assert server.executed == [{'op': 'a'}, {'op': 'b'}]
+    assert len(spool) == 0
+
+
+def test_replay_moves_failing_entries_aside(spool):
+    spool.add('t1', [{'op': 'a'}])
+    spool.add('t2', [{'op': 'b'}])
+
+    server = Server(http_error(400))
+    assert spool.replay(server)
+
+    assert server.executed == [{'op': 'b'}]
+    assert len(spool) == 0
+    assert spool.has_failed('t1') and not spool.has_failed('t2')
+    assert len(os.listdir(spool.failed_dir)) == 1
+
+
+def test_add_failed(spool):
+    spool.add('t1', [{'op': 'a'}])
+    spool.add_failed('t2', [{'op': 'b'}])
+
+    assert spool.has('t1') and not spool.has('t2')
+    assert spool.has_failed('t2')
+    assert len(spool) == 1
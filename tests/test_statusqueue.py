@@ -0,0 +1,145 @@
+"""Tests for the batching of task status updates"""
+
+import json
+
+import pytest
+import requests
+
+from fatman_clients.spool import Spool
+from fatman_clients.statusqueue import StatusQueue
+
+BULK_URL = 'http://server/api/v2/tasks'
+
+
+def response(obj, status_code=200):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp._content = json.dumps(obj).encode('utf-8')  # pylint: disable=protected-access
+    return resp
+
+
+class Server(object):
+    """Executes the patch operations of the queue, bulk ones fail with the given status code"""
+
+    def __init__(self, bulk_status=None, failing_urls=()):
+        self.bulk_status = bulk_status
+        self.failing_urls = failing_urls
+        self.requests = []
+
+    def __call__(self, oper):
+        self.requests.append(oper)
+
+        if oper['url'] == BULK_URL:
+            if self.bulk_status is not None:
+                resp = response({}, self.bulk_status)
+                resp.raise_for_status()
+            return response(oper['json'])
+
+        if oper['url'] in self.failing_urls:
+            response({}, 400).raise_for_status()
+
+        return response(dict(oper['json'], id=oper['url'].rsplit('/', 1)[1]))
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return Spool(str(tmp_path / 'spool'))
+
+
+def task_url(task_id):
+    return BULK_URL + '/' + task_id
+
+
+def test_updates_are_coalesced(spool):
+    server = Server()
+    queue = StatusQueue(BULK_URL, spool, server, window=3600)
+
+    queue.put('t1', task_url('t1'), {'status': 'running'})
+    queue.put('t1', task_url('t1'), {'status': 'done', 'data': {'errors': []}})
+    assert len(queue) == 1 and 't1' in queue
+    assert server.requests == []
+
+    queue.flush()
+    assert server.requests == [{'op': 'patch', 'url': task_url('t1'),
+                                'json': {'status': 'done', 'data': {'errors': []}}}]
+    assert len(queue) == 0
+
+
+def test_coalescing_keeps_earlier_fields(spool):
+    server = Server()
+    queue = StatusQueue(BULK_URL, spool, server, window=3600)
+
+    queue.put('t1', task_url('t1'), {'status': 'running', 'machine': 'host'})
+    queue.put('t1', task_url('t1'), {'status': 'done'})
+    queue.flush()
+
+    assert server.requests[0]['json'] == {'status': 'done', 'machine': 'host'}
+
+
+def test_updates_are_sent_in_bulk(spool):
+    server = Server()
+    updated = []
+    queue = StatusQueue(BULK_URL, spool, server, window=3600, on_update=updated.append)
+
+    for task_id in ('t1', 't2', 't3'):
+        queue.put(task_id, task_url(task_id), {'status': 'done'})
+    queue.flush()
+
+    assert len(server.requests) == 1
+    assert server.requests[0]['json'] == [{'status': 'done', 'id': t} for t in ('t1', 't2', 't3')]
+    assert [t['id'] for t in updated] == ['t1', 't2', 't3']
+    assert (queue.sent_requests, queue.sent_updates) == (1, 3)
+
+
+def test_without_window_updates_are_sent_right_away(spool):
+    server = Server()
+    queue = StatusQueue(BULK_URL, spool, server, window=0)
+
+    queue.put('t1', task_url('t1'), {'status': 'running'})
+    assert len(server.requests) == 1 and len(queue) == 0
+
+
+def test_rejected_bulk_updates_are_sent_per_task(spool):
+    server = Server(bulk_status=405)
+    queue = StatusQueue(BULK_URL, spool, server, window=3600)
+
+    queue.put('t1', task_url('t1'), {'status': 'done'})
+    queue.put('t2', task_url('t2'), {'status': 'error'})
+    queue.flush()
+
+    assert [r['url'] for r in server.requests] == [BULK_URL, task_url('t1'), task_url('t2')]
+
+    # and bulk updates are not tried again
+    queue.put('t3', task_url('t3'), {'status': 'done'})
+    queue.put('t4', task_url('t4'), {'status': 'done'})
+    queue.flush()
+
+    assert [r['url'] for r in server.requests[3:]] == [task_url('t3'), task_url('t4')]
+
+
+def test_failed_updates_are_kept(spool):
+    server = Server(failing_urls=(task_url('t1'),))
+    queue = StatusQueue(None, spool, server, window=3600)
+
+    queue.put('t1', task_url('t1'), {'status': 'done'})
+    queue.put('t2', task_url('t2'), {'status': 'done'})
+    queue.flush()
+
+    assert spool.has_failed('t1') and not spool.has_failed('t2')
+    assert (queue.sent_requests, queue.sent_updates) == (1, 1)
+
+
+def test_updates_are_spooled_while_unreachable(spool):
+    def unreachable(oper):
+        raise requests.exceptions.ConnectionError()
+
+    queue = StatusQueue(BULK_URL, spool, unreachable, window=3600)
+    queue.put('t1', task_url('t1'), {'status': 'done'})
+    queue.put('t2', task_url('t2'), {'status': 'done'})
+    queue.flush()
+
+    assert spool.has('t1') and spool.has('t2')
+
+    server = Server()
+    assert spool.replay(server)
+    assert [r['url'] for r in server.requests] == [task_url('t1'), task_url('t2')]
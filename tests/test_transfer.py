@@ -0,0 +1,178 @@
+"""Tests for the resumable chunked uploads"""
+
+import io
+import json
+import base64
+import hashlib
+
+import pytest
+import requests
+
+from fatman_clients import transfer
+
+SESSIONS_URL = 'http://server/sessions'
+
+
+def response(obj, status_code=200):
+    resp = requests.Response()
+    resp.status_code = status_code
+    resp._content = json.dumps(obj).encode('utf-8')  # pylint: disable=protected-access
+    return resp
+
+
+class UploadServer(object):
+    """In-memory stand-in for the upload session endpoints, passed to resumable_upload
+    in place of the requests session. Faults are consumed one per request:
+    None for none, 'lose-ack' to store a chunk but fail the request,
+    'drop' to fail a request, 'gone' to forget the session first."""
+
+    def __init__(self, faults=()):
+        self.faults = list(faults)
+        self.sessions = {}
+        self.completed = {}
+        self.requests = []
+
+    def _fault(self):
+        return self.faults.pop(0) if self.faults else None
+
+    def post(self, url, json=None):  # pylint: disable=redefined-outer-name
+        self.requests.append(('POST', url))
+        fault = self._fault()
+        if fault == 'drop':
+            raise requests.exceptions.ConnectionError()
+
+        if url == SESSIONS_URL:
+            session_url = '{}/{}'.format(SESSIONS_URL, len(self.sessions))
+            self.sessions[session_url] = {'name': json['name'], 'size': json['size'], 'data': b''}
+            return response({'_links': {'self': session_url}, 'offset': 0}, 201)
+
+        session = self.sessions.pop(url)
+        if 'sha256:' + hashlib.sha256(session['data']).hexdigest() != json['checksum']:
+            return response({}, 422)
+        self.completed[session['name']] = session['data']
+        return response({}, 201)
+
+    def get(self, url):
+        self.requests.append(('GET', url))
+        fault = self._fault()
+        if fault == 'drop':
+            raise requests.exceptions.ConnectionError()
+        if fault == 'gone':
+            self.sessions.pop(url, None)
+
+        if url not in self.sessions:
+            return response({}, 404)
+        return response({'offset': len(self.sessions[url]['data'])})
+
+    def put(self, url, data, headers):
+        self.requests.append(('PUT', url))
+        fault = self._fault()
+
+        chunk = data.read()
+        first = int(headers['Content-Range'].split(' ')[1].split('-')[0])
+        assert headers['Digest'] == 'sha-256=' + base64.b64encode(hashlib.sha256(chunk).digest()).decode()
+
+        if fault == 'drop':
+            raise requests.exceptions.ConnectionError()
+
+        session = self.sessions[url]
+        assert first == len(session['data'])
+        session['data'] += chunk
+
+        if fault == 'lose-ack':
+            raise requests.exceptions.ConnectionError()
+
+        return response({'offset': len(session['data'])})
+
+
+def upload(server, data, chunk_size=4, **kwargs):
+    return transfer.resumable_upload(server, SESSIONS_URL, 'out.txt', io.BytesIO(data), len(data),
+                                     chunk_size, retry_delay=0, **kwargs)
+
+
+DATA = b'0123456789abcdefghij'
+
+
+def test_upload_in_chunks():
+    server = UploadServer()
+    upload(server, DATA)
+
+    assert server.completed == {'out.txt': DATA}
+    assert [r[0] for r in server.requests] == ['POST'] + ['PUT']*5 + ['POST']
+
+
+def test_resync_after_a_lost_acknowledgement():
+    server = UploadServer([None, None, 'lose-ack'])
+    upload(server, DATA)
+
+    # the chunk got through, the upload continues after it instead of sending it again
+    assert server.completed == {'out.txt': DATA}
+    assert [r[0] for r in server.requests] == ['POST', 'PUT', 'PUT', 'GET'] + ['PUT']*3 + ['POST']
+
+
+def test_resync_after_a_dropped_chunk():
+    server = UploadServer([None, 'drop'])
+    upload(server, DATA)
+
+    assert server.completed == {'out.txt': DATA}
+    assert [r[0] for r in server.requests] == ['POST', 'PUT', 'GET'] + ['PUT']*5 + ['POST']
+
+
+def test_progress_resets_the_retries():
+    # more acknowledgements get lost than attempts in a row may fail, but the data gets through
+    server = UploadServer([None] + ['lose-ack', None] * 10)
+    upload(server, DATA, chunk_size=2)
+
+    assert server.completed == {'out.txt': DATA}
+
+
+def test_give_up_without_progress():
+    server = UploadServer([None] + ['drop'] * (transfer.UPLOAD_RETRIES + 1))
+    sessions = []
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        upload(server, DATA, on_session=sessions.append)
+
+    # the session is kept to resume the upload later
+    session_url = sessions[-1]
+    assert session_url is not None
+
+    upload(server, DATA, session_url=session_url, on_session=sessions.append)
+    assert server.completed == {'out.txt': DATA}
+    assert sessions[-1] is None
+    assert sum(1 for r in server.requests if r[0] == 'POST' and r[1] == SESSIONS_URL) == 1
+
+
+def test_restart_if_the_session_is_gone():
+    server = UploadServer([None, None, 'drop', 'gone'])
+    upload(server, DATA)
+
+    assert server.completed == {'out.txt': DATA}
+    assert sum(1 for r in server.requests if r == ('POST', SESSIONS_URL)) == 2
+
+
+def test_restarts_count_as_failures():
+    class Forgetful(UploadServer):
+        """Loses every session right after sending a chunk to it failed"""
+        def put(self, url, data, headers):
+            self.requests.append(('PUT', url))
+            del self.sessions[url]
+            raise requests.exceptions.ConnectionError()
+
+    server = Forgetful()
+    with pytest.raises(requests.exceptions.RequestException):
+        upload(server, DATA)
+
+    assert sum(1 for r in server.requests if r == ('POST', SESSIONS_URL)) <= transfer.UPLOAD_RETRIES
+
+
+def test_fatal_errors_are_not_retried():
+    class Forbidden(UploadServer):
+        def post(self, url, json=None):  # pylint: disable=redefined-outer-name
+            self.requests.append(('POST', url))
+            return response({}, 403)
+
+    server = Forbidden()
+    with pytest.raises(requests.exceptions.HTTPError):
+        upload(server, DATA)
+    assert len(server.requests) == 1